@@ -30,7 +30,8 @@ cd "$ext_repo_dir"/llm-foundry/scripts/data_prep
 # - use an example tiny C4 dataset,
 # - write data to scratch,
 # - use a local tokenizer,
-# - do not compress the resulting binary file.
+# - do not compress the resulting binary file,
+# - tokenize texts in batches.
 
 # Convert json dataset to StreamingDataset format
 # Alternatively, you can use
@@ -41,13 +42,18 @@ python -u "$(get_curr_dir)"/../py-scripts/convert_dataset_json_parallel.py \
   --path "$INPUT_DATA_FILE" \
   --out_root "$OUTPUT_DATA_DIR" --split train \
   --concat_tokens 2048 --tokenizer "$TOKENIZER_DIR" \
-  --get_bos_token_id --get_eos_token_id
+  --get_bos_token_id --get_eos_token_id \
+  --tokenization_batch_size 4096
 
 # Convert raw Parquet data.
 # python -u "$(get_curr_dir)"/../py-scripts/convert_dataset_parquet_parallel.py \
 #   --path "$INPUT_DATA_FILE" \
 #   --out_root "$OUTPUT_DATA_DIR" --split train \
 #   --concat_tokens 2048 --tokenizer "$TOKENIZER_DIR" \
-#   --get_bos_token_id --get_eos_token_id --no_use_fast
+#   --get_bos_token_id --get_eos_token_id --no_use_fast \
+#   --tokenization_batch_size 4096
+# To be able to resume the Parquet conversion after a crash or
+# preemption by re-submitting the same job, additionally pass
+# `--checkpoint_interval 16` (record progress every 16 row groups).
 
 pop_curr_file
@@ -0,0 +1,341 @@
+"""
+Batched tokenization and concatenation of text into fixed-length token
+samples.
+
+This is a drop-in alternative to LLM Foundry's `ConcatTokensDataset`
+that calls the (fast) tokenizer once per batch of texts instead of once
+per text and packs the resulting token IDs using NumPy buffers instead
+of Python list slicing. Optionally, tokenization is distributed over a
+pool of worker processes while keeping the output order deterministic.
+"""
+
+import collections
+import itertools
+import multiprocessing as mp
+from multiprocessing.pool import Pool
+import os
+import time
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+import warnings
+
+import numpy as np
+from torch.utils.data import IterableDataset
+from transformers import PreTrainedTokenizerBase
+
+from conversion_pipeline import prefetch
+from data_prep_metrics import get_metrics
+
+DEFAULT_TOKENIZATION_BATCH_SIZE = 4096
+
+# Tokenizer of a tokenization worker process; set by
+# `_init_tokenization_worker`.
+_worker_tokenizer = None
+
+
+def get_special_tokens(
+        tokenizer: PreTrainedTokenizerBase,
+        bos_text: str = '',
+        eos_text: str = '',
+        get_bos_token_id: bool = False,
+        get_eos_token_id: bool = False,
+) -> Tuple[List[int], List[int]]:
+    """Return the token IDs to insert before and after each text.
+
+    Args:
+        tokenizer (PreTrainedTokenizerBase): The tokenizer to use.
+        bos_text (str): Text to insert at the beginning of each sequence.
+        eos_text (str): Text to insert at the end of each sequence.
+        get_bos_token_id (bool): Whether to use the tokenizer's BOS token
+            ID instead of tokenizing `bos_text`.
+        get_eos_token_id (bool): Whether to use the tokenizer's EOS token
+            ID instead of tokenizing `eos_text`.
+
+    Returns:
+        A tuple of BOS token IDs and EOS token IDs.
+    """
+    if get_bos_token_id:
+        bos_tokens = [tokenizer.bos_token_id]
+    else:
+        bos_tokens = tokenizer(
+            bos_text,
+            truncation=False,
+            padding=False,
+            add_special_tokens=False,
+        )['input_ids']
+        if len(bos_tokens) > 1:
+            warnings.warn(
+                f'You specified --bos_text={bos_text}. That text will be '
+                f'tokenized into {len(bos_tokens)} tokens, not a single '
+                f'BOS token.',
+            )
+
+    if get_eos_token_id:
+        eos_tokens = [tokenizer.eos_token_id]
+    else:
+        eos_tokens = tokenizer(
+            eos_text,
+            truncation=False,
+            padding=False,
+            add_special_tokens=False,
+        )['input_ids']
+        if len(eos_tokens) > 1:
+            warnings.warn(
+                f'You specified --eos_text={eos_text}. That text will be '
+                f'tokenized into {len(eos_tokens)} tokens, not a single '
+                f'EOS token.',
+            )
+
+    return bos_tokens, eos_tokens
+
+
+def tokenize_texts(
+        tokenizer: PreTrainedTokenizerBase,
+        texts: List[str],
+        bos_tokens: List[int],
+        eos_tokens: List[int],
+        dtype: np.dtype = np.int32,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Tokenize a batch of texts with a single tokenizer call.
+
+    Args:
+        tokenizer (PreTrainedTokenizerBase): The tokenizer to use.
+        texts (List[str]): The texts to tokenize.
+        bos_tokens (List[int]): Token IDs to insert before each text.
+        eos_tokens (List[int]): Token IDs to insert after each text.
+        dtype (np.dtype): Data type of the returned token IDs.
+
+    Returns:
+        A tuple of the flat array of all token IDs (including BOS and EOS
+        tokens) and the array of per-text token counts.
+    """
+    input_ids = tokenizer(texts, truncation=False, padding=False)['input_ids']
+    num_special_tokens = len(bos_tokens) + len(eos_tokens)
+    doc_lengths = np.fromiter(
+        (len(ids) + num_special_tokens for ids in input_ids),
+        dtype=np.int64,
+        count=len(input_ids),
+    )
+    tokens = np.fromiter(
+        itertools.chain.from_iterable(
+            itertools.chain(bos_tokens, ids, eos_tokens)
+            for ids in input_ids
+        ),
+        dtype=dtype,
+        count=int(doc_lengths.sum()),
+    )
+    return tokens, doc_lengths
+
+
+class TokenPacker:
+    """Pack a stream of tokenized texts into samples of `max_length`.
+
+    The behavior is the same as in LLM Foundry's `ConcatTokensDataset`:
+    when wrapping, texts are concatenated and cut at every `max_length`
+    boundary; when not wrapping, a sample is emitted as soon as the
+    buffered texts reach `max_length` and the remaining tokens of the
+    buffer are discarded.
+    """
+
+    def __init__(
+            self,
+            max_length: int,
+            should_wrap: bool = True,
+            dtype: np.dtype = np.int32,
+    ) -> None:
+        self.max_length = max_length
+        self.should_wrap = should_wrap
+        self.buffer = np.empty(0, dtype=dtype)
+
+    def pack(
+            self,
+            tokens: np.ndarray,
+            doc_lengths: np.ndarray,
+    ) -> Iterator[np.ndarray]:
+        """Add tokenized texts to the buffer and yield all full samples.
+
+        Args:
+            tokens (np.ndarray): Flat array of token IDs of all texts.
+            doc_lengths (np.ndarray): Number of tokens of each text.
+
+        Yields:
+            Samples of exactly `max_length` token IDs.
+        """
+        num_buffered = len(self.buffer)
+        if num_buffered > 0:
+            tokens = np.concatenate([self.buffer, tokens])
+
+        if self.should_wrap:
+            num_samples = len(tokens) // self.max_length
+            end = num_samples * self.max_length
+            yield from tokens[:end].reshape(num_samples, self.max_length)
+            self.buffer = tokens[end:].copy()
+        else:
+            start = 0
+            for doc_end in num_buffered + np.cumsum(doc_lengths):
+                if doc_end - start >= self.max_length:
+                    yield tokens[start:start + self.max_length]
+                    start = doc_end
+            self.buffer = tokens[start:].copy()
+
+
+def _init_tokenization_worker(tokenizer: PreTrainedTokenizerBase) -> None:
+    global _worker_tokenizer
+    # Parallelism comes from the worker processes; do not let each of
+    # them spawn its own tokenizer thread pool on top.
+    os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+    _worker_tokenizer = tokenizer
+
+
+def _tokenize_in_worker(
+        args: Tuple[List[str], List[int], List[int], np.dtype],
+) -> Tuple[np.ndarray, np.ndarray, float]:
+    """Tokenize in a worker process; additionally returns the number of
+    seconds spent tokenizing.
+    """
+    texts, bos_tokens, eos_tokens, dtype = args
+    start = time.perf_counter()
+    tokens, doc_lengths = tokenize_texts(
+        _worker_tokenizer,
+        texts,
+        bos_tokens,
+        eos_tokens,
+        dtype=dtype,
+    )
+    return tokens, doc_lengths, time.perf_counter() - start
+
+
+def imap_bounded(
+        pool: Pool,
+        func: Callable[[Any], Any],
+        iterable: Iterable[Any],
+        max_pending: int,
+) -> Iterator[Any]:
+    """Like `pool.imap`, but with at most `max_pending` tasks in flight.
+
+    `Pool.imap` consumes its input as fast as possible, which would
+    read the whole dataset into memory if tokenization is slower than
+    reading. Results are returned in input order.
+    """
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) >= max_pending:
+            yield pending.popleft().get()
+        pending.append(pool.apply_async(func, (item,)))
+    while pending:
+        yield pending.popleft().get()
+
+
+def iter_text_batches(
+        hf_dataset: Iterable[Dict],
+        batch_size: int,
+) -> Iterator[List[str]]:
+    """Yield lists of up to `batch_size` texts from `hf_dataset`."""
+    for batch in hf_dataset.iter(batch_size=batch_size):
+        yield batch['text']
+
+
+class BatchedConcatTokensDataset(IterableDataset):
+    """An IterableDataset that returns token samples for MDSWriter.
+
+    Returns dicts of {'tokens': np.ndarray} just like LLM Foundry's
+    `ConcatTokensDataset`, but tokenizes `batch_size` texts at a time.
+    Token IDs are stored as `dtype`.
+    """
+
+    def __init__(
+            self,
+            hf_dataset: Iterable[Dict],
+            tokenizer: PreTrainedTokenizerBase,
+            max_length: int,
+            bos_text: str = '',
+            eos_text: str = '',
+            no_wrap: bool = False,
+            get_bos_token_id: bool = False,
+            get_eos_token_id: bool = False,
+            batch_size: int = DEFAULT_TOKENIZATION_BATCH_SIZE,
+            num_workers: Optional[int] = None,
+            dtype: np.dtype = np.int32,
+    ) -> None:
+        self.hf_dataset = hf_dataset
+        self.tokenizer = tokenizer
+        self.max_length = max_length
+        self.should_wrap = not no_wrap
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.dtype = np.dtype(dtype)
+        # The packer keeps unfinished samples between iterations, so the
+        # dataset can be iterated in consecutive segments (for example,
+        # when the units of work of the underlying dataset are swapped
+        # out between iterations).
+        self.packer = TokenPacker(
+            self.max_length,
+            self.should_wrap,
+            dtype=self.dtype,
+        )
+        self.bos_tokens, self.eos_tokens = get_special_tokens(
+            tokenizer,
+            bos_text=bos_text,
+            eos_text=eos_text,
+            get_bos_token_id=get_bos_token_id,
+            get_eos_token_id=get_eos_token_id,
+        )
+
+    def _iter_tokenized(self) -> Iterator[Tuple[np.ndarray, np.ndarray]]:
+        # Read ahead while tokenizing. The reader thread is only
+        # started once iteration starts, so after the worker pool has
+        # been forked.
+        metrics = get_metrics()
+        text_batches = prefetch(
+            metrics.timed(
+                iter_text_batches(self.hf_dataset, self.batch_size),
+                'read',
+            ),
+        )
+        # Only time the tokenizer, not waiting for texts to be read.
+        if not self.num_workers:
+            for texts in text_batches:
+                with metrics.stage('tokenize'):
+                    tokenized = tokenize_texts(
+                        self.tokenizer,
+                        texts,
+                        self.bos_tokens,
+                        self.eos_tokens,
+                        dtype=self.dtype,
+                    )
+                yield tokenized
+            return
+
+        with mp.Pool(
+                self.num_workers,
+                initializer=_init_tokenization_worker,
+                initargs=(self.tokenizer,),
+        ) as pool:
+            for tokens, doc_lengths, seconds in imap_bounded(
+                    pool,
+                    _tokenize_in_worker,
+                    (
+                        (texts, self.bos_tokens, self.eos_tokens, self.dtype)
+                        for texts in text_batches
+                    ),
+                    max_pending=2 * self.num_workers,
+            ):
+                # Summed over the workers, like the time of other stages
+                # is summed over threads.
+                metrics.add_stage_time('tokenize', seconds)
+                yield tokens, doc_lengths
+
+    def __iter__(self) -> Iterator[Dict[str, np.ndarray]]:
+        metrics = get_metrics()
+        for tokens, doc_lengths in self._iter_tokenized():
+            metrics.add(documents=len(doc_lengths))
+            for sample in self.packer.pack(tokens, doc_lengths):
+                yield {'tokens': sample}
@@ -0,0 +1,284 @@
+"""
+Helpers to overlap the stages of converting samples to MDS format.
+
+The stages are connected by bounded queues:
+1. a reader thread prefetches batches of input data (`prefetch`),
+2. worker processes tokenize the batches (see `batched_tokenization`),
+3. a writer thread serializes samples into shards (`write_samples`),
+4. a thread pool hashes, compresses, and writes finished shards
+   (`ParallelMDSWriter`).
+Reading (pyarrow), tokenization, and compression release the GIL, so
+the threads actually run in parallel.
+"""
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import queue
+import threading
+import warnings
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+from streaming import MDSWriter
+
+from data_prep_metrics import get_metrics
+
+# Marks the end of the sample stream in a queue.
+_DONE = object()
+
+
+class _Error:
+    """Wraps an exception raised in a background thread."""
+
+    def __init__(self, error: BaseException) -> None:
+        self.error = error
+
+
+def prefetch(iterable: Iterable[Any], max_prefetch: int = 8) -> Iterator[Any]:
+    """Iterate over `iterable` in a background thread, keeping up to
+    `max_prefetch` items ready.
+
+    Exceptions raised while iterating are re-raised in the consuming
+    thread. The background thread is only started once iteration
+    starts.
+    """
+    item_queue = queue.Queue(maxsize=max_prefetch)
+    stop = threading.Event()
+
+    def put(item: Any) -> bool:
+        # Give up if the consumer went away.
+        while not stop.is_set():
+            try:
+                item_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read_loop():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Error(e))
+            return
+        put(_DONE)
+
+    reader_thread = threading.Thread(target=read_loop, daemon=True)
+    reader_thread.start()
+    try:
+        while True:
+            item = item_queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, _Error):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        reader_thread.join()
+
+
+class DocumentCounter:
+    """Iterate over the documents of `hf_dataset`, recording how many
+    were read.
+
+    For datasets that consume documents one at a time without recording
+    metrics themselves, such as LLM Foundry's `ConcatTokensDataset`.
+    Other attributes are those of `hf_dataset`, so units of work can
+    still be swapped out (see `resumable_conversion.py`).
+    """
+
+    def __init__(self, hf_dataset: Iterable[Dict[str, Any]]) -> None:
+        object.__setattr__(self, 'hf_dataset', hf_dataset)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        metrics = get_metrics()
+        for document in self.hf_dataset:
+            metrics.add(documents=1)
+            yield document
+
+    def __getattr__(self, name: str) -> Any:
+        # Only called for attributes not found otherwise; avoids
+        # recursing before `hf_dataset` is set (e.g., when copying).
+        if name == 'hf_dataset':
+            raise AttributeError(name)
+        return getattr(self.hf_dataset, name)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        setattr(self.hf_dataset, name, value)
+
+
+class ParallelMDSWriter(MDSWriter):
+    """`MDSWriter` that hashes, compresses, and writes finished shards
+    in a background thread pool while the next shard is being filled.
+
+    Shards are recorded in the index in the order they were filled, so
+    the result is the same as with `MDSWriter`.
+
+    This relies on internals of `MDSWriter`. If the installed
+    `streaming` version does not have them, shards are written like
+    `MDSWriter` does, one after another.
+
+    Args:
+        *args (Any): Arguments for `MDSWriter`.
+        num_shard_workers (int): Number of shards to process in
+            parallel.
+        **kwargs (Any): Keyword arguments for `MDSWriter`.
+    """
+
+    # Internals of `MDSWriter` used to write shards in parallel.
+    _INTERNALS = (
+        '_name_next_shard',
+        '_process_file',
+        'cloud_writer',
+        'encode_joint_shard',
+        'get_config',
+        'new_samples',
+        'shards',
+    )
+
+    def __init__(
+            self,
+            *args: Any,
+            num_shard_workers: int = 4,
+            **kwargs: Any,
+    ) -> None:
+        super().__init__(*args, **kwargs)
+        self._shard_executor = None
+        missing = [
+            name for name in self._INTERNALS if not hasattr(self, name)
+        ]
+        if missing:
+            warnings.warn(
+                f'installed `streaming` version lacks MDSWriter internals '
+                f'{missing}; writing shards sequentially',
+            )
+            return
+        self._shard_executor = ThreadPoolExecutor(
+            max_workers=num_shard_workers,
+        )
+        # Bounds the memory taken up by encoded shards waiting to be
+        # processed.
+        self._max_pending_shards = 2 * num_shard_workers
+        self._pending_shards = collections.deque()
+
+    def _write_shard_file(
+            self,
+            raw_data: bytes,
+            raw_basename: str,
+            zip_basename: Optional[str],
+    ) -> Tuple[Dict[str, Any], Optional[Dict[str, Any]]]:
+        metrics = get_metrics()
+        with metrics.stage('compress'):
+            raw_info, zip_info = self._process_file(
+                raw_data,
+                raw_basename,
+                zip_basename,
+            )
+        metrics.add(output_bytes=(zip_info or raw_info)['bytes'])
+        self.cloud_writer.upload_file(zip_basename or raw_basename)
+        return raw_info, zip_info
+
+    def _complete_oldest_shard(self) -> None:
+        shard, future = self._pending_shards.popleft()
+        shard['raw_data'], shard['zip_data'] = future.result()
+
+    def flush_shard(self) -> None:
+        if self._shard_executor is None:
+            return super().flush_shard()
+        raw_basename, zip_basename = self._name_next_shard()
+        raw_data = self.encode_joint_shard()
+        shard = {
+            'samples': len(self.new_samples),
+            'raw_data': None,
+            'zip_data': None,
+        }
+        shard.update(self.get_config())
+        # Filled in once the shard has been processed.
+        self.shards.append(shard)
+        future = self._shard_executor.submit(
+            self._write_shard_file,
+            raw_data,
+            raw_basename,
+            zip_basename,
+        )
+        self._pending_shards.append((shard, future))
+        while len(self._pending_shards) > self._max_pending_shards:
+            self._complete_oldest_shard()
+
+    def _write_index(self) -> None:
+        if self._shard_executor is not None:
+            while self._pending_shards:
+                self._complete_oldest_shard()
+            self._shard_executor.shutdown(wait=True)
+        super()._write_index()
+
+
+def write_samples(
+        samples: Iterable[Dict[str, Any]],
+        out: MDSWriter,
+        max_queue_size: int = 64,
+        chunk_size: int = 256,
+) -> None:
+    """Write `samples` to `out` from a separate writer thread.
+
+    The calling thread keeps producing samples (reading and tokenizing)
+    while the writer thread serializes them. Samples are written in the
+    order they are produced.
+
+    Args:
+        samples (Iterable[Dict[str, Any]]): The samples to write.
+        out (MDSWriter): The writer to write the samples with.
+        max_queue_size (int): Maximum number of sample chunks that are
+            produced but not yet written.
+        chunk_size (int): Number of samples to hand to the writer thread
+            at once.
+    """
+    sample_queue = queue.Queue(maxsize=max_queue_size)
+    errors = []
+    metrics = get_metrics()
+
+    def write_loop():
+        while True:
+            chunk = sample_queue.get()
+            if chunk is _DONE:
+                break
+            # After an error, keep draining so the producer does not
+            # block forever.
+            if errors:
+                continue
+            try:
+                with metrics.stage('write'):
+                    for sample in chunk:
+                        out.write(sample)
+            except BaseException as e:
+                errors.append(e)
+                continue
+            if 'tokens' in chunk[0]:
+                metrics.add(
+                    tokens=sum(len(sample['tokens']) for sample in chunk),
+                )
+            else:
+                # Without tokenization, each sample is one document.
+                metrics.add(documents=len(chunk))
+
+    writer_thread = threading.Thread(target=write_loop, daemon=True)
+    writer_thread.start()
+    try:
+        chunk = []
+        for sample in samples:
+            chunk.append(sample)
+            if len(chunk) >= chunk_size:
+                sample_queue.put(chunk)
+                chunk = []
+                if errors:
+                    break
+        if chunk:
+            sample_queue.put(chunk)
+    finally:
+        sample_queue.put(_DONE)
+        writer_thread.join()
+
+    if errors:
+        raise errors[0]
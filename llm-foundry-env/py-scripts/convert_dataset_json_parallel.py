@@ -15,13 +15,31 @@ from typing import Optional
 
 import datasets as hf_datasets
 from datasets.distributed import split_dataset_by_node
-from streaming import MDSWriter
 from torch.utils.data import IterableDataset
 from tqdm import tqdm
 from transformers import AutoTokenizer, PreTrainedTokenizerBase
 
 from llmfoundry.data import ConcatTokensDataset, NoConcatDataset
 
+from batched_tokenization import (
+    BatchedConcatTokensDataset,
+    DEFAULT_TOKENIZATION_BATCH_SIZE,
+)
+from conversion_pipeline import (
+    DocumentCounter,
+    ParallelMDSWriter,
+    write_samples,
+)
+from data_prep_metrics import start_metrics
+from get_vocab_size import get_token_dtype, TOKEN_DTYPES
+from jsonl_byte_ranges import (
+    is_splittable,
+    JsonlByteRangeDataset,
+    list_byte_ranges,
+)
+from resumable_conversion import convert_resumable
+from work_planning import get_file_sizes, plan_work
+
 
 class ConcatMode(Enum):
     NO_CONCAT = 'NO_CONCAT'
@@ -39,6 +57,11 @@ def build_hf_dataset(
     get_bos_token_id: bool = False,
     get_eos_token_id: bool = False,
     tokenizer: PreTrainedTokenizerBase = None,
+    tokenization_batch_size: Optional[int] = None,
+    num_workers: Optional[int] = None,
+    work_plan_dir: Optional[str] = None,
+    split_bytes: Optional[int] = None,
+    token_dtype: str = 'int32',
 ) -> IterableDataset:
     """Build an IterableDataset over the HF C4 or pile source data.
 
@@ -55,6 +78,15 @@ def build_hf_dataset(
         get_eos_token_id (bool): whether to get the token ID to insert at the end of each sequence
             from the tokenizer
         tokenizer (PreTrainedTokenizerBase): if mode is CONCAT_TOKENS, the tokenizer to use
+        tokenization_batch_size (Optional[int]): if mode is CONCAT_TOKENS and this is given,
+            tokenize this many texts per tokenizer call instead of one at a time
+        num_workers (Optional[int]): if mode is CONCAT_TOKENS and this is given, the number of
+            processes to tokenize batches of texts in
+        work_plan_dir (Optional[str]): directory to store the assignment of data to processes
+            in, or to load it from if it already exists
+        split_bytes (Optional[int]): if given, split JSONL files larger than this many bytes
+            into newline-aligned byte ranges and distribute those over processes
+        token_dtype (str): if mode is CONCAT_TOKENS, the NumPy data type to store token IDs as
         data_subset (str): Referred to as "name" in HuggingFace datasets.load_dataset.
             Typically "all" (The Pile) or "en" (c4).
 
@@ -69,17 +101,61 @@ def build_hf_dataset(
     world_size = int(os.environ['WORLD_SIZE'])
     rank = int(os.environ['RANK'])
 
-    hf_dataset = hf_datasets.load_dataset(
-        'json',
-        data_files=data_files,
-        split=split,
-        streaming=True,
-    )
-    hf_dataset = split_dataset_by_node(
-        hf_dataset,
-        rank=rank,
-        world_size=world_size,
+    rank_plan_file = (
+        os.path.join(work_plan_dir, 'rank_plan.json')
+        if work_plan_dir is not None
+        else None
     )
+    if split_bytes is not None:
+        if isinstance(data_files, str):
+            data_files = [data_files]
+        if not all(map(is_splittable, data_files)):
+            raise ValueError(
+                'splitting into byte ranges is only supported for '
+                'uncompressed JSON lines files.',
+            )
+        byte_ranges = list_byte_ranges(sorted(data_files), split_bytes)
+        # Balance the processes by the size of their byte ranges; each
+        # process only reads its own byte ranges.
+        assignment = plan_work(
+            [str(byte_range) for byte_range in byte_ranges],
+            [byte_range.end - byte_range.start for byte_range in byte_ranges],
+            world_size,
+            plan_file=rank_plan_file,
+            save=rank == 0,
+        )
+        hf_dataset = JsonlByteRangeDataset(
+            [byte_ranges[i] for i in assignment[rank]],
+        )
+    elif isinstance(data_files, list) and len(data_files) >= world_size:
+        # Balance the processes by the size of their files; each process
+        # only loads its own files.
+        data_files = sorted(data_files)
+        assignment = plan_work(
+            data_files,
+            get_file_sizes(data_files),
+            world_size,
+            plan_file=rank_plan_file,
+            save=rank == 0,
+        )
+        hf_dataset = hf_datasets.load_dataset(
+            'json',
+            data_files=[data_files[i] for i in assignment[rank]],
+            split=split,
+            streaming=True,
+        )
+    else:
+        hf_dataset = hf_datasets.load_dataset(
+            'json',
+            data_files=data_files,
+            split=split,
+            streaming=True,
+        )
+        hf_dataset = split_dataset_by_node(
+            hf_dataset,
+            rank=rank,
+            world_size=world_size,
+        )
 
     if mode == ConcatMode.NO_CONCAT:
         dataset = NoConcatDataset(hf_dataset)
@@ -101,16 +177,34 @@ def build_hf_dataset(
                 tok_error_msg += 'such as facebook/opt-125m, or specify EOS/BOS text with e.g. '
                 tok_error_msg += '--bos_text=<|endoftext|>.'
                 raise ValueError(tok_error_msg)
-        dataset = ConcatTokensDataset(
-            hf_dataset=hf_dataset,
-            tokenizer=tokenizer,
-            max_length=max_length,
-            bos_text=bos_text,
-            eos_text=eos_text,
-            no_wrap=no_wrap,
-            get_bos_token_id=get_bos_token_id,
-            get_eos_token_id=get_eos_token_id,
-        )
+        if tokenization_batch_size or num_workers:
+            dataset = BatchedConcatTokensDataset(
+                hf_dataset=hf_dataset,
+                tokenizer=tokenizer,
+                max_length=max_length,
+                bos_text=bos_text,
+                eos_text=eos_text,
+                no_wrap=no_wrap,
+                get_bos_token_id=get_bos_token_id,
+                get_eos_token_id=get_eos_token_id,
+                batch_size=(
+                    tokenization_batch_size
+                    or DEFAULT_TOKENIZATION_BATCH_SIZE
+                ),
+                num_workers=num_workers,
+                dtype=token_dtype,
+            )
+        else:
+            dataset = ConcatTokensDataset(
+                hf_dataset=DocumentCounter(hf_dataset),
+                tokenizer=tokenizer,
+                max_length=max_length,
+                bos_text=bos_text,
+                eos_text=eos_text,
+                no_wrap=no_wrap,
+                get_bos_token_id=get_bos_token_id,
+                get_eos_token_id=get_eos_token_id,
+            )
     return dataset
 
 
@@ -127,6 +221,13 @@ def convert_dataset_json(
     get_bos_token_id: bool = False,
     get_eos_token_id: bool = False,
     num_workers: Optional[int] = None,
+    tokenization_batch_size: Optional[int] = None,
+    work_plan_dir: Optional[str] = None,
+    split_bytes: Optional[int] = None,
+    checkpoint_interval: Optional[int] = None,
+    metrics_dir: Optional[str] = None,
+    metrics_interval: float = 30.0,
+    token_dtype: str = 'auto',
 ) -> None:
     """Create C4/pile streaming dataset.
 
@@ -144,14 +245,29 @@ def convert_dataset_json(
             sequence from the tokenizer
         get_eos_token_id (bool): Whether to get the token ID to insert at the end of each sequence
             from the tokenizer
-        num_workers (Optional[int]): Number of workers for data loading
+        num_workers (Optional[int]): Number of processes to tokenize in
+        tokenization_batch_size (Optional[int]): Number of texts to tokenize per tokenizer
+            call when concatenating tokens; tokenize one text at a time if not given
+        work_plan_dir (Optional[str]): Directory to store the assignment of data to processes
+            in, or to load it from if it already exists
+        split_bytes (Optional[int]): Split JSONL files larger than this many bytes into
+            newline-aligned byte ranges that are distributed over processes
+        checkpoint_interval (Optional[int]): If given, record progress after converting this
+            many byte ranges, so that an interrupted conversion can be resumed
+        metrics_dir (Optional[str]): If given, write throughput and resource metrics of each
+            process to this directory
+        metrics_interval (float): Number of seconds between metrics samples
+        token_dtype (str): NumPy data type to store token IDs as; "auto" picks the narrowest
+            one that fits the tokenizer's vocabulary
     """
     if concat_tokens is not None:
         mode = ConcatMode.CONCAT_TOKENS
         built_tokenizer = AutoTokenizer.from_pretrained(tokenizer)
         # we will enforce length, so suppress warnings about sequences too long for the model
         built_tokenizer.model_max_length = int(1e30)
-        columns = {'tokens': 'ndarray:int32'}
+        token_dtype = get_token_dtype(built_tokenizer, token_dtype)
+        print(f'Storing tokens as {token_dtype}')
+        columns = {'tokens': f'ndarray:{token_dtype}'}
     else:
         mode = ConcatMode.NO_CONCAT
         built_tokenizer = None
@@ -167,35 +283,67 @@ def convert_dataset_json(
 
     rank = int(os.environ['RANK'])
 
-    # Get samples
-    dataset = build_hf_dataset(
-        path=path,
-        split=split,
-        mode=mode,
-        max_length=concat_tokens,
-        bos_text=bos_text,
-        eos_text=eos_text,
-        no_wrap=no_wrap,
-        get_bos_token_id=get_bos_token_id,
-        get_eos_token_id=get_eos_token_id,
-        tokenizer=built_tokenizer,
-    )
+    if concat_tokens is not None and (
+            checkpoint_interval is not None or token_dtype != 'int32'
+    ):
+        # Resuming requires access to the tokens that were not yet
+        # packed into a sample, and LLM Foundry's `ConcatTokensDataset`
+        # only produces int32 tokens. Batched tokenization offers both.
+        tokenization_batch_size = (
+            tokenization_batch_size or DEFAULT_TOKENIZATION_BATCH_SIZE
+        )
 
-    print('here')
+    # Use a separate set of metrics per SLURM array task.
+    metrics_name = 'convert_dataset_json'
+    if os.getenv('SLURM_ARRAY_TASK_ID'):
+        metrics_name += f"_{os.getenv('SLURM_ARRAY_TASK_ID')}"
+    with start_metrics(
+            metrics_dir,
+            metrics_name,
+            rank=rank,
+            interval=metrics_interval,
+    ):
+        # Get samples
+        dataset = build_hf_dataset(
+            path=path,
+            split=split,
+            mode=mode,
+            max_length=concat_tokens,
+            bos_text=bos_text,
+            eos_text=eos_text,
+            no_wrap=no_wrap,
+            get_bos_token_id=get_bos_token_id,
+            get_eos_token_id=get_eos_token_id,
+            tokenizer=built_tokenizer,
+            tokenization_batch_size=tokenization_batch_size,
+            num_workers=num_workers,
+            work_plan_dir=work_plan_dir,
+            token_dtype=token_dtype,
+            split_bytes=split_bytes,
+        )
 
-    # Write samples
-    print(f'Converting to MDS format...')
-    print(
-        f'Note that the progress bar is based on the dataset length before tokenization.',
-    )
-    print(f'It will finish at a value below 100% if tokenizing')
-    with MDSWriter(
-        columns=columns,
-        out=os.path.join(out_root, str(rank)),
-        compression=compression,
-    ) as out:
-        for sample in tqdm(dataset):
-            out.write(sample)
+        # Write samples
+        print(f'Converting to MDS format...')
+        print(
+            f'Note that the progress bar is based on the dataset length before tokenization.',
+        )
+        print(f'It will finish at a value below 100% if tokenizing')
+        if checkpoint_interval is not None:
+            convert_resumable(
+                dataset,
+                out=os.path.join(out_root, str(rank)),
+                columns=columns,
+                compression=compression,
+                checkpoint_interval=checkpoint_interval,
+            )
+            return
+
+        with ParallelMDSWriter(
+            columns=columns,
+            out=os.path.join(out_root, str(rank)),
+            compression=compression,
+        ) as out:
+            write_samples(tqdm(dataset), out)
 
 
 def convert_dataset_json_from_args(
@@ -211,6 +359,13 @@ def convert_dataset_json_from_args(
     get_bos_token_id: bool = False,
     get_eos_token_id: bool = False,
     num_workers: Optional[int] = None,
+    tokenization_batch_size: Optional[int] = None,
+    work_plan_dir: Optional[str] = None,
+    split_bytes: Optional[int] = None,
+    checkpoint_interval: Optional[int] = None,
+    metrics_dir: Optional[str] = None,
+    metrics_interval: float = 30.0,
+    token_dtype: str = 'auto',
 ) -> None:
     """A wrapper for `convert_dataset_json` that parses arguments.
 
@@ -228,7 +383,20 @@ def convert_dataset_json_from_args(
             sequence from the tokenizer
         get_eos_token_id (bool): Whether to get the token ID to insert at the end of each sequence
             from the tokenizer
-        num_workers (Optional[int]): Number of workers for data loading
+        num_workers (Optional[int]): Number of processes to tokenize in
+        tokenization_batch_size (Optional[int]): Number of texts to tokenize per tokenizer
+            call when concatenating tokens; tokenize one text at a time if not given
+        work_plan_dir (Optional[str]): Directory to store the assignment of data to processes
+            in, or to load it from if it already exists
+        split_bytes (Optional[int]): Split JSONL files larger than this many bytes into
+            newline-aligned byte ranges that are distributed over processes
+        checkpoint_interval (Optional[int]): If given, record progress after converting this
+            many byte ranges, so that an interrupted conversion can be resumed
+        metrics_dir (Optional[str]): If given, write throughput and resource metrics of each
+            process to this directory
+        metrics_interval (float): Number of seconds between metrics samples
+        token_dtype (str): NumPy data type to store token IDs as; "auto" picks the narrowest
+            one that fits the tokenizer's vocabulary
 
     Raises:
         ValueError: If the out_root directory exists and contains files that overlap with the requested splits
@@ -269,6 +437,13 @@ def convert_dataset_json_from_args(
         get_bos_token_id=get_bos_token_id,
         get_eos_token_id=get_eos_token_id,
         num_workers=num_workers,
+        tokenization_batch_size=tokenization_batch_size,
+        work_plan_dir=work_plan_dir,
+        split_bytes=split_bytes,
+        checkpoint_interval=checkpoint_interval,
+        metrics_dir=metrics_dir,
+        metrics_interval=metrics_interval,
+        token_dtype=token_dtype,
     )
 
 
@@ -296,8 +471,89 @@ def parse_args() -> Namespace:
     parser.add_argument('--no_wrap', default=False, action='store_true')
     parser.add_argument('--get_bos_token_id', action='store_true')
     parser.add_argument('--get_eos_token_id', action='store_true')
+    parser.add_argument(
+        '--work_plan_dir',
+        type=str,
+        default=None,
+        help=(
+            'Directory to store the size-balanced assignment of data to '
+            'processes in. If a plan already exists there, it is reused.'
+        ),
+    )
+    parser.add_argument(
+        '--split_bytes',
+        type=int,
+        default=None,
+        help=(
+            'Split JSONL files larger than this many bytes into '
+            'newline-aligned byte ranges that are distributed over '
+            'processes as independent units of work.'
+        ),
+    )
+    parser.add_argument(
+        '--checkpoint_interval',
+        type=int,
+        default=None,
+        help=(
+            'Record progress in the output directory after converting this '
+            'many byte ranges. A re-run with the same arguments then skips '
+            'the already converted byte ranges. Requires `--split_bytes`.'
+        ),
+    )
+    parser.add_argument(
+        '--metrics_dir',
+        type=str,
+        default=None,
+        help=(
+            'Directory to write throughput and resource metrics of each '
+            'process to, sampled every `--metrics_interval` seconds. Reduce '
+            'them over all processes with `data_prep_metrics.py`.'
+        ),
+    )
+    parser.add_argument(
+        '--metrics_interval',
+        type=float,
+        default=30.0,
+        help='Number of seconds between metrics samples.',
+    )
+    parser.add_argument(
+        '--token_dtype',
+        choices=['auto'] + TOKEN_DTYPES,
+        default='auto',
+        help=(
+            'NumPy data type to store token IDs as when concatenating '
+            'tokens. "auto" (the default) picks the narrowest type that '
+            'fits the tokenizer\'s vocabulary, i.e., uint16 for up to '
+            '65536 tokens.'
+        ),
+    )
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=None,
+        help=(
+            'Number of processes to tokenize in when concatenating tokens. '
+            'Implies tokenizing texts in batches.'
+        ),
+    )
+    parser.add_argument(
+        '--tokenization_batch_size',
+        type=int,
+        default=None,
+        help=(
+            'Number of texts to tokenize per tokenizer call when '
+            'concatenating tokens. By default, texts are tokenized one at '
+            'a time.'
+        ),
+    )
 
     parsed = parser.parse_args()
+    # Check before the tokenizer and dataset are built on every process.
+    if parsed.checkpoint_interval is not None:
+        if parsed.split_bytes is None:
+            parser.error('--checkpoint_interval requires --split_bytes')
+        if parsed.checkpoint_interval < 1:
+            parser.error('--checkpoint_interval must be at least 1')
     return parsed
 
 
@@ -315,4 +571,12 @@ if __name__ == '__main__':
         no_wrap=args.no_wrap,
         get_bos_token_id=args.get_bos_token_id,
         get_eos_token_id=args.get_eos_token_id,
+        tokenization_batch_size=args.tokenization_batch_size,
+        num_workers=args.num_workers,
+        work_plan_dir=args.work_plan_dir,
+        split_bytes=args.split_bytes,
+        checkpoint_interval=args.checkpoint_interval,
+        metrics_dir=args.metrics_dir,
+        metrics_interval=args.metrics_interval,
+        token_dtype=args.token_dtype,
     )
@@ -15,13 +15,31 @@ from typing import Optional
 
 import datasets as hf_datasets
 from datasets.distributed import split_dataset_by_node
-from streaming import MDSWriter
 from torch.utils.data import IterableDataset
 from tqdm import tqdm
 from transformers import AutoTokenizer, PreTrainedTokenizerBase
 
 from llmfoundry.data import ConcatTokensDataset, NoConcatDataset
 
+from batched_tokenization import (
+    BatchedConcatTokensDataset,
+    DEFAULT_TOKENIZATION_BATCH_SIZE,
+)
+from conversion_pipeline import (
+    DocumentCounter,
+    ParallelMDSWriter,
+    write_samples,
+)
+from data_prep_metrics import start_metrics
+from get_vocab_size import get_token_dtype, TOKEN_DTYPES
+from parquet_row_groups import (
+    is_data_file,
+    list_row_groups,
+    ParquetRowGroupDataset,
+)
+from resumable_conversion import convert_resumable
+from work_planning import get_file_sizes, plan_work
+
 
 class ConcatMode(Enum):
     NO_CONCAT = 'NO_CONCAT'
@@ -50,6 +68,11 @@ def build_hf_dataset(
     get_eos_token_id: bool = False,
     recurse: bool = False,
     tokenizer: PreTrainedTokenizerBase = None,
+    tokenization_batch_size: Optional[int] = None,
+    num_workers: Optional[int] = None,
+    sharding: str = 'row_group',
+    work_plan_dir: Optional[str] = None,
+    token_dtype: str = 'int32',
 ) -> IterableDataset:
     """Build an IterableDataset over the HF C4 or pile source data.
 
@@ -68,12 +91,26 @@ def build_hf_dataset(
         recurse (bool): Whether to recurse into subdirectories of the given path to look for data
             files.
         tokenizer (PreTrainedTokenizerBase): if mode is CONCAT_TOKENS, the tokenizer to use
+        tokenization_batch_size (Optional[int]): if mode is CONCAT_TOKENS and this is given,
+            tokenize this many texts per tokenizer call instead of one at a time
+        num_workers (Optional[int]): if mode is CONCAT_TOKENS and this is given, the number of
+            processes to tokenize batches of texts in
+        sharding (str): how to distribute the data over processes; "row_group" assigns
+            whole Parquet row groups to each process, "example" lets each process read
+            all data and keep every `WORLD_SIZE`th example
+        work_plan_dir (Optional[str]): directory to store the assignment of data to processes
+            in, or to load it from if it already exists
+        token_dtype (str): if mode is CONCAT_TOKENS, the NumPy data type to store token IDs as
         data_subset (str): Referred to as "name" in HuggingFace datasets.load_dataset.
             Typically "all" (The Pile) or "en" (c4).
 
     Returns:
         An IterableDataset.
     """
+    world_size = int(os.environ['WORLD_SIZE'])
+    rank = int(os.environ['RANK'])
+    array_id = None
+
     if os.path.isdir(path):
         if recurse:
             data_files = filter(
@@ -90,28 +127,73 @@ def build_hf_dataset(
             array_id = int(os.getenv('SLURM_ARRAY_TASK_ID'))
             num_splits = int(os.getenv('SLURM_ARRAY_TASK_COUNT'))
             print(f'This is process {array_id}/{num_splits}')
-            data_files = sorted(data_files)[array_id::num_splits]
+            # Balance the array tasks by the size of their files.
+            data_files = sorted(filter(is_data_file, data_files))
+            assignment = plan_work(
+                data_files,
+                get_file_sizes(data_files),
+                num_splits,
+                plan_file=(
+                    os.path.join(work_plan_dir, 'array_plan.json')
+                    if work_plan_dir is not None
+                    else None
+                ),
+                save=array_id == 0 and rank == 0,
+            )
+            data_files = [data_files[i] for i in assignment[array_id]]
     else:
         data_files = path
 
-    world_size = int(os.environ['WORLD_SIZE'])
-    rank = int(os.environ['RANK'])
-
-    hf_dataset = hf_datasets.load_dataset(
-        'parquet',
-        data_files=data_files,
-        split=split,
-        streaming=True,
-        # This has nothing to do with a SGD batch size, but is the
-        # number of samples in which shards of the underlying Parquet
-        # data are loaded.
-        batch_size=16384,
-    )
-    hf_dataset = split_dataset_by_node(
-        hf_dataset,
-        rank=rank,
-        world_size=world_size,
-    )
+    if sharding == 'row_group':
+        if isinstance(data_files, str):
+            data_files = [data_files]
+        # Every process reads all footers to get the same global list
+        # of row groups, then only reads its own row groups.
+        row_groups = list_row_groups(list(data_files))
+        # Balance the processes by the uncompressed size of their row
+        # groups.
+        assignment = plan_work(
+            [f'{row_group.path}:{row_group.index}' for row_group in row_groups],
+            [row_group.num_bytes for row_group in row_groups],
+            world_size,
+            plan_file=(
+                os.path.join(
+                    work_plan_dir,
+                    (
+                        f'rank_plan_{array_id}.json'
+                        if array_id is not None
+                        else 'rank_plan.json'
+                    ),
+                )
+                if work_plan_dir is not None
+                else None
+            ),
+            save=rank == 0,
+        )
+        rank_row_groups = [row_groups[i] for i in assignment[rank]]
+        print(
+            f'Processing {len(rank_row_groups)} of {len(row_groups)} '
+            f'row groups',
+        )
+        hf_dataset = ParquetRowGroupDataset(rank_row_groups)
+    elif sharding == 'example':
+        hf_dataset = hf_datasets.load_dataset(
+            'parquet',
+            data_files=data_files,
+            split=split,
+            streaming=True,
+            # This has nothing to do with a SGD batch size, but is the
+            # number of samples in which shards of the underlying Parquet
+            # data are loaded.
+            batch_size=16384,
+        )
+        hf_dataset = split_dataset_by_node(
+            hf_dataset,
+            rank=rank,
+            world_size=world_size,
+        )
+    else:
+        raise ValueError(f'unknown sharding method {sharding}')
 
     if mode == ConcatMode.NO_CONCAT:
         dataset = NoConcatDataset(hf_dataset)
@@ -133,16 +215,34 @@ def build_hf_dataset(
                 tok_error_msg += 'such as facebook/opt-125m, or specify EOS/BOS text with e.g. '
                 tok_error_msg += '--bos_text=<|endoftext|>.'
                 raise ValueError(tok_error_msg)
-        dataset = ConcatTokensDataset(
-            hf_dataset=hf_dataset,
-            tokenizer=tokenizer,
-            max_length=max_length,
-            bos_text=bos_text,
-            eos_text=eos_text,
-            no_wrap=no_wrap,
-            get_bos_token_id=get_bos_token_id,
-            get_eos_token_id=get_eos_token_id,
-        )
+        if tokenization_batch_size or num_workers:
+            dataset = BatchedConcatTokensDataset(
+                hf_dataset=hf_dataset,
+                tokenizer=tokenizer,
+                max_length=max_length,
+                bos_text=bos_text,
+                eos_text=eos_text,
+                no_wrap=no_wrap,
+                get_bos_token_id=get_bos_token_id,
+                get_eos_token_id=get_eos_token_id,
+                batch_size=(
+                    tokenization_batch_size
+                    or DEFAULT_TOKENIZATION_BATCH_SIZE
+                ),
+                num_workers=num_workers,
+                dtype=token_dtype,
+            )
+        else:
+            dataset = ConcatTokensDataset(
+                hf_dataset=DocumentCounter(hf_dataset),
+                tokenizer=tokenizer,
+                max_length=max_length,
+                bos_text=bos_text,
+                eos_text=eos_text,
+                no_wrap=no_wrap,
+                get_bos_token_id=get_bos_token_id,
+                get_eos_token_id=get_eos_token_id,
+            )
     return dataset
 
 
@@ -161,6 +261,13 @@ def convert_dataset_parquet(
     use_fast: bool = True,
     recurse: bool = False,
     num_workers: Optional[int] = None,
+    tokenization_batch_size: Optional[int] = None,
+    sharding: str = 'row_group',
+    work_plan_dir: Optional[str] = None,
+    checkpoint_interval: Optional[int] = None,
+    metrics_dir: Optional[str] = None,
+    metrics_interval: float = 30.0,
+    token_dtype: str = 'auto',
 ) -> None:
     """Create C4/pile streaming dataset.
 
@@ -181,14 +288,28 @@ def convert_dataset_parquet(
         use_fast (bool): Whether to use a fast version of the tokenizer.
         recurse (bool): Whether to recurse into subdirectories of the given path to look for data
             files.
-        num_workers (Optional[int]): Number of workers for data loading
+        num_workers (Optional[int]): Number of processes to tokenize in
+        tokenization_batch_size (Optional[int]): Number of texts to tokenize per tokenizer
+            call when concatenating tokens; tokenize one text at a time if not given
+        sharding (str): How to distribute the data over processes; "row_group" or "example"
+        work_plan_dir (Optional[str]): Directory to store the assignment of data to processes
+            in, or to load it from if it already exists
+        checkpoint_interval (Optional[int]): If given, record progress after converting this
+            many row groups, so that an interrupted conversion can be resumed
+        metrics_dir (Optional[str]): If given, write throughput and resource metrics of each
+            process to this directory
+        metrics_interval (float): Number of seconds between metrics samples
+        token_dtype (str): NumPy data type to store token IDs as; "auto" picks the narrowest
+            one that fits the tokenizer's vocabulary
     """
     if concat_tokens is not None:
         mode = ConcatMode.CONCAT_TOKENS
         built_tokenizer = AutoTokenizer.from_pretrained(tokenizer, use_fast=use_fast)
         # we will enforce length, so suppress warnings about sequences too long for the model
         built_tokenizer.model_max_length = int(1e30)
-        columns = {'tokens': 'ndarray:int32'}
+        token_dtype = get_token_dtype(built_tokenizer, token_dtype)
+        print(f'Storing tokens as {token_dtype}')
+        columns = {'tokens': f'ndarray:{token_dtype}'}
     else:
         mode = ConcatMode.NO_CONCAT
         built_tokenizer = None
@@ -204,38 +325,70 @@ def convert_dataset_parquet(
 
     rank = int(os.environ['RANK'])
 
-    # Get samples
-    dataset = build_hf_dataset(
-        path=path,
-        split=split,
-        mode=mode,
-        max_length=concat_tokens,
-        bos_text=bos_text,
-        eos_text=eos_text,
-        no_wrap=no_wrap,
-        get_bos_token_id=get_bos_token_id,
-        get_eos_token_id=get_eos_token_id,
-        recurse=recurse,
-        tokenizer=built_tokenizer,
-    )
+    if concat_tokens is not None and (
+            checkpoint_interval is not None or token_dtype != 'int32'
+    ):
+        # Resuming requires access to the tokens that were not yet
+        # packed into a sample, and LLM Foundry's `ConcatTokensDataset`
+        # only produces int32 tokens. Batched tokenization offers both.
+        tokenization_batch_size = (
+            tokenization_batch_size or DEFAULT_TOKENIZATION_BATCH_SIZE
+        )
+
+    # Use a separate set of metrics per SLURM array task.
+    metrics_name = 'convert_dataset_parquet'
+    if os.getenv('SLURM_ARRAY_TASK_ID'):
+        metrics_name += f"_{os.getenv('SLURM_ARRAY_TASK_ID')}"
+    with start_metrics(
+            metrics_dir,
+            metrics_name,
+            rank=rank,
+            interval=metrics_interval,
+    ):
+        # Get samples
+        dataset = build_hf_dataset(
+            path=path,
+            split=split,
+            mode=mode,
+            max_length=concat_tokens,
+            bos_text=bos_text,
+            eos_text=eos_text,
+            no_wrap=no_wrap,
+            get_bos_token_id=get_bos_token_id,
+            get_eos_token_id=get_eos_token_id,
+            recurse=recurse,
+            tokenizer=built_tokenizer,
+            tokenization_batch_size=tokenization_batch_size,
+            num_workers=num_workers,
+            sharding=sharding,
+            work_plan_dir=work_plan_dir,
+            token_dtype=token_dtype,
+        )
 
-    print('here')
+        # Write samples
+        print(f'Converting to MDS format...')
+        print(
+            f'Note that the progress bar is based on the dataset length before tokenization.',
+        )
+        print(f'It will finish at a value below 100% if tokenizing')
+        if checkpoint_interval is not None:
+            convert_resumable(
+                dataset,
+                out=os.path.join(out_root, str(rank)),
+                columns=columns,
+                compression=compression,
+                checkpoint_interval=checkpoint_interval,
+            )
+            return
 
-    # Write samples
-    print(f'Converting to MDS format...')
-    print(
-        f'Note that the progress bar is based on the dataset length before tokenization.',
-    )
-    print(f'It will finish at a value below 100% if tokenizing')
-    with MDSWriter(
-        columns=columns,
-        out=os.path.join(out_root, str(rank)),
-        compression=compression,
-    ) as out:
-        # Can help to remove `tqdm`.
-        # for sample in tqdm(dataset):
-        for sample in dataset:
-            out.write(sample)
+        with ParallelMDSWriter(
+            columns=columns,
+            out=os.path.join(out_root, str(rank)),
+            compression=compression,
+        ) as out:
+            # Can help to remove `tqdm`.
+            # write_samples(tqdm(dataset), out)
+            write_samples(dataset, out)
 
 
 def convert_dataset_parquet_from_args(
@@ -253,6 +406,13 @@ def convert_dataset_parquet_from_args(
     use_fast: bool = True,
     recurse: bool = False,
     num_workers: Optional[int] = None,
+    tokenization_batch_size: Optional[int] = None,
+    sharding: str = 'row_group',
+    work_plan_dir: Optional[str] = None,
+    checkpoint_interval: Optional[int] = None,
+    metrics_dir: Optional[str] = None,
+    metrics_interval: float = 30.0,
+    token_dtype: str = 'auto',
 ) -> None:
     """A wrapper for `convert_dataset_parquet` that parses arguments.
 
@@ -273,7 +433,19 @@ def convert_dataset_parquet_from_args(
         use_fast (bool): Whether to use a fast version of the tokenizer.
         recurse (bool): Whether to recurse into subdirectories of the given path to look for data
             files.
-        num_workers (Optional[int]): Number of workers for data loading
+        num_workers (Optional[int]): Number of processes to tokenize in
+        tokenization_batch_size (Optional[int]): Number of texts to tokenize per tokenizer
+            call when concatenating tokens; tokenize one text at a time if not given
+        sharding (str): How to distribute the data over processes; "row_group" or "example"
+        work_plan_dir (Optional[str]): Directory to store the assignment of data to processes
+            in, or to load it from if it already exists
+        checkpoint_interval (Optional[int]): If given, record progress after converting this
+            many row groups, so that an interrupted conversion can be resumed
+        metrics_dir (Optional[str]): If given, write throughput and resource metrics of each
+            process to this directory
+        metrics_interval (float): Number of seconds between metrics samples
+        token_dtype (str): NumPy data type to store token IDs as; "auto" picks the narrowest
+            one that fits the tokenizer's vocabulary
 
     Raises:
         ValueError: If the out_root directory exists and contains files that overlap with the requested splits
@@ -316,6 +488,13 @@ def convert_dataset_parquet_from_args(
         use_fast=use_fast,
         recurse=recurse,
         num_workers=num_workers,
+        tokenization_batch_size=tokenization_batch_size,
+        sharding=sharding,
+        work_plan_dir=work_plan_dir,
+        checkpoint_interval=checkpoint_interval,
+        metrics_dir=metrics_dir,
+        metrics_interval=metrics_interval,
+        token_dtype=token_dtype,
     )
 
 
@@ -351,9 +530,92 @@ def parse_args() -> Namespace:
     parser.add_argument('--no_wrap', default=False, action='store_true')
     parser.add_argument('--get_bos_token_id', action='store_true')
     parser.add_argument('--get_eos_token_id', action='store_true')
+    parser.add_argument(
+        '--sharding',
+        choices=['row_group', 'example'],
+        default='row_group',
+        help=(
+            'How to distribute the data over processes. "row_group" '
+            'assigns whole Parquet row groups to each process so data is '
+            'only read once in total; "example" makes each process read '
+            'all data and keep every `WORLD_SIZE`th example.'
+        ),
+    )
+    parser.add_argument(
+        '--work_plan_dir',
+        type=str,
+        default=None,
+        help=(
+            'Directory to store the size-balanced assignment of data to '
+            'processes in. If a plan already exists there, it is reused.'
+        ),
+    )
+    parser.add_argument(
+        '--num_workers',
+        type=int,
+        default=None,
+        help=(
+            'Number of processes to tokenize in when concatenating tokens. '
+            'Implies tokenizing texts in batches.'
+        ),
+    )
+    parser.add_argument(
+        '--tokenization_batch_size',
+        type=int,
+        default=None,
+        help=(
+            'Number of texts to tokenize per tokenizer call when '
+            'concatenating tokens. By default, texts are tokenized one at '
+            'a time.'
+        ),
+    )
+    parser.add_argument(
+        '--checkpoint_interval',
+        type=int,
+        default=None,
+        help=(
+            'Record progress in the output directory after converting this '
+            'many row groups. A re-run with the same arguments then skips '
+            'the already converted row groups. Requires `--sharding '
+            'row_group`.'
+        ),
+    )
+    parser.add_argument(
+        '--metrics_dir',
+        type=str,
+        default=None,
+        help=(
+            'Directory to write throughput and resource metrics of each '
+            'process to, sampled every `--metrics_interval` seconds. Reduce '
+            'them over all processes with `data_prep_metrics.py`.'
+        ),
+    )
+    parser.add_argument(
+        '--metrics_interval',
+        type=float,
+        default=30.0,
+        help='Number of seconds between metrics samples.',
+    )
+    parser.add_argument(
+        '--token_dtype',
+        choices=['auto'] + TOKEN_DTYPES,
+        default='auto',
+        help=(
+            'NumPy data type to store token IDs as when concatenating '
+            'tokens. "auto" (the default) picks the narrowest type that '
+            'fits the tokenizer\'s vocabulary, i.e., uint16 for up to '
+            '65536 tokens.'
+        ),
+    )
     parser.add_argument('--no_use_fast', action='store_true')
 
     parsed = parser.parse_args()
+    # Check before the tokenizer and dataset are built on every process.
+    if parsed.checkpoint_interval is not None:
+        if parsed.sharding != 'row_group':
+            parser.error('--checkpoint_interval requires --sharding row_group')
+        if parsed.checkpoint_interval < 1:
+            parser.error('--checkpoint_interval must be at least 1')
     return parsed
 
 
@@ -372,6 +634,14 @@ if __name__ == '__main__':
         no_wrap=args.no_wrap,
         get_bos_token_id=args.get_bos_token_id,
         get_eos_token_id=args.get_eos_token_id,
+        tokenization_batch_size=args.tokenization_batch_size,
+        num_workers=args.num_workers,
+        sharding=args.sharding,
+        work_plan_dir=args.work_plan_dir,
+        checkpoint_interval=args.checkpoint_interval,
+        metrics_dir=args.metrics_dir,
+        metrics_interval=args.metrics_interval,
+        token_dtype=args.token_dtype,
         use_fast=not args.no_use_fast,
         recurse=args.recurse,
     )
@@ -1,13 +1,38 @@
 from argparse import ArgumentParser
 
+import numpy as np
 from transformers import AutoTokenizer
 
+TOKEN_DTYPES = ['uint16', 'int32']
+
 
 def get_vocab_size(tok_dir):
     tok = AutoTokenizer.from_pretrained(tok_dir)
     return tok.vocab_size
 
 
+def get_token_dtype(tok, token_dtype='auto'):
+    """Return the name of the narrowest NumPy data type that can store
+    all token IDs of `tok`, or `token_dtype` if it is not "auto".
+    """
+    # `vocab_size` does not include added tokens.
+    num_tokens = max(tok.vocab_size, len(tok))
+    if token_dtype == 'auto':
+        for dtype in TOKEN_DTYPES:
+            if num_tokens - 1 <= np.iinfo(dtype).max:
+                return dtype
+        raise ValueError(f'no token data type fits {num_tokens} tokens')
+
+    if token_dtype not in TOKEN_DTYPES:
+        raise ValueError(f'unknown token data type {token_dtype}')
+    if num_tokens - 1 > np.iinfo(token_dtype).max:
+        raise ValueError(
+            f'token data type {token_dtype} cannot store all {num_tokens} '
+            f'token IDs of the tokenizer',
+        )
+    return token_dtype
+
+
 def main():
     parser = ArgumentParser()
     parser.add_argument(
@@ -0,0 +1,249 @@
+"""
+Read and write MDS shards without decoding samples.
+
+An (uncompressed) MDS shard consists of the number of samples, a table
+of sample offsets, the shard's JSON config, and the encoded samples.
+Using the offset table, samples can be copied from one dataset to
+another dataset with the same columns as raw bytes, skipping decoding
+and re-encoding. Shards whose samples are all copied can even be copied
+as whole files, skipping re-compression if the compression stays the
+same.
+"""
+
+import copy
+import json
+import os
+import shutil
+from typing import Any, Dict, Iterator, List, Sequence
+
+import numpy as np
+from streaming.base.compression import decompress
+from streaming.base.format.mds.encodings import mds_decode
+
+from conversion_pipeline import ParallelMDSWriter
+from data_prep_metrics import get_metrics
+
+
+def read_index(dirname: str) -> List[Dict[str, Any]]:
+    """Return the shard infos from the index of the MDS dataset in
+    `dirname`.
+    """
+    with open(os.path.join(dirname, 'index.json'), 'r') as f:
+        return json.load(f)['shards']
+
+
+class MDSShardReader:
+    """Read the (encoded or decoded) samples of an MDS dataset shard by
+    shard.
+
+    The most recently used shard is kept decompressed in memory, so
+    reading the samples of a shard in order is cheap.
+    """
+
+    def __init__(self, dirname: str) -> None:
+        self.dirname = dirname
+        self.shards = read_index(dirname)
+        # Global index of the first sample of each shard, plus the total
+        # number of samples.
+        self.shard_starts = np.cumsum(
+            [0] + [shard['samples'] for shard in self.shards],
+        )
+        self._shard_index = None
+        self._data = None
+        self._offsets = None
+
+    def __len__(self) -> int:
+        return int(self.shard_starts[-1])
+
+    def locate(self, indices: np.ndarray) -> np.ndarray:
+        """Return the index of the shard of each global sample index."""
+        return np.searchsorted(self.shard_starts, indices, side='right') - 1
+
+    def shard_path(self, shard_index: int) -> str:
+        """Return the path of the file that stores `shard_index`, i.e.,
+        the compressed file if the shard is compressed.
+        """
+        shard = self.shards[shard_index]
+        info = shard['zip_data'] or shard['raw_data']
+        return os.path.join(self.dirname, info['basename'])
+
+    def _load(self, shard_index: int) -> None:
+        if self._shard_index == shard_index:
+            return
+
+        shard = self.shards[shard_index]
+        raw_path = os.path.join(self.dirname, shard['raw_data']['basename'])
+        if shard['zip_data'] is None or os.path.isfile(raw_path):
+            with open(raw_path, 'rb') as f:
+                data = f.read()
+        else:
+            with open(self.shard_path(shard_index), 'rb') as f:
+                data = decompress(shard['compression'], f.read())
+
+        self._offsets = np.frombuffer(
+            data,
+            np.uint32,
+            count=shard['samples'] + 1,
+            offset=4,
+        )
+        self._data = memoryview(data)
+        self._shard_index = shard_index
+
+    def iter_shard_samples(
+            self,
+            shard_index: int,
+            local_indices: Sequence[int],
+    ) -> Iterator[memoryview]:
+        """Yield the encoded samples at `local_indices` of shard
+        `shard_index`.
+        """
+        self._load(shard_index)
+        for local_index in local_indices:
+            yield self._data[
+                self._offsets[local_index]:self._offsets[local_index + 1]
+            ]
+
+    def iter_shard_items(
+            self,
+            shard_index: int,
+            local_indices: Sequence[int],
+    ) -> Iterator[Dict[str, Any]]:
+        """Yield the decoded samples at `local_indices` of shard
+        `shard_index`.
+        """
+        shard = self.shards[shard_index]
+        columns = list(zip(
+            shard['column_names'],
+            shard['column_encodings'],
+            shard['column_sizes'],
+        ))
+        num_variable_sizes = sum(size is None for (_, _, size) in columns)
+        for data in self.iter_shard_samples(shard_index, local_indices):
+            # Variable-sized columns store their sizes up front.
+            variable_sizes = iter(
+                np.frombuffer(data, np.uint32, count=num_variable_sizes)
+                .tolist(),
+            )
+            position = 4 * num_variable_sizes
+            sample = {}
+            for (name, encoding, size) in columns:
+                if size is None:
+                    size = next(variable_sizes)
+                sample[name] = mds_decode(
+                    encoding,
+                    bytes(data[position:position + size]),
+                )
+                position += size
+            yield sample
+
+    def get_item(self, index: int) -> Dict[str, Any]:
+        """Return the decoded sample at global `index`."""
+        shard_index = int(self.locate(index))
+        local_index = index - int(self.shard_starts[shard_index])
+        return next(self.iter_shard_items(shard_index, [local_index]))
+
+    def get_sample_data(self, index: int) -> memoryview:
+        """Return the encoded sample at global `index`."""
+        shard_index = int(self.locate(index))
+        local_index = index - int(self.shard_starts[shard_index])
+        return next(self.iter_shard_samples(shard_index, [local_index]))
+
+
+class RawMDSWriter(ParallelMDSWriter):
+    """`MDSWriter` that additionally accepts encoded samples (as bytes)
+    and whole shards of an MDS dataset with the same columns.
+    """
+
+    def encode_sample(self, sample: Any) -> bytes:
+        if isinstance(sample, (bytes, memoryview)):
+            return bytes(sample)
+        return super().encode_sample(sample)
+
+    def can_copy_shard(self, shard: Dict[str, Any]) -> bool:
+        """Return whether `shard` can be copied as-is, i.e., has the same
+        columns and compression as this writer.
+        """
+        return (
+            shard.get('compression') == self.compression
+            and shard['column_names'] == self.column_names
+            and shard['column_encodings'] == self.column_encodings
+        )
+
+    def copy_shard(self, shard_path: str, shard: Dict[str, Any]) -> None:
+        """Append the whole shard stored in `shard_path` (described by
+        `shard`) by copying its file.
+        """
+        if not self.can_copy_shard(shard):
+            raise ValueError(
+                'can only copy shards with the same columns and compression',
+            )
+        # Keep the order of samples.
+        if self.new_samples:
+            self.flush_shard()
+            self._reset_cache()
+
+        raw_basename, zip_basename = self._name_next_shard()
+        new_shard = copy.deepcopy(shard)
+        new_shard['raw_data']['basename'] = raw_basename
+        if new_shard['zip_data'] is not None:
+            new_shard['zip_data']['basename'] = zip_basename
+        basename = zip_basename or raw_basename
+        shutil.copyfile(shard_path, os.path.join(self.local, basename))
+        self.shards.append(new_shard)
+        get_metrics().add(
+            output_bytes=(new_shard['zip_data'] or new_shard['raw_data'])[
+                'bytes'],
+        )
+        self.cloud_writer.upload_file(basename)
+
+
+def copy_samples(
+        reader: MDSShardReader,
+        writers: Sequence[RawMDSWriter],
+        indices_per_writer: Sequence[np.ndarray],
+) -> None:
+    """Copy the samples at the sorted global indices
+    `indices_per_writer[i]` from `reader` to `writers[i]` without
+    decoding them, reading each input shard only once.
+
+    Shards whose samples are all copied to the same writer are copied as
+    whole files if possible.
+    """
+    metrics = get_metrics()
+    indices_per_writer = [
+        np.asarray(indices) for indices in indices_per_writer
+    ]
+    shard_indices_per_writer = [
+        reader.locate(indices) for indices in indices_per_writer
+    ]
+    for shard_index in np.unique(np.concatenate(shard_indices_per_writer)):
+        shard = reader.shards[shard_index]
+        for (writer, indices, shard_indices) in zip(
+                writers,
+                indices_per_writer,
+                shard_indices_per_writer,
+        ):
+            (lo, hi) = np.searchsorted(
+                shard_indices,
+                [shard_index, shard_index + 1],
+            )
+            if lo == hi:
+                continue
+            local_indices = indices[lo:hi] - reader.shard_starts[shard_index]
+
+            if (
+                    len(local_indices) == shard['samples']
+                    and writer.can_copy_shard(shard)
+            ):
+                writer.copy_shard(reader.shard_path(shard_index), shard)
+                metrics.add(
+                    documents=len(local_indices),
+                    input_bytes=shard['raw_data']['bytes'],
+                )
+                continue
+
+            num_bytes = 0
+            for data in reader.iter_shard_samples(shard_index, local_indices):
+                writer.write(data)
+                num_bytes += len(data)
+            metrics.add(documents=len(local_indices), input_bytes=num_bytes)
@@ -1,11 +1,34 @@
 """
 Merge a directory of sub-datasets into one file.
+
+With `--distributed`, all `WORLD_SIZE` processes merge the indices of a
+contiguous chunk of sub-datasets each, and the partial indices are
+combined in a tree (see `tree_reduction.py`). Shard files stay in their
+sub-dataset directories and are referenced from the merged index by
+relative paths, so no files are moved.
 """
 
 from argparse import ArgumentParser, Namespace
+import json
+import os
+import re
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 from llmfoundry.utils.data_prep_utils import merge_shard_groups
 
+from data_prep_metrics import get_metrics, start_metrics
+from tree_reduction import (
+    DEFAULT_TIMEOUT,
+    get_chunk,
+    get_rank_and_world_size,
+    get_run_id,
+    remove_work_dir,
+    tree_reduce,
+)
+
+# Sub-dataset directories, as matched by `merge_shard_groups`.
+SUB_DATASET_PATTERN = re.compile(r'\d+')
+
 
 def parse_args() -> Namespace:
     """Parse commandline arguments."""
@@ -15,19 +38,225 @@ def parse_args() -> Namespace:
         ),
     )
     parser.add_argument('--out_root', type=str, required=True)
+    parser.add_argument(
+        '--distributed',
+        action='store_true',
+        help=(
+            'Merge with all `WORLD_SIZE` processes, where `RANK` is the index '
+            'of this process. Shard files are not moved.'
+        ),
+    )
+    parser.add_argument(
+        '--fan_in',
+        type=int,
+        default=16,
+        help='Number of partial indices combined at once when distributed.',
+    )
+    parser.add_argument(
+        '--work_dir',
+        type=str,
+        default=None,
+        help=(
+            'Directory for partial indices when distributed. Must not '
+            'contain results of another run. Only the partial indices are '
+            'removed from it afterwards. By default, a new directory in '
+            '`out_root` is used for each run.'
+        ),
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help=(
+            'Number of seconds to wait for the partial indices of other '
+            'processes when distributed before giving up.'
+        ),
+    )
+    parser.add_argument(
+        '--metrics_dir',
+        type=str,
+        default=None,
+        help='Directory to write throughput and resource metrics to.',
+    )
     parsed = parser.parse_args()
     return parsed
 
 
+def check_shard_columns(
+        shards: Iterable[Tuple[str, Dict[str, Any]]],
+) -> None:
+    """Raise an error if the given `(sub-dataset, shard)` pairs have
+    differing columns (for example, different token data types), which
+    would result in an unusable merged dataset.
+    """
+    columns = {}
+    for (subdir, shard) in shards:
+        columns.setdefault(
+            tuple(zip(shard['column_names'], shard['column_encodings'])),
+            subdir,
+        )
+    if len(columns) > 1:
+        raise ValueError(
+            f'cannot merge sub-datasets with differing columns: '
+            f'{[(dict(key), subdir) for (key, subdir) in columns.items()]}',
+        )
+
+
+def check_columns(out_root: str) -> None:
+    """Raise an error if the sub-datasets in `out_root` have differing
+    columns.
+    """
+    def iter_shards():
+        for subdir in sorted(os.listdir(out_root)):
+            index_path = os.path.join(out_root, subdir, 'index.json')
+            if not os.path.isfile(index_path):
+                continue
+            with open(index_path, 'r') as f:
+                for shard in json.load(f)['shards']:
+                    yield (subdir, shard)
+
+    check_shard_columns(iter_shards())
+
+
+def list_sub_datasets(out_root: str) -> List[str]:
+    """Return the sub-dataset directories of `out_root` in merge
+    order.
+    """
+    return [
+        name for name in sorted(os.listdir(out_root))
+        if re.match(SUB_DATASET_PATTERN, name)
+        and os.path.isdir(os.path.join(out_root, name))
+    ]
+
+
+def write_partial_index(
+        out_root: str,
+        subdirs: List[str],
+        prefix: str,
+) -> None:
+    """Write the shards of the sub-datasets `subdirs` of `out_root`, with
+    basenames relative to `out_root`, to `prefix`.json.
+    """
+    metrics = get_metrics()
+    shards = []
+    for subdir in subdirs:
+        with open(os.path.join(out_root, subdir, 'index.json'), 'r') as f:
+            sub_shards = json.load(f)['shards']
+        for shard in sub_shards:
+            for key in ['raw_data', 'zip_data']:
+                if shard.get(key) is not None:
+                    shard[key]['basename'] = os.path.join(
+                        subdir,
+                        shard[key]['basename'],
+                    )
+        shards.extend(sub_shards)
+        metrics.add(
+            documents=sum(shard['samples'] for shard in sub_shards),
+            input_bytes=sum(
+                shard['raw_data']['bytes'] for shard in sub_shards
+            ),
+        )
+
+    with open(prefix + '.json', 'w') as f:
+        json.dump({'shards': shards}, f)
+
+
+def combine_partial_indices(child_prefixes: List[str], prefix: str) -> None:
+    """Concatenate the partial indices at `child_prefixes` into
+    `prefix`.json.
+    """
+    shards = []
+    for child_prefix in child_prefixes:
+        with open(child_prefix + '.json', 'r') as f:
+            shards.extend(json.load(f)['shards'])
+    with open(prefix + '.json', 'w') as f:
+        json.dump({'shards': shards}, f)
+
+
+def merge_distributed(
+        out_root: str,
+        fan_in: int = 16,
+        work_dir: Optional[str] = None,
+        timeout: Optional[float] = DEFAULT_TIMEOUT,
+) -> None:
+    """Merge the sub-datasets in `out_root` with all `WORLD_SIZE`
+    processes, waiting up to `timeout` seconds for other processes.
+
+    Partial indices are written to `work_dir`, which must not contain
+    results of another run, and are removed after a successful merge.
+    By default, a new directory in `out_root` is used for each run and
+    removed as well; a given `work_dir` is kept.
+    """
+    (rank, world_size) = get_rank_and_world_size()
+    # Only remove a directory this run created.
+    keep_work_dir = work_dir is not None
+    if work_dir is None:
+        # Never pick up partial indices or markers of an earlier run.
+        work_dir = os.path.join(out_root, f'.merge-{get_run_id(world_size)}')
+    subdirs = get_chunk(list_sub_datasets(out_root), rank, world_size)
+
+    final_prefix = tree_reduce(
+        work_dir,
+        rank,
+        world_size,
+        lambda prefix: write_partial_index(out_root, subdirs, prefix),
+        combine_partial_indices,
+        fan_in=fan_in,
+        timeout=timeout,
+    )
+    if final_prefix is None:
+        return
+
+    with open(final_prefix + '.json', 'r') as f:
+        shards = json.load(f)['shards']
+    check_shard_columns(
+        (shard['raw_data']['basename'].split(os.sep)[0], shard)
+        for shard in shards
+    )
+    with open(os.path.join(out_root, 'index.json'), 'w') as f:
+        json.dump({'version': 2, 'shards': shards}, f, sort_keys=True)
+    remove_work_dir(work_dir, keep_work_dir)
+
+
 def main(args: Namespace) -> None:
     """Main: merge MDS sub-datasets into one.
 
     Args:
         args (Namespace): Commandline arguments.
     """
-    # Write samples
-    print('Merging MDS sub-datasets...')
-    merge_shard_groups(args.out_root)
+    if args.distributed:
+        (rank, _) = get_rank_and_world_size()
+        with start_metrics(
+                args.metrics_dir,
+                'merge_dataset',
+                rank=rank,
+        ) as metrics:
+            print('Merging MDS sub-datasets with all processes...')
+            with metrics.stage('merge'):
+                merge_distributed(
+                    args.out_root,
+                    fan_in=args.fan_in,
+                    work_dir=args.work_dir,
+                    timeout=args.timeout,
+                )
+        return
+
+    with start_metrics(args.metrics_dir, 'merge_dataset') as metrics:
+        # Write samples
+        print('Merging MDS sub-datasets...')
+        check_columns(args.out_root)
+        with metrics.stage('merge'):
+            merge_shard_groups(args.out_root)
+
+        if metrics.enabled:
+            with open(os.path.join(args.out_root, 'index.json'), 'r') as f:
+                shards = json.load(f)['shards']
+            metrics.add(
+                documents=sum(shard['samples'] for shard in shards),
+                input_bytes=sum(
+                    shard['raw_data']['bytes'] for shard in shards
+                ),
+            )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+"""
+Split Parquet data into row groups as independent units of work.
+
+Reading only the row groups assigned to a process means the total
+amount of data read over all processes is the size of the dataset,
+instead of every process reading (and discarding most of) everything.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from typing import Dict, Iterator, List, NamedTuple, Sequence
+
+import pyarrow.parquet as pq
+
+from data_prep_metrics import get_metrics
+
+
+class RowGroup(NamedTuple):
+    path: str
+    index: int
+    num_rows: int
+    num_bytes: int
+
+
+def is_data_file(path: str) -> bool:
+    """Return whether `path` is a data file and not, for example, a
+    marker or checksum file as written by Spark/Hadoop.
+    """
+    basename = os.path.basename(path)
+    return not basename.startswith(('_', '.'))
+
+
+def _read_row_groups(path: str) -> List[RowGroup]:
+    metadata = pq.read_metadata(path)
+    return [
+        RowGroup(
+            path=path,
+            index=i,
+            num_rows=metadata.row_group(i).num_rows,
+            num_bytes=metadata.row_group(i).total_byte_size,
+        )
+        for i in range(metadata.num_row_groups)
+    ]
+
+
+def list_row_groups(
+        data_files: Sequence[str],
+        num_threads: int = 16,
+) -> List[RowGroup]:
+    """Read the footers of `data_files` and list all their row groups.
+
+    Args:
+        data_files (Sequence[str]): Parquet files to list row groups of.
+        num_threads (int): Number of threads to read footers with.
+
+    Returns:
+        All row groups in a deterministic order, i.e., sorted by file
+        path, then by row group index.
+    """
+    data_files = sorted(filter(is_data_file, data_files))
+    with ThreadPoolExecutor(num_threads) as executor:
+        row_groups_per_file = executor.map(_read_row_groups, data_files)
+    return [
+        row_group
+        for row_groups in row_groups_per_file
+        for row_group in row_groups
+    ]
+
+
+class ParquetRowGroupDataset:
+    """Iterate over the texts in the given Parquet row groups.
+
+    Supports the parts of the HuggingFace `IterableDataset` interface we
+    use, i.e., iterating over examples and `iter(batch_size)`.
+    """
+
+    def __init__(
+            self,
+            row_groups: Sequence[RowGroup],
+            columns: Sequence[str] = ('text',),
+    ) -> None:
+        # Units of work, i.e., the row groups to read.
+        self.units = list(row_groups)
+        self.columns = list(columns)
+
+    def iter(self, batch_size: int) -> Iterator[Dict[str, List]]:
+        """Yield dictionaries of up to `batch_size` values per column.
+
+        Batches do not cross row group boundaries.
+        """
+        metrics = get_metrics()
+        parquet_file = None
+        parquet_path = None
+        for row_group in self.units:
+            # Keep the file open for consecutive row groups of it.
+            if parquet_path != row_group.path:
+                if parquet_file is not None:
+                    parquet_file.close()
+                parquet_file = pq.ParquetFile(row_group.path)
+                parquet_path = row_group.path
+
+            for batch in parquet_file.iter_batches(
+                    batch_size=batch_size,
+                    row_groups=[row_group.index],
+                    columns=self.columns,
+            ):
+                metrics.add(input_bytes=batch.nbytes)
+                yield batch.to_pydict()
+
+        if parquet_file is not None:
+            parquet_file.close()
+
+    def __iter__(self) -> Iterator[Dict]:
+        for batch in self.iter(batch_size=16384):
+            columns = batch.keys()
+            for values in zip(*batch.values()):
+                yield dict(zip(columns, values))
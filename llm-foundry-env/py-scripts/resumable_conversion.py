@@ -0,0 +1,182 @@
+"""
+Crash-resumable conversion to MDS format.
+
+A rank converts its units of work (Parquet row groups or JSONL byte
+ranges) in segments of `checkpoint_interval` units. Each segment is
+written as a complete MDS dataset into its own numbered part directory
+in the rank's output directory. After a part is finished, a progress
+manifest records the completed units, the finished parts, and the
+tokens that were not yet packed into a sample. On restart, finished
+units are skipped, unrecorded (partially written) parts are removed,
+and conversion continues with a new part.
+
+At the end, the parts' indices are combined into a single `index.json`
+for the rank, so the rank directory can be merged with
+`merge_dataset.py` as usual.
+"""
+
+import json
+import os
+import shutil
+from typing import Any, Dict, List, Optional, Sequence
+
+import numpy as np
+from torch.utils.data import IterableDataset
+
+from conversion_pipeline import ParallelMDSWriter, write_samples
+
+PROGRESS_MANIFEST_NAME = 'progress.json'
+
+
+class ProgressManifest:
+    """Record of the finished work of a single rank, stored as JSON in
+    the rank's output directory.
+    """
+
+    def __init__(self, out: str) -> None:
+        self.path = os.path.join(out, PROGRESS_MANIFEST_NAME)
+        self.completed_units: List[str] = []
+        self.parts: List[str] = []
+        self.token_buffer: List[int] = []
+        if os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                progress = json.load(f)
+            self.completed_units = progress['completed_units']
+            self.parts = progress['parts']
+            self.token_buffer = progress['token_buffer']
+
+    def save(self) -> None:
+        # Write atomically so that a crash never leaves a partial
+        # manifest behind.
+        tmp_path = f'{self.path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w') as f:
+            json.dump(
+                {
+                    'completed_units': self.completed_units,
+                    'parts': self.parts,
+                    'token_buffer': self.token_buffer,
+                },
+                f,
+            )
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+
+def _remove_unrecorded_parts(out: str, parts: Sequence[str]) -> None:
+    """Remove part directories that were not finished before a crash."""
+    for name in os.listdir(out):
+        path = os.path.join(out, name)
+        if os.path.isdir(path) and name.isdigit() and name not in parts:
+            print(f'Removing unfinished part {path}')
+            shutil.rmtree(path)
+
+
+def merge_part_indices(out: str, parts: Sequence[str]) -> None:
+    """Write an `index.json` to `out` that references the shards of all
+    `parts` in order.
+    """
+    shards = []
+    for part in parts:
+        with open(os.path.join(out, part, 'index.json'), 'r') as f:
+            part_index = json.load(f)
+        for shard in part_index['shards']:
+            for key in ['raw_data', 'zip_data']:
+                if shard.get(key) is not None:
+                    shard[key]['basename'] = os.path.join(
+                        part,
+                        shard[key]['basename'],
+                    )
+            shards.append(shard)
+
+    with open(os.path.join(out, 'index.json'), 'w') as f:
+        json.dump({'version': 2, 'shards': shards}, f, sort_keys=True)
+
+
+def convert_resumable(
+        dataset: IterableDataset,
+        out: str,
+        columns: Dict[str, str],
+        compression: Optional[str],
+        checkpoint_interval: int,
+        **writer_kwargs: Any,
+) -> None:
+    """Convert `dataset` to MDS format in `out`, continuing from the
+    progress recorded by a previous, interrupted run.
+
+    `dataset` has to wrap (as `dataset.hf_dataset`) a dataset over
+    units of work, such as a `ParquetRowGroupDataset` or
+    `JsonlByteRangeDataset`. If `dataset` packs tokens (i.e., has a
+    `packer`), the packer must keep its state between iterations. The
+    units of the underlying dataset are swapped out for each segment.
+
+    The resulting samples are identical to those of an uninterrupted
+    conversion; only their distribution over shards differs.
+
+    Args:
+        dataset (IterableDataset): Dataset to convert.
+        out (str): Output directory of this rank.
+        columns (Dict[str, str]): Columns of the MDS dataset.
+        compression (Optional[str]): Compression type, if any.
+        checkpoint_interval (int): Number of units of work to convert
+            between recording progress.
+        **writer_kwargs (Any): Further arguments for the `MDSWriter`s.
+    """
+    source = dataset.hf_dataset
+    if not hasattr(source, 'units'):
+        raise ValueError(
+            'resumable conversion requires a dataset split into units of '
+            'work (such as Parquet row groups or JSONL byte ranges)',
+        )
+    if checkpoint_interval < 1:
+        raise ValueError('checkpoint interval must be at least 1')
+
+    units = list(source.units)
+    unit_names = [str(unit) for unit in units]
+    packer = getattr(dataset, 'packer', None)
+
+    os.makedirs(out, exist_ok=True)
+    manifest = ProgressManifest(out)
+    num_completed = len(manifest.completed_units)
+    if manifest.completed_units != unit_names[:num_completed]:
+        raise ValueError(
+            f'progress manifest at {manifest.path} was created for '
+            f'different inputs or a different number of processes; please '
+            f'remove {out} to start over.',
+        )
+    if num_completed > 0:
+        print(
+            f'Resuming after {num_completed} of {len(units)} units of work '
+            f'({len(manifest.parts)} parts)',
+        )
+    _remove_unrecorded_parts(out, manifest.parts)
+    if packer is not None:
+        packer.buffer = np.array(
+            manifest.token_buffer,
+            dtype=packer.buffer.dtype,
+        )
+
+    for start in range(num_completed, len(units), checkpoint_interval):
+        segment = units[start:start + checkpoint_interval]
+        source.units = segment
+        part = f'{len(manifest.parts):05}'
+        with ParallelMDSWriter(
+            columns=columns,
+            out=os.path.join(out, part),
+            compression=compression,
+            **writer_kwargs,
+        ) as writer:
+            write_samples(dataset, writer)
+
+        manifest.parts.append(part)
+        manifest.completed_units.extend(str(unit) for unit in segment)
+        if packer is not None:
+            manifest.token_buffer = packer.buffer.tolist()
+        manifest.save()
+        print(
+            f'Finished {len(manifest.completed_units)} of {len(units)} '
+            f'units of work',
+        )
+
+    source.units = units
+    merge_part_indices(out, manifest.parts)
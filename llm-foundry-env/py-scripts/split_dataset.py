@@ -2,45 +2,337 @@
 # (https://github.com/TrustLLMeu/trustllm-envs/pull/2).
 
 from argparse import ArgumentParser
+import contextlib
 import functools
 import multiprocessing as mp
 import os
 
 from llmfoundry.utils.data_prep_utils import merge_shard_groups
 import numpy as np
-from streaming import MDSWriter, StreamingDataset
+from streaming import MDSWriter
 import tqdm
 
+from data_prep_metrics import start_metrics
+from mds_shards import copy_samples, MDSShardReader, RawMDSWriter, read_index
+from work_planning import assign_balanced
 
-def write_data(writer_kwargs, ds, indices_shard, rank):
-    assert 'out' in writer_kwargs
-    writer_kwargs['out'] = os.path.join(writer_kwargs['out'], str(rank))
-    with MDSWriter(**writer_kwargs) as writer:
-        for index in tqdm.tqdm(indices_shard):
-            writer.write(ds.get_item(index))
 
+def get_columns(in_path):
+    """Return the columns and their encodings of the MDS dataset at
+    `in_path`, as given in its index.
+    """
+    columns = {
+        tuple(zip(shard['column_names'], shard['column_encodings']))
+        for shard in read_index(in_path)
+    }
+    if len(columns) != 1:
+        raise ValueError(
+            f'shards of {in_path} have differing columns: {columns}',
+        )
+    return dict(columns.pop())
+
+
+def parse_output(spec):
+    """Parse an output specification of the form `PATH[:PROB[:MAX]]`
+    into a dictionary with keys "path", "prob", and "max".
+
+    An output without a probability receives all remaining samples.
+    """
+    parts = spec.split(':')
+    path = parts[0]
+    prob = float(parts[1]) if len(parts) > 1 else None
+    max_samples = int(parts[2]) if len(parts) > 2 else None
+    if len(parts) > 3 or not path:
+        raise ValueError(f'invalid output specification {spec}')
+    return {'path': path, 'prob': prob, 'max': max_samples}
+
+
+def get_thresholds(outputs, num_samples):
+    """Return the probability of a sample ending up in each output that
+    has a probability, i.e., the minimum (in expected number of samples)
+    of its probability and maximum number of samples.
+    """
+    thresholds = []
+    for output in outputs:
+        if output['prob'] is None:
+            continue
+        threshold = output['prob']
+        if output['max'] is not None:
+            threshold = min(output['max'] / num_samples, threshold)
+        thresholds.append(threshold)
+    if sum(thresholds) > 1:
+        raise ValueError('output probabilities must not sum to more than 1')
+    return thresholds
+
+
+def draw_selected_indices(rng, threshold, num_samples, max_batch_size=1 << 24):
+    """Return the sorted indices of samples that were selected with
+    probability `threshold`.
+
+    The distances between selected indices are geometrically
+    distributed. They are drawn in batches and accumulated, which
+    results in the same indices as drawing them one at a time.
+    """
+    # Draw enough distances to most likely cover all samples in a
+    # single batch.
+    expected = threshold * num_samples
+    batch_size = int(min(
+        expected + 4 * np.sqrt(expected) + 16,
+        max_batch_size,
+    ))
+
+    batches = []
+    # Index of the last selected sample.
+    last_index = -1
+    while last_index < num_samples:
+        # These are the numbers of samples until the next selected
+        # index. Always >= 1.
+        distances = rng.geometric(threshold, size=batch_size)
+        # Use numbers of samples as "distances" to compute indices.
+        indices = last_index + np.cumsum(distances)
+        batches.append(indices)
+        last_index = indices[-1]
+
+    selected_indices = np.concatenate(batches)
+    # Remove indices that were too large.
+    return selected_indices[:np.searchsorted(selected_indices, num_samples)]
+
+
+def validate_selection(selected_indices, num_samples):
+    """Check in linear time that `selected_indices` are strictly
+    increasing indices into `num_samples` samples.
+    """
+    if len(selected_indices) == 0:
+        return
+    if selected_indices[0] < 0 or selected_indices[-1] >= num_samples:
+        raise ValueError('selected indices are out of range')
+    if not np.all(selected_indices[1:] > selected_indices[:-1]):
+        raise ValueError('selected indices are not strictly increasing')
+
+
+def select_samples(rng, thresholds, num_samples):
+    """Route samples to outputs.
+
+    Each sample ends up in output `i` with probability `thresholds[i]`,
+    or in none of them. With a single output, the selection is the same
+    as for the original two-way split.
+
+    Returns:
+        For each output, the sorted indices of its samples.
+    """
+    total_threshold = sum(thresholds)
+    if total_threshold <= 0:
+        return [np.empty(0, dtype=np.int64) for _ in thresholds]
+
+    selected_indices = draw_selected_indices(
+        rng,
+        total_threshold,
+        num_samples,
+    )
+    # Outputs receive disjoint subsets of these indices, so this
+    # validates all of them.
+    validate_selection(selected_indices, num_samples)
+    if len(thresholds) == 1:
+        return [selected_indices]
+
+    choices = rng.choice(
+        len(thresholds),
+        size=len(selected_indices),
+        p=np.array(thresholds) / total_threshold,
+    )
+    return [
+        selected_indices[choices == i]
+        for i in range(len(thresholds))
+    ]
+
+
+def iter_labels(selected_indices, num_outputs, blocks):
+    """Yield which output each sample of each `(start, end)` block goes
+    to.
+
+    `selected_indices` is as for `write_data`. Labels are created
+    lazily, so only a single block's labels are in memory at a time.
+    """
+    remainder_output = next(
+        i for (i, indices) in enumerate(selected_indices) if indices is None
+    )
+    dtype = np.min_scalar_type(num_outputs)
+    for (block_start, block_end) in blocks:
+        labels = np.full(
+            block_end - block_start,
+            remainder_output,
+            dtype=dtype,
+        )
+        for (i, indices) in enumerate(selected_indices):
+            if indices is None:
+                continue
+            (lo, hi) = np.searchsorted(indices, [block_start, block_end])
+            labels[indices[lo:hi] - block_start] = i
+        yield labels
 
-def parallelize_writing(writer_kwargs, ds, indices, num_workers):
+
+def write_data(
+        outputs,
+        columns,
+        compression,
+        in_path,
+        shard_indices,
+        selected_indices,
+        rank,
+        raw_copy=False,
+        metrics_dir=None,
+        metrics_interval=30.0,
+):
+    """Write the samples of the input shards `shard_indices` of the
+    dataset at `in_path` to their outputs, using one writer per output.
+
+    `selected_indices` contains, for each output, the sorted indices of
+    its samples in these shards, or `None` for the output that receives
+    all remaining samples.
+    """
+    # Each worker reads its shards on its own.
+    ds = MDSShardReader(in_path)
+    blocks = [
+        (
+            int(ds.shard_starts[shard_index]),
+            int(ds.shard_starts[shard_index + 1]),
+        )
+        for shard_index in shard_indices
+    ]
+
+    writer_cls = RawMDSWriter if raw_copy else MDSWriter
+    with start_metrics(
+            metrics_dir,
+            'split_dataset',
+            rank=rank,
+            interval=metrics_interval,
+    ) as metrics:
+        with contextlib.ExitStack() as stack:
+            writers = [
+                stack.enter_context(writer_cls(
+                    columns=columns,
+                    compression=compression,
+                    out=os.path.join(output['path'], str(rank)),
+                ))
+                for output in outputs
+            ]
+            progress_bar = tqdm.tqdm(
+                total=sum(end - start for (start, end) in blocks),
+            )
+            for (shard_index, (block_start, _), labels) in zip(
+                    shard_indices,
+                    blocks,
+                    iter_labels(selected_indices, len(outputs), blocks),
+            ):
+                if raw_copy:
+                    # Copy encoded samples without decoding them.
+                    copy_samples(
+                        ds,
+                        writers,
+                        [
+                            block_start + np.flatnonzero(labels == i)
+                            for i in range(len(outputs))
+                        ],
+                    )
+                    progress_bar.update(len(labels))
+                    continue
+
+                samples = metrics.timed(
+                    ds.iter_shard_items(shard_index, range(len(labels))),
+                    'read',
+                )
+                for (sample, label) in zip(samples, labels):
+                    with metrics.stage('write'):
+                        writers[label].write(sample)
+                    if 'tokens' in sample:
+                        metrics.add(
+                            documents=1,
+                            tokens=len(sample['tokens']),
+                            input_bytes=sample['tokens'].nbytes,
+                        )
+                    else:
+                        metrics.add(
+                            documents=1,
+                            input_bytes=len(sample['text'].encode('utf-8')),
+                        )
+                progress_bar.update(len(labels))
+            progress_bar.close()
+
+        if not raw_copy:
+            metrics.add(
+                output_bytes=sum(
+                    (shard['zip_data'] or shard['raw_data'])['bytes']
+                    for writer in writers
+                    for shard in writer.shards
+                ),
+            )
+
+
+def parallelize_writing(
+        outputs,
+        columns,
+        compression,
+        in_path,
+        selected_indices,
+        num_workers,
+        raw_copy=False,
+        metrics_dir=None,
+        metrics_interval=30.0,
+):
     if num_workers < 0:
         raise ValueError('cannot use negative number of workers.')
-    elif num_workers == 0:
-        write_data(writer_kwargs, ds, indices, 0)
-    else:
-        # Create indices shards.
-        indices_shards = np.array_split(indices, num_workers)
-        # Create a list of (shard, rank) pairs to pass to the workers.
-        worker_args = [
-            (indices_shard, rank)
-            for (rank, indices_shard) in enumerate(indices_shards)
-        ]
 
+    # Each worker owns whole input shards, so no shard is read by more
+    # than one worker. Balance workers by the shards' sizes in bytes.
+    shards = read_index(in_path)
+    shard_starts = np.cumsum([0] + [shard['samples'] for shard in shards])
+    shard_sizes = [
+        (shard['zip_data'] or shard['raw_data'])['bytes']
+        for shard in shards
+    ]
+    # Where each shard's samples start in each output's indices.
+    shard_cuts = [
+        np.searchsorted(indices, shard_starts) if indices is not None else None
+        for indices in selected_indices
+    ]
+
+    worker_args = []
+    for (rank, shard_indices) in enumerate(
+            assign_balanced(shard_sizes, max(num_workers, 1)),
+    ):
+        if not shard_indices:
+            continue
+        worker_selected_indices = []
+        for (indices, cuts) in zip(selected_indices, shard_cuts):
+            if indices is None:
+                worker_selected_indices.append(None)
+                continue
+            worker_selected_indices.append(np.concatenate([
+                indices[cuts[shard_index]:cuts[shard_index + 1]]
+                for shard_index in shard_indices
+            ]))
+        worker_args.append(
+            (shard_indices, worker_selected_indices, rank),
+        )
+
+    write = functools.partial(
+        write_data,
+        outputs,
+        columns,
+        compression,
+        in_path,
+        raw_copy=raw_copy,
+        metrics_dir=metrics_dir,
+        metrics_interval=metrics_interval,
+    )
+    if num_workers == 0:
+        for args in worker_args:
+            write(*args)
+    else:
         # Write in parallel.
         with mp.Pool(processes=num_workers) as pool:
             # TODO get number of tokens and reduce afterwards
-            pool.starmap(
-                functools.partial(write_data, writer_kwargs, ds),
-                worker_args,
-            )
+            pool.starmap(write, worker_args)
 
 
 def parse_args():
@@ -48,7 +340,7 @@ def parse_args():
     parser.add_argument(
         '--in_path',
         required=True,
-        help='Input path for `StreamingDataset`.',
+        help='Local path of the input MDS dataset.',
     )
     parser.add_argument(
         '--left_path',
@@ -80,6 +372,18 @@ def parse_args():
             'of right_prob and right_max is chosen during splitting.'
         ),
     )
+    parser.add_argument(
+        '--outputs',
+        nargs='+',
+        help=(
+            'Split into any number of outputs, given as `PATH[:PROB[:MAX]]`, '
+            'for example `train valid:1e-3:1000 test:1e-3:1000`. A sample '
+            'ends up in an output with the minimum (in expected number of '
+            'samples) of PROB and MAX; exactly one output without PROB '
+            'receives all remaining samples. If given, the `--left_*` and '
+            '`--right_*` arguments are ignored.'
+        ),
+    )
     parser.add_argument(
         '--seed',
         default=0x5eed,
@@ -96,136 +400,155 @@ def parse_args():
         type=int,
         help='Number of workers to use for parallel writing.',
     )
+    parser.add_argument(
+        '--raw_copy',
+        action='store_true',
+        help=(
+            'Copy the encoded samples from the input shards instead of '
+            'decoding and re-encoding each sample. Shards whose samples all '
+            'end up in the same split are copied as whole files if '
+            '`--compression` matches the input\'s compression.'
+        ),
+    )
+    parser.add_argument(
+        '--metrics_dir',
+        help=(
+            'Directory to write throughput and resource metrics of each '
+            'worker to.'
+        ),
+    )
+    parser.add_argument(
+        '--metrics_interval',
+        default=30.0,
+        type=float,
+        help='Number of seconds between metrics samples.',
+    )
     return parser.parse_args()
 
 
-def run_split(
+def run_multi_split(
         in_path,
-        left_path,
-        right_path,
-        right_prob,
-        right_max,
+        outputs,
         seed,
         compression,
         num_workers,
+        metrics_dir=None,
+        metrics_interval=30.0,
+        raw_copy=False,
 ):
-    ds = StreamingDataset(
-        local=in_path,
-        batch_size=1,
-
-        # Below can be set to default values to avoid warnings as they
-        # appear.
-        # split='all',
-        # download_retry=download_retry,
-        # download_timeout=download_timeout,
-        # validate_hash=validate_hash,
-        # keep_zip=keep_zip,
-        # epoch_size=epoch_size,
-        predownload=8,
-        # cache_limit=cache_limit,
-        # partition_algo=partition_algo,
-        num_canonical_nodes=1,
-        # batch_size=batch_size,
-        # shuffle=shuffle,
-        # shuffle_algo=shuffle_algo,
-        # shuffle_seed=shuffle_seed,
-        shuffle_block_size=1 << 18,
-        # sampling_method=sampling_method,
-        # sampling_granularity=sampling_granularity,
-        # batching_method=batching_method,
-        # allow_unsafe_types=allow_unsafe_types,
-        # replication=replication,
-    )
-
-    has_tokens = 'tokens' in ds.get_item(0)
-    if has_tokens:
-        key = 'tokens'
-        columns = {key: 'ndarray:int32'}
-    else:
-        key = 'text'
-        columns = {key: 'str'}
+    """Split the dataset at `in_path` into `outputs` in a single pass.
+
+    Each output is a dictionary with keys "path", "prob", and "max"
+    (see `parse_output`).
+    """
+    if sum(output['prob'] is None for output in outputs) != 1:
+        raise ValueError(
+            'exactly one output must not have a probability so that it '
+            'receives all remaining samples',
+        )
+
+    # Only read the index; workers read the shard files directly.
+    ds = MDSShardReader(in_path)
+
+    # Keep the columns (and thus the token data type) of the input.
+    columns = get_columns(in_path)
 
     print(f'{in_path = }')
-    print(f'{left_path = }')
-    print(f'{right_path = }')
+    for output in outputs:
+        print(f'output = {output}')
     print(f'{compression = }')
     print(f'{columns = }')
 
     rng = np.random.default_rng(seed)
-    threshold = min(right_max / len(ds), right_prob)
-
-    # This is the number of samples until the next index in the "right"
-    # set. Always >= 1.
-    num_samples_until_right = rng.geometric(threshold)
-    # Convert number of samples to index.
-    right_index = num_samples_until_right - 1
-    right_indices = [right_index]
-    while right_indices[-1] < len(ds):
-        # This is the number of samples until the next index in the
-        # "right" set. Always >= 1.
-        num_samples_until_right = rng.geometric(threshold)
-        # Use number of samples as "distance" to compute next index.
-        right_index = right_indices[-1] + num_samples_until_right
-        right_indices.append(right_index)
-
-    # Remove last index that was too large and caused us to exit the
-    # while-loop.
-    right_indices.pop()
-
-    all_indices = np.arange(len(ds))
-    left_indices = np.setdiff1d(
-        all_indices,
-        right_indices,
-        assume_unique=True,
-    )
+    drawn_indices = iter(select_samples(
+        rng,
+        get_thresholds(outputs, len(ds)),
+        len(ds),
+    ))
+    # `None` marks the output receiving the remaining samples.
+    selected_indices = [
+        next(drawn_indices) if output['prob'] is not None else None
+        for output in outputs
+    ]
 
     print('number of total samples:', len(ds))
-    print('number of left samples:', len(left_indices))
-    print('number of right samples:', len(right_indices))
-    assert np.all(
-        np.sort(np.append(left_indices, right_indices)) == all_indices,
-    )
-    del all_indices
-    assert len(np.unique(left_indices)) == len(left_indices)
-    assert len(np.unique(right_indices)) == len(right_indices)
-
-    common_kwargs = {
-        'columns': columns,
-        'compression': compression,
-    }
-    left_writer_kwargs = common_kwargs.copy()
-    left_writer_kwargs['out'] = left_path
-    right_writer_kwargs = common_kwargs.copy()
-    right_writer_kwargs['out'] = right_path
+    num_selected = sum(
+        len(indices) for indices in selected_indices if indices is not None
+    )
+    for (output, indices) in zip(outputs, selected_indices):
+        num_samples = (
+            len(indices) if indices is not None else len(ds) - num_selected
+        )
+        print(f'number of samples in {output["path"]}:', num_samples)
 
-    print('Writing left split...')
+    print('Writing splits...')
     parallelize_writing(
-        left_writer_kwargs,
-        ds,
-        left_indices,
+        outputs,
+        columns,
+        compression,
+        in_path,
+        selected_indices,
         num_workers=num_workers,
+        raw_copy=raw_copy,
+        metrics_dir=metrics_dir,
+        metrics_interval=metrics_interval,
     )
-    merge_shard_groups(left_path)
+    for output in outputs:
+        merge_shard_groups(output['path'])
 
-    print('Writing right split...')
-    parallelize_writing(
-        right_writer_kwargs,
-        ds,
-        right_indices,
-        num_workers=num_workers,
+
+def run_split(
+        in_path,
+        left_path,
+        right_path,
+        right_prob,
+        right_max,
+        seed,
+        compression,
+        num_workers,
+        metrics_dir=None,
+        metrics_interval=30.0,
+        raw_copy=False,
+):
+    run_multi_split(
+        in_path,
+        [
+            {'path': left_path, 'prob': None, 'max': None},
+            {'path': right_path, 'prob': right_prob, 'max': right_max},
+        ],
+        seed,
+        compression,
+        num_workers,
+        metrics_dir=metrics_dir,
+        metrics_interval=metrics_interval,
+        raw_copy=raw_copy,
     )
-    merge_shard_groups(right_path)
 
 
 if __name__ == '__main__':
     args = parse_args()
-    run_split(
-        in_path=args.in_path,
-        left_path=args.left_path,
-        right_path=args.right_path,
-        right_prob=args.right_prob,
-        right_max=args.right_max,
-        seed=args.seed,
-        compression=args.compression,
-        num_workers=args.num_workers,
-    )
+    if args.outputs:
+        run_multi_split(
+            in_path=args.in_path,
+            outputs=[parse_output(spec) for spec in args.outputs],
+            seed=args.seed,
+            compression=args.compression,
+            num_workers=args.num_workers,
+            metrics_dir=args.metrics_dir,
+            metrics_interval=args.metrics_interval,
+            raw_copy=args.raw_copy,
+        )
+    else:
+        run_split(
+            in_path=args.in_path,
+            left_path=args.left_path,
+            right_path=args.right_path,
+            right_prob=args.right_prob,
+            right_max=args.right_max,
+            seed=args.seed,
+            compression=args.compression,
+            num_workers=args.num_workers,
+            metrics_dir=args.metrics_dir,
+            metrics_interval=args.metrics_interval,
+            raw_copy=args.raw_copy,
+        )
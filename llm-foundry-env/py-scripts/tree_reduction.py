@@ -0,0 +1,212 @@
+"""
+Distributed tree reduction over a shared filesystem.
+
+Each of `WORLD_SIZE` processes first writes a partial result for its
+share of the work. Partial results are then combined in a tree with a
+fixed fan-in: at each level, process `j` combines partials `j * fan_in`
+to `(j + 1) * fan_in - 1` of the previous level, until a single result
+remains (computed by rank 0). Processes synchronize only by waiting for
+"done" marker files, so no communication library is required and
+metadata I/O is spread over all processes.
+"""
+
+import math
+import os
+import shutil
+import time
+import uuid
+from typing import Callable, List, Optional, Sequence, Tuple, TypeVar
+
+T = TypeVar('T')
+
+DONE_SUFFIX = '.done'
+# Default number of seconds to wait for other processes' results.
+DEFAULT_TIMEOUT = 3600.0
+
+
+def get_rank_and_world_size() -> Tuple[int, int]:
+    """Return `RANK` and `WORLD_SIZE` from the environment."""
+    if 'WORLD_SIZE' not in os.environ or 'RANK' not in os.environ:
+        raise RuntimeError(
+            'The `WORLD_SIZE` and `RANK` environment variables need to be '
+            'defined for parallel data processing, where `WORLD_SIZE` is the '
+            'number of processes, and `RANK` is the index of this process.'
+        )
+    return (int(os.environ['RANK']), int(os.environ['WORLD_SIZE']))
+
+
+def get_run_id(world_size: int) -> str:
+    """Return an ID that all processes of this run agree on, but that
+    differs between runs, for naming a fresh work directory.
+
+    Under SLURM, the ID is derived from the job step and the restart
+    count of the job, so reruns in the same job and requeued jobs get
+    new IDs.
+
+    Raises:
+        RuntimeError: If there are multiple processes outside of a SLURM
+            job step, since they cannot agree on an ID.
+    """
+    if world_size == 1:
+        return f'local-{uuid.uuid4().hex}'
+
+    job_id = os.getenv('SLURM_JOB_ID')
+    step_id = os.getenv('SLURM_STEP_ID')
+    if job_id is None or step_id is None:
+        raise RuntimeError(
+            'Multiple processes outside of a SLURM job step cannot agree on '
+            'a run ID; please give a work directory that is unique to this '
+            'run.'
+        )
+    restart_count = os.getenv('SLURM_RESTART_COUNT', '0')
+    return f'{job_id}.{step_id}-{restart_count}'
+
+
+def get_chunk(items: Sequence[T], rank: int, world_size: int) -> List[T]:
+    """Return the contiguous chunk of `items` of process `rank`, so that
+    concatenating all chunks in rank order keeps the order of `items`.
+    """
+    start = len(items) * rank // world_size
+    end = len(items) * (rank + 1) // world_size
+    return list(items[start:end])
+
+
+def mark_done(path: str) -> None:
+    """Signal that the output at `path` is complete."""
+    with open(path + DONE_SUFFIX, 'w'):
+        pass
+
+
+def wait_for(
+        paths: Sequence[str],
+        timeout: Optional[float] = None,
+        poll_interval: float = 1.0,
+) -> None:
+    """Wait until all outputs at `paths` are complete (see `mark_done`).
+
+    Raises:
+        TimeoutError: If not all outputs were complete after `timeout`
+            seconds.
+    """
+    start = time.time()
+    last_report = start
+    pending = list(paths)
+    while True:
+        pending = [
+            path for path in pending
+            if not os.path.exists(path + DONE_SUFFIX)
+        ]
+        if not pending:
+            return
+        now = time.time()
+        if timeout is not None and now - start > timeout:
+            raise TimeoutError(
+                f'timed out waiting for {len(pending)} outputs, such as '
+                f'{pending[0]}',
+            )
+        if now - last_report > 600:
+            print(f'Still waiting for {len(pending)} outputs, such as '
+                  f'{pending[0]}')
+            last_report = now
+        time.sleep(poll_interval)
+
+
+def _get_level_dir(level: int) -> str:
+    return f'level{level:02}'
+
+
+def remove_work_dir(
+        work_dir: str,
+        keep: bool,
+        entries: Sequence[str] = (),
+) -> None:
+    """Remove the partial results of a finished run from `work_dir`.
+
+    If `keep` is set (for example, because `work_dir` was given by the
+    user and may have existed before), only the levels of the tree and
+    the caller's `entries` in it are removed, not `work_dir` itself.
+    """
+    if not keep:
+        shutil.rmtree(work_dir)
+        return
+    level = 0
+    while os.path.isdir(os.path.join(work_dir, _get_level_dir(level))):
+        shutil.rmtree(os.path.join(work_dir, _get_level_dir(level)))
+        level += 1
+    for name in entries:
+        path = os.path.join(work_dir, name)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+def tree_reduce(
+        work_dir: str,
+        rank: int,
+        world_size: int,
+        map_fn: Callable[[str], None],
+        reduce_fn: Callable[[List[str], str], None],
+        fan_in: int = 16,
+        timeout: Optional[float] = None,
+) -> Optional[str]:
+    """Compute a partial result per process and combine them in a tree.
+
+    Partial results are identified by path prefixes in `work_dir`; the
+    callbacks may write any number of files starting with the prefix.
+
+    Args:
+        work_dir (str): Shared directory for partial results. Must not
+            contain results of a different run (see `get_run_id`).
+        rank (int): Index of this process.
+        world_size (int): Number of processes.
+        map_fn (Callable[[str], None]): Writes this process's partial
+            result to the given prefix.
+        reduce_fn (Callable[[List[str], str], None]): Combines the
+            partial results at the given prefixes (in order) into a
+            partial result at the second argument.
+        fan_in (int): Maximum number of partial results combined at
+            once.
+        timeout (Optional[float]): Maximum number of seconds to wait for
+            other processes' partial results.
+
+    Returns:
+        The prefix of the final result on rank 0, `None` on all other
+        ranks.
+    """
+    if fan_in < 2:
+        raise ValueError('fan-in must be at least 2')
+
+    def get_prefix(level, index):
+        return os.path.join(work_dir, _get_level_dir(level), f'{index:05}')
+
+    level = 0
+    prefix = get_prefix(level, rank)
+    if os.path.exists(prefix + DONE_SUFFIX):
+        raise RuntimeError(f'{work_dir} contains results of an earlier run')
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    map_fn(prefix)
+    mark_done(prefix)
+
+    num_partials = world_size
+    while num_partials > 1:
+        next_num_partials = math.ceil(num_partials / fan_in)
+        if rank >= next_num_partials:
+            return None
+
+        child_prefixes = [
+            get_prefix(level, index)
+            for index in range(
+                    rank * fan_in,
+                    min((rank + 1) * fan_in, num_partials),
+            )
+        ]
+        level += 1
+        prefix = get_prefix(level, rank)
+        os.makedirs(os.path.dirname(prefix), exist_ok=True)
+        wait_for(child_prefixes, timeout=timeout)
+        reduce_fn(child_prefixes, prefix)
+        mark_done(prefix)
+        num_partials = next_num_partials
+
+    return prefix if rank == 0 else None
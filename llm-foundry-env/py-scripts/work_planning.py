@@ -0,0 +1,125 @@
+"""
+Size-aware, balanced assignment of units of work (such as input files)
+to parallel processes.
+
+Assigning a static, equally sized slice of files to each process makes
+the slowest process (for example, the one that happens to get the
+largest file) determine the total runtime. Instead, we assign items by
+size using a longest-processing-time-first (LPT) greedy scheme.
+"""
+
+import heapq
+import json
+import os
+from typing import List, Optional, Sequence
+
+
+def assign_balanced(
+        weights: Sequence[int],
+        num_bins: int,
+) -> List[List[int]]:
+    """Assign items to `num_bins` bins with balanced total weight.
+
+    Items are assigned in order of decreasing weight to the bin with
+    the currently lowest total weight (LPT scheme). Ties are broken by
+    index, so the result is deterministic.
+
+    Args:
+        weights (Sequence[int]): Weight (such as the size) of each item.
+        num_bins (int): Number of bins to assign the items to.
+
+    Returns:
+        For each bin, the sorted indices of the items assigned to it.
+    """
+    bins = [[] for _ in range(num_bins)]
+    loads = [(0, i) for i in range(num_bins)]
+    for item in sorted(range(len(weights)), key=lambda i: (-weights[i], i)):
+        load, bin_index = heapq.heappop(loads)
+        bins[bin_index].append(item)
+        heapq.heappush(loads, (load + weights[item], bin_index))
+
+    for items in bins:
+        items.sort()
+    return bins
+
+
+def get_file_sizes(paths: Sequence[str]) -> List[int]:
+    """Return the size in bytes of each file in `paths`."""
+    return [os.path.getsize(path) for path in paths]
+
+
+def _save_plan(plan_file: str, plan: dict) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(plan_file)), exist_ok=True)
+    # Write atomically so that other processes never read a partial
+    # plan.
+    tmp_plan_file = f'{plan_file}.tmp{os.getpid()}'
+    with open(tmp_plan_file, 'w') as f:
+        json.dump(plan, f, indent=1)
+    os.replace(tmp_plan_file, plan_file)
+
+
+def _load_plan(
+        plan_file: str,
+        items: Sequence[str],
+        num_bins: int,
+) -> List[List[int]]:
+    with open(plan_file, 'r') as f:
+        plan = json.load(f)
+    if plan['num_bins'] != num_bins or plan['items'] != list(items):
+        raise ValueError(
+            f'work plan at {plan_file} was created for different inputs '
+            f'or a different number of processes; please remove it to '
+            f'create a new plan.',
+        )
+    return plan['assignment']
+
+
+def plan_work(
+        items: Sequence[str],
+        weights: Sequence[int],
+        num_bins: int,
+        plan_file: Optional[str] = None,
+        save: bool = True,
+) -> List[List[int]]:
+    """Assign `items` to `num_bins` processes and report the plan.
+
+    If `plan_file` exists, the plan stored in it is reused, so a re-run
+    processes exactly the same items in each process.
+
+    Args:
+        items (Sequence[str]): Names of the items (such as file paths).
+        weights (Sequence[int]): Weight (such as the size) of each item.
+        num_bins (int): Number of processes to assign the items to.
+        plan_file (Optional[str]): JSON file to load the plan from or
+            store the plan in.
+        save (bool): Whether to store the plan in `plan_file` if it does
+            not exist yet. Should only be true for a single process.
+
+    Returns:
+        For each process, the sorted indices of the items assigned to it.
+    """
+    if plan_file is not None and os.path.isfile(plan_file):
+        print(f'Loading work plan from {plan_file}')
+        assignment = _load_plan(plan_file, items, num_bins)
+    else:
+        assignment = assign_balanced(weights, num_bins)
+        if plan_file is not None and save:
+            _save_plan(
+                plan_file,
+                {
+                    'num_bins': num_bins,
+                    'items': list(items),
+                    'weights': list(weights),
+                    'assignment': assignment,
+                },
+            )
+            print(f'Saved work plan to {plan_file}')
+
+    loads = [sum(weights[i] for i in bin_items) for bin_items in assignment]
+    mean_load = sum(loads) / max(num_bins, 1)
+    print(
+        f'Work plan: {len(items)} items over {num_bins} processes; '
+        f'load min/mean/max: {min(loads, default=0)}/{mean_load:.0f}/'
+        f'{max(loads, default=0)}',
+    )
+    return assignment
@@ -0,0 +1,132 @@
+"""
+Round trip of `ParallelMDSWriter`: shards it writes must be read back
+by `streaming` exactly like those of a plain `MDSWriter`.
+
+Needs `streaming`; skipped otherwise.
+"""
+
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), os.pardir, 'py-scripts'),
+)
+
+pytest.importorskip('streaming')
+
+from streaming import MDSWriter, StreamingDataset
+
+from conversion_pipeline import (
+    DocumentCounter,
+    ParallelMDSWriter,
+    write_samples,
+)
+from data_prep_metrics import start_metrics
+
+COLUMNS = {'tokens': 'ndarray:int32', 'text': 'str'}
+
+
+def make_samples(num_samples=500):
+    rng = np.random.default_rng(0)
+    return [
+        {
+            'tokens': rng.integers(0, 50000, rng.integers(1, 300)).astype(
+                np.int32,
+            ),
+            'text': f'document {i}',
+        }
+        for i in range(num_samples)
+    ]
+
+
+def write(writer_cls, out, samples, **kwargs):
+    # A small size limit, so that many shards are written.
+    with writer_cls(
+            columns=COLUMNS,
+            out=out,
+            compression='zstd',
+            size_limit=1 << 14,
+            **kwargs,
+    ) as writer:
+        write_samples(samples, writer)
+
+
+def read_shards(out):
+    with open(os.path.join(out, 'index.json')) as f:
+        return json.load(f)['shards']
+
+
+def read_samples(out):
+    dataset = StreamingDataset(
+        local=out,
+        shuffle=False,
+        batch_size=1,
+        allow_unsafe_types=True,
+    )
+    return [dataset[i] for i in range(len(dataset))]
+
+
+def assert_samples_equal(actual, expected):
+    assert len(actual) == len(expected)
+    for (a, e) in zip(actual, expected):
+        np.testing.assert_array_equal(a['tokens'], e['tokens'])
+        assert a['text'] == e['text']
+
+
+@pytest.mark.parametrize('num_shard_workers', [1, 4])
+def test_round_trip(tmp_path, num_shard_workers):
+    samples = make_samples()
+    parallel_out = str(tmp_path / 'parallel')
+    write(
+        ParallelMDSWriter,
+        parallel_out,
+        samples,
+        num_shard_workers=num_shard_workers,
+    )
+    plain_out = str(tmp_path / 'plain')
+    write(MDSWriter, plain_out, samples)
+
+    shards = read_shards(parallel_out)
+    assert len(shards) > 4 * num_shard_workers
+    assert shards == read_shards(plain_out)
+    assert_samples_equal(read_samples(parallel_out), samples)
+
+
+def test_falls_back_without_internals(tmp_path, monkeypatch):
+    # As if a `streaming` version lacked one of the internals.
+    monkeypatch.setattr(
+        ParallelMDSWriter,
+        '_INTERNALS',
+        ParallelMDSWriter._INTERNALS + ('_removed_internal',),
+    )
+    samples = make_samples(100)
+    out = str(tmp_path / 'out')
+    with pytest.warns(UserWarning, match='_removed_internal'):
+        write(ParallelMDSWriter, out, samples)
+    assert_samples_equal(read_samples(out), samples)
+
+
+def test_document_counter(tmp_path):
+    class Units:
+        units = [['a', 'b'], ['c']]
+
+        def __iter__(self):
+            for unit in self.units:
+                for text in unit:
+                    yield {'text': text}
+
+    units = Units()
+    counter = DocumentCounter(units)
+    # Units of work are swapped out on the wrapped dataset.
+    counter.units = [['d', 'e', 'f']]
+    assert units.units == [['d', 'e', 'f']]
+    with start_metrics(str(tmp_path), 'test'):
+        assert [sample['text'] for sample in counter] == ['d', 'e', 'f']
+    (summary_path,) = tmp_path.glob('test.*.summary.json')
+    with open(summary_path) as f:
+        assert json.load(f)['documents'] == 3
@@ -4,6 +4,12 @@
 
 set -euo pipefail
 
+# Do not use these variables; they may be overwritten. Instead, use
+# `get_curr_file` or `get_curr_dir` after sourcing `get_curr_file.sh`.
+_curr_file="${BASH_SOURCE[0]:-${(%):-%x}}"
+_curr_dir="$(dirname "$_curr_file")"
+source "$_curr_dir"/../../global-scripts/get_curr_file.sh "$_curr_file"
+
 _activated_container="${_ACTIVATED_CONTAINER:-0}"
 if ! ((_activated_container)); then
     echo 'Container has not been activated; please use' \
@@ -18,6 +24,9 @@ PER_SPLIT_NUM_WORKERS="${PER_SPLIT_NUM_WORKERS:-0}"
 
 megatron_repo_dir="$ext_repo_dir"/Megatron-LM
 
+# Training is started with `run_with_virtual_datasets.py`, so that
+# virtual merges (`merge_datasets.py --virtual`) can be used as data.
+#
 # Below is a Megatron-LM Llama-2 pretraining example configuration,
 # with major settings being
 # - use variable config values,
@@ -46,6 +55,7 @@ env NVTE_APPLY_QK_LAYER_SCALING=1 python -u -m torchrun_jsc \
        --rdzv_id="$RDZV_ID" \
        --rdzv_endpoint="$MASTER_ADDR":"$MASTER_PORT" \
        --rdzv_backend=c10d \
+       "$(get_curr_dir)"/../py-scripts/run_with_virtual_datasets.py \
        "$megatron_repo_dir"/pretrain_gpt.py  \
        --train-iters=10 \
        --log-interval=1 \
@@ -118,6 +128,7 @@ env NVTE_APPLY_QK_LAYER_SCALING=1 python -u -m torchrun_jsc \
 #        --rdzv_id="$RDZV_ID" \
 #        --rdzv_endpoint="$MASTER_ADDR":"$MASTER_PORT" \
 #        --rdzv_backend=c10d \
+#        "$(get_curr_dir)"/../py-scripts/run_with_virtual_datasets.py \
 #        "$megatron_repo_dir"/pretrain_gpt.py  \
 #        --config-path="$TRAIN_CONFIG_YAML_DIR" \
 #        --config-name="$TRAIN_CONFIG_YAML_NAME" \
@@ -182,3 +193,5 @@ env NVTE_APPLY_QK_LAYER_SCALING=1 python -u -m torchrun_jsc \
 #        --log-validation-ppl-to-tensorboard \
 #        --log-memory-to-tensorboard \
 #        --seed=1234
+
+pop_curr_file
@@ -0,0 +1,363 @@
+"""
+Low-overhead throughput and resource metrics for data preparation.
+
+Each process records counters (documents, tokens, input and output
+bytes) and the time spent per stage. When enabled, a background thread
+samples them at a fixed interval and appends a record with the current
+rates and memory usage to a per-rank JSON lines file. When the process
+finishes, a summary is written that can be reduced over all ranks to
+spot slow nodes and straggler ranks:
+
+    python data_prep_metrics.py --metrics_dir <dir> --name <name>
+
+Code that wants to report metrics uses `get_metrics()`, which returns a
+disabled (and practically free) recorder unless `start_metrics` was
+called in this process.
+"""
+
+from argparse import ArgumentParser, Namespace
+import contextlib
+import glob
+import json
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+_COUNTERS = ['documents', 'tokens', 'input_bytes', 'output_bytes']
+
+
+def get_rss_bytes(pid: str = 'self') -> int:
+    """Return the resident set size of process `pid` in bytes, or 0 if
+    it cannot be determined.
+    """
+    try:
+        with open(f'/proc/{pid}/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def get_children_rss_bytes() -> int:
+    """Return the summed resident set size of this process's direct
+    children (such as worker processes) in bytes.
+    """
+    total = 0
+    for children_file in glob.glob('/proc/self/task/*/children'):
+        try:
+            with open(children_file, 'r') as f:
+                children = f.read().split()
+        except OSError:
+            continue
+        total += sum(get_rss_bytes(child) for child in children)
+    return total
+
+
+class MetricsRecorder:
+    """Thread-safe counters and stage timers of a single process.
+
+    Args:
+        metrics_dir (Optional[str]): Directory to write metrics to. If
+            not given, the recorder is disabled and does nothing.
+        name (str): Name of the entry point, used in file names.
+        rank (int): Index of this process.
+        interval (float): Number of seconds between samples.
+    """
+
+    def __init__(
+            self,
+            metrics_dir: Optional[str] = None,
+            name: str = 'data_prep',
+            rank: int = 0,
+            interval: float = 30.0,
+    ) -> None:
+        self.enabled = metrics_dir is not None
+        self.metrics_dir = metrics_dir
+        self.name = name
+        self.rank = rank
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._counters = dict.fromkeys(_COUNTERS, 0)
+        self._stage_seconds: Dict[str, float] = {}
+        self._max_rss_bytes = 0
+        self._start_time = time.time()
+        self._last_sample_time = self._start_time
+        self._last_counters = dict(self._counters)
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _path(self, suffix: str) -> str:
+        return os.path.join(
+            self.metrics_dir,
+            f'{self.name}.rank{self.rank:05}.{suffix}',
+        )
+
+    def start(self) -> 'MetricsRecorder':
+        """Start sampling in a background thread."""
+        if not self.enabled:
+            return self
+        os.makedirs(self.metrics_dir, exist_ok=True)
+        # Start a new file so re-runs do not mix their samples.
+        open(self._path('jsonl'), 'w').close()
+        self._thread = threading.Thread(target=self._sample_loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def add(
+            self,
+            documents: int = 0,
+            tokens: int = 0,
+            input_bytes: int = 0,
+            output_bytes: int = 0,
+    ) -> None:
+        """Add to the counters."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters['documents'] += documents
+            self._counters['tokens'] += tokens
+            self._counters['input_bytes'] += input_bytes
+            self._counters['output_bytes'] += output_bytes
+
+    def add_stage_time(self, stage: str, seconds: float) -> None:
+        """Add `seconds` to the time spent in `stage`."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._stage_seconds[stage] = (
+                self._stage_seconds.get(stage, 0.0) + seconds
+            )
+
+    @contextlib.contextmanager
+    def stage(self, stage: str) -> Iterator[None]:
+        """Measure the time spent in the `with` block as `stage`."""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stage, time.perf_counter() - start)
+
+    def timed(self, iterable: Iterable[Any], stage: str) -> Iterator[Any]:
+        """Yield from `iterable`, measuring the time spent producing
+        items as `stage`.
+        """
+        if not self.enabled:
+            yield from iterable
+            return
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_stage_time(stage, time.perf_counter() - start)
+                return
+            self.add_stage_time(stage, time.perf_counter() - start)
+            yield item
+
+    def _sample(self) -> Dict[str, Any]:
+        now = time.time()
+        with self._lock:
+            counters = dict(self._counters)
+            stage_seconds = dict(self._stage_seconds)
+        rss_bytes = get_rss_bytes()
+        children_rss_bytes = get_children_rss_bytes()
+        self._max_rss_bytes = max(
+            self._max_rss_bytes,
+            rss_bytes + children_rss_bytes,
+        )
+
+        seconds = max(now - self._last_sample_time, 1e-9)
+        deltas = {
+            key: counters[key] - self._last_counters[key]
+            for key in _COUNTERS
+        }
+        self._last_sample_time = now
+        self._last_counters = counters
+        return {
+            'time': now,
+            'elapsed_s': now - self._start_time,
+            **counters,
+            'documents_per_s': deltas['documents'] / seconds,
+            'tokens_per_s': deltas['tokens'] / seconds,
+            'input_mb_per_s': deltas['input_bytes'] / seconds / 1e6,
+            'output_mb_per_s': deltas['output_bytes'] / seconds / 1e6,
+            'rss_bytes': rss_bytes,
+            'children_rss_bytes': children_rss_bytes,
+            'stage_seconds': stage_seconds,
+        }
+
+    def _write_sample(self) -> None:
+        with open(self._path('jsonl'), 'a') as f:
+            f.write(json.dumps(self._sample()) + '\n')
+
+    def _sample_loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            self._write_sample()
+
+    def close(self) -> None:
+        """Stop sampling and write the final sample and the summary."""
+        if not self.enabled or self._stop.is_set():
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._write_sample()
+
+        elapsed = max(time.time() - self._start_time, 1e-9)
+        # Other threads (such as shard writers) may still be recording.
+        with self._lock:
+            counters = dict(self._counters)
+            stage_seconds = dict(self._stage_seconds)
+        summary = {
+            'name': self.name,
+            'rank': self.rank,
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'start_time': self._start_time,
+            'elapsed_s': elapsed,
+            **counters,
+            'documents_per_s': counters['documents'] / elapsed,
+            'tokens_per_s': counters['tokens'] / elapsed,
+            'input_mb_per_s': counters['input_bytes'] / elapsed / 1e6,
+            'output_mb_per_s': counters['output_bytes'] / elapsed / 1e6,
+            'max_rss_bytes': self._max_rss_bytes,
+            'stage_seconds': stage_seconds,
+        }
+        with open(self._path('summary.json'), 'w') as f:
+            json.dump(summary, f, indent=1)
+
+    def __enter__(self) -> 'MetricsRecorder':
+        return self.start()
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+# Recorder of this process; disabled unless `start_metrics` is called.
+_recorder = MetricsRecorder()
+
+
+def start_metrics(
+        metrics_dir: Optional[str],
+        name: str,
+        rank: int = 0,
+        interval: float = 30.0,
+) -> MetricsRecorder:
+    """Create, start, and return this process's recorder.
+
+    Use the result as a context manager (or call its `close` method) to
+    write the summary at the end.
+    """
+    global _recorder
+    _recorder = MetricsRecorder(metrics_dir, name, rank, interval).start()
+    return _recorder
+
+
+def get_metrics() -> MetricsRecorder:
+    """Return this process's recorder."""
+    return _recorder
+
+
+def reduce_metrics(metrics_dir: str, name: str) -> Dict[str, Any]:
+    """Combine the summaries of all ranks of entry point `name` in
+    `metrics_dir` and write the result to `<name>.summary.json`.
+
+    Returns:
+        Totals over all ranks, aggregate rates, and the ranks that took
+        longest and had the lowest throughput.
+    """
+    summaries: List[Dict[str, Any]] = []
+    for path in sorted(
+            glob.glob(os.path.join(metrics_dir, f'{name}.rank*.summary.json')),
+    ):
+        with open(path, 'r') as f:
+            summaries.append(json.load(f))
+    if not summaries:
+        raise ValueError(f'no summaries for {name} found in {metrics_dir}')
+
+    start_time = min(summary['start_time'] for summary in summaries)
+    end_time = max(
+        summary['start_time'] + summary['elapsed_s']
+        for summary in summaries
+    )
+    wall_seconds = max(end_time - start_time, 1e-9)
+    totals = {
+        key: sum(summary[key] for summary in summaries)
+        for key in _COUNTERS
+    }
+    stage_seconds = {}
+    for summary in summaries:
+        for stage, seconds in summary['stage_seconds'].items():
+            stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds
+    elapsed = [summary['elapsed_s'] for summary in summaries]
+
+    def describe(summary):
+        return {
+            key: summary[key]
+            for key in [
+                    'rank',
+                    'host',
+                    'elapsed_s',
+                    'documents_per_s',
+                    'input_mb_per_s',
+            ]
+        }
+
+    reduced = {
+        'name': name,
+        'num_ranks': len(summaries),
+        'wall_s': wall_seconds,
+        **totals,
+        'documents_per_s': totals['documents'] / wall_seconds,
+        'tokens_per_s': totals['tokens'] / wall_seconds,
+        'input_mb_per_s': totals['input_bytes'] / wall_seconds / 1e6,
+        'output_mb_per_s': totals['output_bytes'] / wall_seconds / 1e6,
+        'elapsed_s_min': min(elapsed),
+        'elapsed_s_mean': sum(elapsed) / len(elapsed),
+        'elapsed_s_max': max(elapsed),
+        'max_rss_bytes': max(summary['max_rss_bytes'] for summary in summaries),
+        'stage_seconds': stage_seconds,
+        'slowest_ranks': [
+            describe(summary)
+            for summary in sorted(
+                    summaries,
+                    key=lambda summary: -summary['elapsed_s'],
+            )[:5]
+        ],
+        'lowest_throughput_ranks': [
+            describe(summary)
+            for summary in sorted(
+                    summaries,
+                    key=lambda summary: summary['input_mb_per_s'],
+            )[:5]
+        ],
+    }
+    with open(os.path.join(metrics_dir, f'{name}.summary.json'), 'w') as f:
+        json.dump(reduced, f, indent=1)
+    return reduced
+
+
+def parse_args() -> Namespace:
+    """Parse commandline arguments."""
+    parser = ArgumentParser(
+        description='Reduce data preparation metrics over all ranks',
+    )
+    parser.add_argument('--metrics_dir', type=str, required=True)
+    parser.add_argument(
+        '--name',
+        type=str,
+        required=True,
+        help='Name of the entry point whose metrics to reduce.',
+    )
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    print(json.dumps(reduce_metrics(args.metrics_dir, args.name), indent=1))
@@ -0,0 +1,252 @@
+"""
+Merge Megatron-LM indexed datasets, optionally copying the data of
+several inputs at once.
+
+This is an alternative to `Megatron-LM/tools/merge_datasets.py` for
+(non-multimodal) datasets. Indices are combined as NumPy arrays (see
+`mmap_index.py`) and data is copied inside the kernel (see
+`file_copy.py`). With `--parallel-workers`, the output `.bin` is sized
+in advance and each input is copied into its own region of it
+concurrently. With `--virtual`, no data is copied at all (see
+`virtual_merge.py`).
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+from typing import List, Sequence, Tuple, Type
+
+import numpy as np
+
+from data_prep_metrics import get_metrics, start_metrics
+from file_copy import CopyStats
+from mmap_index import get_bin_path, get_idx_path, IndexParts, read_index
+from virtual_merge import write_manifest
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--input',
+        required=True,
+        help='Path to directory containing all document files to merge',
+    )
+    parser.add_argument(
+        '--output-prefix',
+        required=True,
+        help='Path to binary output file without suffix',
+    )
+    parser.add_argument(
+        '--parallel-workers',
+        type=int,
+        default=0,
+        help=(
+            'Number of threads copying inputs concurrently into a '
+            'preallocated output. If 0, inputs are appended one after '
+            'another.'
+        ),
+    )
+    parser.add_argument(
+        '--virtual',
+        action='store_true',
+        help=(
+            'Only write the merged index and a manifest referencing the '
+            'input `.bin` files instead of copying them. Training started '
+            'with `run_with_virtual_datasets.py` loads the result.'
+        ),
+    )
+    parser.add_argument(
+        '--metrics-dir',
+        help='Directory to write throughput and resource metrics to',
+    )
+    args = parser.parse_args()
+
+    assert os.path.isdir(args.input), \
+        f'ERROR: {args.input} is not a directory or does not exist'
+    output_dir = os.path.dirname(os.path.abspath(args.output_prefix))
+    assert os.path.isdir(output_dir), \
+        f'ERROR: {output_dir} is not a directory or does not exist'
+    return args
+
+
+def list_input_prefixes(input_dir: str) -> List[str]:
+    """Return the sorted prefixes of the indexed datasets in
+    `input_dir`.
+    """
+    prefixes = set()
+    for basename in os.listdir(input_dir):
+        (prefix, ext) = os.path.splitext(basename)
+        if ext not in ['.idx', '.bin']:
+            continue
+        path_prefix = os.path.join(input_dir, prefix)
+        assert (
+            os.path.isfile(get_idx_path(path_prefix))
+            and os.path.isfile(get_bin_path(path_prefix))
+        ), f'ERROR: .idx or .bin file not provided for {path_prefix}'
+        prefixes.add(path_prefix)
+    return sorted(prefixes)
+
+
+def read_indices(
+        input_prefixes: Sequence[str],
+) -> Tuple[IndexParts, Type[np.number], List[int]]:
+    """Return the combined indices of the indexed datasets at
+    `input_prefixes`, their token data type, and the sizes of their
+    `.bin` files.
+    """
+    metrics = get_metrics()
+    with metrics.stage('merge_index'):
+        index_parts = IndexParts()
+        dtype = None
+        bin_sizes = []
+        for prefix in input_prefixes:
+            index = read_index(get_idx_path(prefix))
+            if dtype is None:
+                dtype = index.dtype
+            assert index.dtype == dtype, \
+                f'ERROR: cannot merge datasets of types {dtype} and ' \
+                f'{index.dtype}'
+            index_parts.append(index.sizes, index.doc_idx)
+
+            # Pointers into the merged data are derived from the
+            # sequence sizes, so the data has to match them exactly.
+            bin_size = os.path.getsize(get_bin_path(prefix))
+            num_tokens = int(index.sizes.sum(dtype=np.int64))
+            assert bin_size == num_tokens * np.dtype(dtype).itemsize, \
+                f'ERROR: size of {get_bin_path(prefix)} does not match ' \
+                f'its index'
+            bin_sizes.append(bin_size)
+            metrics.add(
+                documents=len(index.doc_idx) - 1,
+                tokens=num_tokens,
+            )
+            del index
+    assert dtype is not None, 'ERROR: no datasets to merge'
+    return (index_parts, dtype, bin_sizes)
+
+
+def merge_virtual(input_prefixes: Sequence[str], output_prefix: str) -> None:
+    """Merge the indexed datasets at `input_prefixes` into
+    `output_prefix` without copying their data.
+
+    Only the merged `.idx` and a manifest referencing the inputs' `.bin`
+    files are written. The inputs must not be removed or changed
+    afterwards.
+    """
+    (index_parts, dtype, bin_sizes) = read_indices(input_prefixes)
+    with get_metrics().stage('finalize'):
+        index_parts.write(get_idx_path(output_prefix), dtype)
+        write_manifest(
+            output_prefix,
+            [get_bin_path(prefix) for prefix in input_prefixes],
+            bin_sizes,
+        )
+
+
+def append_inputs(input_prefixes: Sequence[str], bin_path: str) -> None:
+    """Append the data of the indexed datasets at `input_prefixes` to
+    `bin_path` one after another.
+    """
+    metrics = get_metrics()
+    copy_stats = CopyStats()
+    start = time.perf_counter()
+    with open(bin_path, 'wb') as dst_file:
+        for prefix in input_prefixes:
+            with metrics.stage('copy_data'):
+                num_bytes = copy_stats.append_file(
+                    get_bin_path(prefix),
+                    dst_file,
+                )
+            metrics.add(input_bytes=num_bytes, output_bytes=num_bytes)
+    print(copy_stats.report(time.perf_counter() - start))
+
+
+def copy_inputs(
+        input_prefixes: Sequence[str],
+        bin_path: str,
+        bin_offsets: Sequence[int],
+        num_workers: int,
+) -> None:
+    """Copy the data of the indexed datasets at `input_prefixes` into
+    their regions starting at `bin_offsets` of the already sized
+    `bin_path`, with `num_workers` threads.
+    """
+    metrics = get_metrics()
+    copy_stats = CopyStats()
+
+    def copy_input(i):
+        with metrics.stage('copy_data'):
+            # Each copy needs its own file descriptor.
+            dst_fd = os.open(bin_path, os.O_WRONLY)
+            try:
+                num_bytes = copy_stats.copy_file(
+                    get_bin_path(input_prefixes[i]),
+                    dst_fd,
+                    int(bin_offsets[i]),
+                )
+            finally:
+                os.close(dst_fd)
+        metrics.add(input_bytes=num_bytes, output_bytes=num_bytes)
+
+    bin_sizes = [
+        os.path.getsize(get_bin_path(prefix)) for prefix in input_prefixes
+    ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        # Copy the largest inputs first so that no large copy is left
+        # running on its own at the end.
+        order = sorted(
+            range(len(input_prefixes)),
+            key=lambda i: (-bin_sizes[i], i),
+        )
+        for _ in executor.map(copy_input, order):
+            pass
+    print(copy_stats.report(time.perf_counter() - start))
+
+
+def merge(
+        input_prefixes: Sequence[str],
+        output_prefix: str,
+        num_workers: int = 0,
+) -> None:
+    """Merge the indexed datasets at `input_prefixes` into
+    `output_prefix`.
+
+    If `num_workers` is positive, the output `.bin` is sized in advance
+    and the data of up to `num_workers` inputs is copied at once.
+    """
+    (index_parts, dtype, bin_sizes) = read_indices(input_prefixes)
+    bin_path = get_bin_path(output_prefix)
+    if num_workers > 0:
+        bin_offsets = np.cumsum([0] + bin_sizes)
+        # Size the output in advance so that inputs can be copied into
+        # it in any order.
+        with open(bin_path, 'wb') as f:
+            f.truncate(int(bin_offsets[-1]))
+        copy_inputs(input_prefixes, bin_path, bin_offsets, num_workers)
+    else:
+        append_inputs(input_prefixes, bin_path)
+
+    with get_metrics().stage('finalize'):
+        index_parts.write(get_idx_path(output_prefix), dtype)
+
+
+def main():
+    args = parse_args()
+    with start_metrics(args.metrics_dir, 'merge_datasets'):
+        if args.virtual:
+            merge_virtual(
+                list_input_prefixes(args.input),
+                args.output_prefix,
+            )
+            return
+        merge(
+            list_input_prefixes(args.input),
+            args.output_prefix,
+            args.parallel_workers,
+        )
+
+
+if __name__ == '__main__':
+    main()
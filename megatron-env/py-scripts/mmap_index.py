@@ -0,0 +1,148 @@
+"""
+Vectorized reading and writing of the `.idx` files of Megatron-LM's
+indexed datasets, without depending on Megatron-LM.
+
+An index consists of a header, the size (in tokens) of each sequence,
+the pointer (byte offset into the `.bin` file) of each sequence, and
+the document index, i.e., the index of the sequence each document
+starts at. Instead of appending every size of every merged dataset to
+a Python list, we keep the merged datasets' arrays, compute pointers
+with a cumulative sum, and write each array with a single call.
+"""
+
+import os
+import struct
+from typing import List, NamedTuple, Sequence, Type
+
+import numpy as np
+
+INDEX_HEADER = b'MMIDIDX\x00\x00'
+INDEX_VERSION = 1
+# Magic, version, data type code, number of sequences, and number of
+# document indices.
+HEADER_BYTES = len(INDEX_HEADER) + 8 + 1 + 8 + 8
+
+# Codes of token data types, as in Megatron-LM's `DType`.
+DTYPE_CODES = {
+    np.uint8: 1,
+    np.int8: 2,
+    np.int16: 3,
+    np.int32: 4,
+    np.int64: 5,
+    np.float64: 6,
+    np.float32: 7,
+    np.uint16: 8,
+}
+CODE_DTYPES = {code: dtype for (dtype, code) in DTYPE_CODES.items()}
+
+
+def get_idx_path(path_prefix: str) -> str:
+    return path_prefix + '.idx'
+
+
+def get_bin_path(path_prefix: str) -> str:
+    return path_prefix + '.bin'
+
+
+class Index(NamedTuple):
+    """The arrays of an index; memory-mapped when read."""
+    dtype: Type[np.number]
+    sizes: np.ndarray
+    doc_idx: np.ndarray
+
+
+def read_index(index_file: str) -> Index:
+    """Return the data type, sequence sizes, and document index of the
+    index in `index_file`.
+
+    Raises:
+        ValueError: If `index_file` is not a supported index, such as
+            the index of a multimodal dataset.
+    """
+    with open(index_file, 'rb') as f:
+        header = f.read(HEADER_BYTES)
+    if len(header) != HEADER_BYTES or not header.startswith(INDEX_HEADER):
+        raise ValueError(f'{index_file} is not an indexed dataset index')
+    (version, code, num_sequences, num_doc_idx) = struct.unpack(
+        '<QBQQ',
+        header[len(INDEX_HEADER):],
+    )
+    if version != INDEX_VERSION:
+        raise ValueError(
+            f'unsupported index version {version} of {index_file}',
+        )
+
+    expected_bytes = HEADER_BYTES + 12 * num_sequences + 8 * num_doc_idx
+    if os.path.getsize(index_file) != expected_bytes:
+        raise ValueError(
+            f'unexpected size of {index_file}; multimodal datasets are '
+            f'not supported',
+        )
+
+    buffer = np.memmap(index_file, mode='r', order='C')
+    sizes = np.frombuffer(
+        buffer,
+        dtype=np.int32,
+        count=num_sequences,
+        offset=HEADER_BYTES,
+    )
+    doc_idx = np.frombuffer(
+        buffer,
+        dtype=np.int64,
+        count=num_doc_idx,
+        offset=HEADER_BYTES + 12 * num_sequences,
+    )
+    return Index(CODE_DTYPES[code], sizes, doc_idx)
+
+
+class IndexParts:
+    """Sizes and document indices of consecutive datasets that are
+    combined into a single index.
+    """
+
+    def __init__(self) -> None:
+        self.sizes: List[np.ndarray] = []
+        self.doc_idx: List[np.ndarray] = [np.zeros(1, dtype=np.int64)]
+        self.num_sequences = 0
+        self.num_doc_idx = 1
+
+    def append(self, sizes: Sequence[int], doc_idx: Sequence[int]) -> None:
+        """Append the `sizes` and `doc_idx` (starting with 0) of the next
+        dataset.
+        """
+        # Copy, so the source index does not need to stay mapped.
+        sizes = np.array(sizes, dtype=np.int32)
+        doc_idx = self.num_sequences + np.asarray(doc_idx[1:], dtype=np.int64)
+        self.sizes.append(sizes)
+        self.doc_idx.append(doc_idx)
+        self.num_sequences += len(sizes)
+        self.num_doc_idx += len(doc_idx)
+
+    def write(self, index_file: str, dtype: Type[np.number]) -> None:
+        """Write the combined index for tokens of type `dtype` to
+        `index_file`.
+        """
+        itemsize = np.dtype(dtype).itemsize
+        with open(index_file, 'wb') as f:
+            f.write(INDEX_HEADER)
+            f.write(struct.pack('<Q', INDEX_VERSION))
+            f.write(struct.pack('<B', DTYPE_CODES[np.dtype(dtype).type]))
+            f.write(struct.pack('<Q', self.num_sequences))
+            f.write(struct.pack('<Q', self.num_doc_idx))
+
+            for sizes in self.sizes:
+                f.write(sizes.tobytes(order='C'))
+
+            address = 0
+            for sizes in self.sizes:
+                if len(sizes) == 0:
+                    continue
+                ends = address + np.cumsum(sizes, dtype=np.int64) * itemsize
+                pointers = np.empty(len(sizes), dtype=np.int64)
+                pointers[0] = address
+                pointers[1:] = ends[:-1]
+                f.write(pointers.tobytes(order='C'))
+                address = int(ends[-1])
+
+            for doc_idx in self.doc_idx:
+                f.write(doc_idx.tobytes(order='C'))
@@ -0,0 +1,105 @@
+"""
+Helpers to run a preprocessing script for many input files in the same
+process, keeping its tokenizer and worker pool alive between files.
+
+Re-running the script per file (for example with `runpy.run_path`)
+re-imports all modules, rebuilds the tokenizer, and re-creates the
+script's worker pool, which dominates the runtime for many small input
+files.
+"""
+
+import functools
+import importlib.util
+import multiprocessing
+import multiprocessing.pool
+import os
+import sys
+from types import ModuleType
+from typing import Any, Callable
+
+
+def load_script_module(script_path: str, module_name: str) -> ModuleType:
+    """Import the script at `script_path` as a module without running
+    its `__main__` block.
+    """
+    spec = importlib.util.spec_from_file_location(
+        module_name,
+        os.path.abspath(script_path),
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+class PersistentPool:
+    """Proxy for a pool that ignores attempts to shut it down, so it can
+    be reused for the next input file.
+    """
+
+    def __init__(self, pool: multiprocessing.pool.Pool) -> None:
+        self._pool = pool
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._pool, name)
+
+    def __enter__(self) -> 'PersistentPool':
+        return self
+
+    def __exit__(self, *args) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def terminate(self) -> None:
+        pass
+
+    def join(self) -> None:
+        pass
+
+
+class PersistentMultiprocessing:
+    """Stand-in for the `multiprocessing` module of a preprocessing
+    script.
+
+    The first pool the script creates is kept alive and returned again
+    for every following pool creation. All other attributes are taken
+    from the real `multiprocessing` module.
+    """
+
+    def __init__(self) -> None:
+        self._pool = None
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(multiprocessing, name)
+
+    def Pool(self, *args, **kwargs) -> PersistentPool:
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(*args, **kwargs)
+        return PersistentPool(self._pool)
+
+    def shutdown(self) -> None:
+        """Actually close the kept-alive pool."""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def cache_first_result(func: Callable) -> Callable:
+    """Return a version of `func` that is only called once; afterwards,
+    the first result is returned regardless of arguments.
+
+    Used for tokenizer builders, whose arguments only differ in the
+    input and output paths between files.
+    """
+    results = []
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not results:
+            results.append(func(*args, **kwargs))
+        return results[0]
+
+    return wrapper
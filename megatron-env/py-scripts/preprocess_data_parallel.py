@@ -3,10 +3,22 @@
 
 from argparse import ArgumentParser
 import glob
-import math
 import os
 import runpy
 import sys
+import uuid
+
+import numpy as np
+
+from data_prep_metrics import start_metrics
+from jsonl_byte_ranges import ByteRangeOpener, is_splittable, list_byte_ranges
+from persistent_preprocessing import (
+    cache_first_result,
+    load_script_module,
+    PersistentMultiprocessing,
+)
+from work_planning import plan_work
+from work_queue import FileWorkQueue, get_stealing_order
 
 
 def parse_args():
@@ -19,9 +31,176 @@ def parse_args():
     parser.add_argument(
         '--dist-input-files-glob', help='Glob of input files to process')
     parser.add_argument('--output-prefix', required=True)
+    parser.add_argument(
+        '--dist-work-plan-file',
+        help=(
+            'JSON file to store the size-balanced assignment of input files '
+            'to processes in. If it already exists, the assignment is '
+            'loaded from it instead.'
+        ),
+    )
+    parser.add_argument(
+        '--dist-work-queue',
+        action='store_true',
+        help=(
+            'Instead of only processing its assigned input files, let each '
+            'process take the next unprocessed input file from a queue on '
+            'the shared filesystem until all files are processed.'
+        ),
+    )
+    parser.add_argument(
+        '--dist-work-queue-dir',
+        help=(
+            'Directory for the work queue\'s claim files. Must not be '
+            'reused between runs. Defaults to a directory in the output '
+            'directory that is specific to the SLURM job and its restart '
+            'count, or unique for a single process outside of SLURM.'
+        ),
+    )
+    parser.add_argument(
+        '--dist-persistent-worker',
+        action='store_true',
+        help=(
+            'Load the preprocessing script, its tokenizer, and its worker '
+            'pool only once and process all input files with them, instead '
+            'of re-running the script for each input file.'
+        ),
+    )
+    parser.add_argument(
+        '--dist-split-bytes',
+        type=int,
+        help=(
+            'Split uncompressed JSONL input files larger than this many '
+            'bytes into newline-aligned byte ranges that are processed '
+            'independently and written as separate outputs. Requires '
+            '`--dist-persistent-worker`.'
+        ),
+    )
+    parser.add_argument(
+        '--dist-metrics-dir',
+        help=(
+            'Directory to write throughput and resource metrics of each '
+            'process to.'
+        ),
+    )
+    parser.add_argument(
+        '--dist-metrics-interval',
+        type=float,
+        default=30.0,
+        help='Number of seconds between metrics samples.',
+    )
     return parser.parse_known_args()
 
 
+def count_outputs(output_prefix):
+    """Return the number of documents, tokens, and bytes in the indexed
+    datasets written for `output_prefix`, summed over all output keys.
+    """
+    counts = {'documents': 0, 'tokens': 0, 'output_bytes': 0}
+    for path in glob.glob(f'{output_prefix}_*'):
+        counts['output_bytes'] += os.path.getsize(path)
+        if not path.endswith('.idx'):
+            continue
+        # Index header: magic (9 bytes), version (8), dtype code (1),
+        # number of sequences (8), and number of document indices (8),
+        # followed by the sequence sizes.
+        header = np.fromfile(path, dtype=np.uint8, count=34)
+        num_sequences, num_doc_indices = header[18:34].view(np.int64)
+        sizes = np.fromfile(
+            path,
+            dtype=np.int32,
+            count=num_sequences,
+            offset=34,
+        )
+        counts['documents'] += int(num_doc_indices) - 1
+        counts['tokens'] += int(sizes.sum(dtype=np.int64))
+    return counts
+
+
+def get_output_prefix(output_dir, index, num_items):
+    """Return the output prefix of the `index`th of `num_items` units of
+    work.
+    """
+    return os.path.join(
+        output_dir,
+        f'{os.path.basename(output_dir)}_{index:0{len(str(num_items))}}',
+    )
+
+
+def has_outputs(output_prefix):
+    """Return whether complete indexed datasets were written for
+    `output_prefix`, i.e., an `.idx` file (written last) and its `.bin`
+    file for each output key.
+    """
+    index_paths = glob.glob(f'{output_prefix}_*.idx')
+    return bool(index_paths) and all(
+        os.path.isfile(path[:-len('.idx')] + '.bin')
+        for path in index_paths
+    )
+
+
+def check_outputs(output_dir, indices, num_items):
+    """Exit with an error if any of the units of work `indices` has no
+    outputs.
+    """
+    missing = [
+        i for i in indices
+        if not has_outputs(get_output_prefix(output_dir, i, num_items))
+    ]
+    if missing:
+        print(
+            f'Error: no outputs were written for {len(missing)} inputs, '
+            f'such as input {missing[0]}; the processes responsible for '
+            f'them may have died.'
+        )
+        sys.exit(1)
+
+
+def get_work_queue_dir(args, world_size):
+    """Return the directory of the work queue of this run."""
+    if args.dist_work_queue_dir is not None:
+        return args.dist_work_queue_dir
+
+    job_id = os.getenv('SLURM_JOB_ID')
+    if job_id is not None:
+        # A requeued job keeps its ID, but increases its restart count.
+        run_id = f'{job_id}-{os.getenv("SLURM_RESTART_COUNT", "0")}'
+    else:
+        assert world_size == 1, (
+            'outside of SLURM, `--dist-work-queue-dir` needs to be given '
+            'with a directory that is unique to this run'
+        )
+        run_id = f'local-{uuid.uuid4().hex}'
+    return os.path.join(args.output_prefix, '.work-queue', run_id)
+
+
+def patch_preprocessing_module(module):
+    """Make the loaded `tools/preprocess_data.py` reuse its tokenizer and
+    worker pool between input files.
+    """
+    persistent_multiprocessing = PersistentMultiprocessing()
+    module.multiprocessing = persistent_multiprocessing
+    # Allows opening only a byte range of the input file.
+    module.open = ByteRangeOpener()
+    module.build_tokenizer = cache_first_result(module.build_tokenizer)
+    return persistent_multiprocessing
+
+
+def process_file_persistent(module):
+    """Process the input file given in `sys.argv` with the loaded
+    `tools/preprocess_data.py` inside this process.
+    """
+    args = module.get_args()
+    assert args.partitions == 1 and not args.split_sentences, (
+        '`--dist-persistent-worker` does not support `--partitions` or '
+        '`--split-sentences`'
+    )
+    # `main` would start a new process per partition; instead, process
+    # the single partition here so the worker pool is reused.
+    partition = module.Partition(args, args.workers)
+    partition.process_json_file((args.input, args.output_prefix))
+
+
 def main():
     args, passthrough_args = parse_args()
     assert os.path.isfile(args.preprocessing_script)
@@ -29,6 +208,9 @@ def main():
         'need either `--dist-input-files` or `--dist-input-files-glob` '
         'to be specified'
     )
+    assert args.dist_split_bytes is None or args.dist_persistent_worker, (
+        '`--dist-split-bytes` requires `--dist-persistent-worker`'
+    )
 
     world_size = int(os.environ['WORLD_SIZE'])
     rank = int(os.environ['RANK'])
@@ -41,9 +223,38 @@ def main():
     if args.dist_input_files_glob:
         input_files.extend(sorted(glob.glob(args.dist_input_files_glob)))
 
-    shard_size = math.ceil(len(input_files) / world_size)
-    shard_offset = shard_size * rank
-    input_files_shard = input_files[shard_offset:shard_offset + shard_size]
+    # Units of work are whole files or, if requested, byte ranges of
+    # large files.
+    input_ranges = list_byte_ranges(input_files, args.dist_split_bytes)
+    input_range_sizes = [
+        input_range.end - input_range.start
+        for input_range in input_ranges
+    ]
+
+    # Balance the processes by the size of their units of work.
+    assignment = plan_work(
+        [str(input_range) for input_range in input_ranges],
+        input_range_sizes,
+        world_size,
+        plan_file=args.dist_work_plan_file,
+        save=rank == 0,
+    )
+    if args.dist_work_queue:
+        work_queue = FileWorkQueue(get_work_queue_dir(args, world_size), rank)
+        input_range_indices = work_queue.claim(
+            get_stealing_order(assignment, input_range_sizes, rank),
+        )
+    else:
+        input_range_indices = assignment[rank]
+
+    if args.dist_persistent_worker:
+        preprocessing_module = load_script_module(
+            args.preprocessing_script,
+            os.path.splitext(os.path.basename(args.preprocessing_script))[0],
+        )
+        persistent_multiprocessing = patch_preprocessing_module(
+            preprocessing_module,
+        )
 
     sys.argv = (
         [args.preprocessing_script]
@@ -51,20 +262,64 @@ def main():
         + ['--input', '--output-prefix']
     )
 
-    for (i, input_file) in enumerate(input_files_shard, shard_offset):
-        print('Processing', input_file)
-        output_prefix = os.path.join(
+    processed_indices = []
+    all_finished = False
+    try:
+        with start_metrics(
+                args.dist_metrics_dir,
+                'preprocess_data',
+                rank=rank,
+                interval=args.dist_metrics_interval,
+        ) as metrics:
+            for i in input_range_indices:
+                input_range = input_ranges[i]
+                print('Processing', input_range)
+                output_prefix = get_output_prefix(
+                    args.output_prefix,
+                    i,
+                    len(input_ranges),
+                )
+                sys.argv = sys.argv[:-2] + [
+                    f'--input={input_range.path}',
+                    f'--output-prefix={output_prefix}',
+                ]
+                with metrics.stage('process'):
+                    if args.dist_persistent_worker:
+                        if (
+                                args.dist_split_bytes is not None
+                                and is_splittable(input_range.path)
+                        ):
+                            preprocessing_module.open.byte_range = input_range
+                        else:
+                            preprocessing_module.open.byte_range = None
+                        process_file_persistent(preprocessing_module)
+                    else:
+                        runpy.run_path(
+                            args.preprocessing_script,
+                            run_name='__main__',
+                        )
+                if metrics.enabled:
+                    metrics.add(
+                        input_bytes=input_range.end - input_range.start,
+                        **count_outputs(output_prefix),
+                    )
+                processed_indices.append(i)
+
+            if args.dist_persistent_worker:
+                persistent_multiprocessing.shutdown()
+    finally:
+        # Also when failing, so that the other processes notice the items
+        # we claimed but did not process.
+        if args.dist_work_queue:
+            all_finished = work_queue.mark_finished(world_size)
+
+    check_outputs(args.output_prefix, processed_indices, len(input_ranges))
+    if all_finished:
+        check_outputs(
             args.output_prefix,
-            (
-                f'{os.path.basename(args.output_prefix)}'
-                f'_{i:0{len(str(len(input_files)))}}'
-            ),
+            range(len(input_ranges)),
+            len(input_ranges),
         )
-        sys.argv = sys.argv[:-2] + [
-            f'--input={input_file}',
-            f'--output-prefix={output_prefix}',
-        ]
-        runpy.run_path(args.preprocessing_script, run_name='__main__')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,111 @@
+"""
+Virtual merges of memory-mapped indexed datasets.
+
+Instead of concatenating the `.bin` files of the merged datasets, a
+virtual merge only writes the merged `.idx` file and a small manifest
+(`<prefix>.manifest.json`) that lists the original `.bin` files and
+their offsets in the (virtual) concatenation. Pointers in the merged
+index refer to these virtual offsets.
+
+Training loads a virtual merge with `virtual_datasets.py`, which reads
+each sequence from the original file. This module only needs NumPy, so
+merging does not require the training framework.
+"""
+
+import json
+import os
+from typing import Dict, List, Optional, Sequence
+
+import numpy as np
+
+MANIFEST_VERSION = 1
+
+
+def manifest_path(path_prefix: str) -> str:
+    return path_prefix + '.manifest.json'
+
+
+def write_manifest(
+        path_prefix: str,
+        bin_paths: Sequence[str],
+        bin_sizes: Sequence[int],
+) -> None:
+    """Write the manifest of a virtual merge of `bin_paths` (with sizes
+    `bin_sizes` in bytes) for the merged index at `path_prefix`.
+
+    Paths are stored relative to the manifest, so the merged dataset can
+    be moved together with its inputs.
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(path_prefix))
+    files = []
+    offset = 0
+    for (bin_path, num_bytes) in zip(bin_paths, bin_sizes):
+        files.append({
+            'path': os.path.relpath(os.path.abspath(bin_path), manifest_dir),
+            'offset': offset,
+            'bytes': num_bytes,
+        })
+        offset += num_bytes
+
+    with open(manifest_path(path_prefix), 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'files': files}, f, indent=1)
+
+
+def read_manifest(path_prefix: str) -> List[Dict]:
+    """Return the files of the virtual merge at `path_prefix`."""
+    with open(manifest_path(path_prefix), 'r') as f:
+        manifest = json.load(f)
+    if manifest['version'] != MANIFEST_VERSION:
+        raise ValueError(
+            f'unsupported virtual merge manifest version '
+            f'{manifest["version"]} in {manifest_path(path_prefix)}',
+        )
+    return manifest['files']
+
+
+class VirtualBinFiles:
+    """The `.bin` files of a virtual merge, read as if concatenated.
+
+    Files are memory-mapped on first access.
+    """
+
+    def __init__(self, path_prefix: str) -> None:
+        files = read_manifest(path_prefix)
+        manifest_dir = os.path.dirname(os.path.abspath(path_prefix))
+        self.paths = [os.path.join(manifest_dir, f['path']) for f in files]
+        self.offsets = np.array(
+            [f['offset'] for f in files]
+            + [sum(f['bytes'] for f in files)],
+            dtype=np.int64,
+        )
+        self._buffers: List[Optional[np.memmap]] = [None] * len(files)
+
+    def _buffer(self, file_index: int) -> np.memmap:
+        if self._buffers[file_index] is None:
+            self._buffers[file_index] = np.memmap(
+                self.paths[file_index],
+                mode='r',
+                order='C',
+            )
+        return self._buffers[file_index]
+
+    def read(self, dtype: np.dtype, count: int, offset: int) -> np.ndarray:
+        """Return `count` items of type `dtype` starting at byte `offset`
+        of the concatenation.
+
+        The items have to lie in a single file, which holds for every
+        sequence of the merged index.
+        """
+        if count == 0:
+            # Empty files cannot be memory-mapped.
+            return np.empty(0, dtype=dtype)
+        file_index = int(
+            np.searchsorted(self.offsets, offset, side='right'),
+        ) - 1
+        file_index = min(file_index, len(self.paths) - 1)
+        return np.frombuffer(
+            self._buffer(file_index),
+            dtype=dtype,
+            count=count,
+            offset=offset - int(self.offsets[file_index]),
+        )
@@ -0,0 +1,98 @@
+"""
+A work queue on a shared filesystem, so that processes can dynamically
+take over work from slower processes.
+
+Items are claimed by exclusively creating a claim file per item, which
+is atomic on POSIX (including parallel) filesystems. No external
+service is required. Claims are never released, so a queue directory
+must not be reused between runs.
+"""
+
+import os
+import socket
+from typing import Iterator, List, Sequence
+
+
+class FileWorkQueue:
+    """Claim items by index using exclusively created files in
+    `queue_dir`.
+    """
+
+    def __init__(self, queue_dir: str, rank: int) -> None:
+        self.queue_dir = queue_dir
+        self.rank = rank
+        os.makedirs(queue_dir, exist_ok=True)
+
+    def _claim_path(self, item: int) -> str:
+        return os.path.join(self.queue_dir, f'{item}.claim')
+
+    def try_claim(self, item: int) -> bool:
+        """Return whether we successfully claimed `item`.
+
+        Exactly one process succeeds in claiming an item.
+        """
+        try:
+            fd = os.open(
+                self._claim_path(item),
+                os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                0o644,
+            )
+        except FileExistsError:
+            return False
+
+        with os.fdopen(fd, 'w') as f:
+            f.write(f'{self.rank} {socket.gethostname()} {os.getpid()}\n')
+        return True
+
+    def claim(self, items: Sequence[int]) -> Iterator[int]:
+        """Yield those of `items` (in order) that we could claim."""
+        for item in items:
+            if self.try_claim(item):
+                yield item
+
+    def mark_finished(self, world_size: int) -> bool:
+        """Record that this process will not claim any more items, either
+        because none are left or because it failed.
+
+        Returns:
+            Whether all `world_size` processes have finished, so that no
+            claimed item is still being processed. May be true for more
+            than one process. Processes that are killed never finish.
+        """
+        finished_dir = os.path.join(self.queue_dir, 'finished')
+        os.makedirs(finished_dir, exist_ok=True)
+        with open(os.path.join(finished_dir, str(self.rank)), 'w'):
+            pass
+        return len(os.listdir(finished_dir)) >= world_size
+
+
+def get_stealing_order(
+        assignment: Sequence[Sequence[int]],
+        weights: Sequence[int],
+        rank: int,
+) -> List[int]:
+    """Return the order in which `rank` should try to claim items.
+
+    A process first works on its own items (largest first), then steals
+    the remaining items of other processes, starting with the ones they
+    would process last. This keeps contention on claims low while
+    letting fast processes take over the tail of slow ones.
+
+    Args:
+        assignment (Sequence[Sequence[int]]): For each process, the items
+            initially assigned to it.
+        weights (Sequence[int]): Weight (such as the size) of each item.
+        rank (int): Index of this process.
+
+    Returns:
+        The indices of all items in the order to try to claim them.
+    """
+    def by_weight(items):
+        return sorted(items, key=lambda i: (-weights[i], i))
+
+    order = by_weight(assignment[rank])
+    num_bins = len(assignment)
+    for offset in range(1, num_bins):
+        other_rank = (rank + offset) % num_bins
+        order.extend(reversed(by_weight(assignment[other_rank])))
+    return order
@@ -4,6 +4,12 @@
 
 set -euo pipefail
 
+# Do not use these variables; they may be overwritten. Instead, use
+# `get_curr_file` or `get_curr_dir` after sourcing `get_curr_file.sh`.
+_curr_file="${BASH_SOURCE[0]:-${(%):-%x}}"
+_curr_dir="$(dirname "$_curr_file")"
+source "$_curr_dir"/../../global-scripts/get_curr_file.sh "$_curr_file"
+
 _activated_container="${_ACTIVATED_CONTAINER:-0}"
 if ! ((_activated_container)); then
     echo 'Container has not been activated; please use' \
@@ -132,6 +138,7 @@ if ((DO_COORD_CHECK)); then
 
 else
     python -u \
+        "$(get_curr_dir)"/../py-scripts/run_with_virtual_datasets.py \
         "$nemo_repo_dir"/examples/nlp/language_modeling/megatron_gpt_pretraining.py  \
         --config-path="$TRAIN_CONFIG_YAML_DIR" \
         --config-name="$TRAIN_CONFIG_YAML_NAME" \
@@ -181,6 +188,7 @@ fi
 
 # Same as above, but using SentencePiece tokenizer.
 # python -u \
+#     "$(get_curr_dir)"/../py-scripts/run_with_virtual_datasets.py \
 #     "$nemo_repo_dir"/examples/nlp/language_modeling/megatron_gpt_pretraining.py  \
 #     --config-path="$TRAIN_CONFIG_YAML_DIR" \
 #     --config-name="$TRAIN_CONFIG_YAML_NAME" \
@@ -218,3 +226,5 @@ fi
 #     model.shape_file="$SHAPE_YAML_FILE" \
 #     exp_manager.name="$exp_name" \
 #     exp_manager.exp_dir="$MODEL_CHECKPOINT_DIR"
+
+pop_curr_file
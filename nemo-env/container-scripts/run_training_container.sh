@@ -4,6 +4,12 @@
 
 set -euo pipefail
 
+# Do not use these variables; they may be overwritten. Instead, use
+# `get_curr_file` or `get_curr_dir` after sourcing `get_curr_file.sh`.
+_curr_file="${BASH_SOURCE[0]:-${(%):-%x}}"
+_curr_dir="$(dirname "$_curr_file")"
+source "$_curr_dir"/../../global-scripts/get_curr_file.sh "$_curr_file"
+
 _activated_container="${_ACTIVATED_CONTAINER:-0}"
 if ! ((_activated_container)); then
     echo 'Container has not been activated; please use' \
@@ -18,6 +24,9 @@ PER_SPLIT_NUM_WORKERS="${PER_SPLIT_NUM_WORKERS:-0}"
 
 nemo_repo_dir="$ext_repo_dir"/NeMo
 
+# Training is started with `run_with_virtual_datasets.py`, so that
+# virtual merges (`merge_datasets.py --virtual`) can be used as data.
+#
 # Below uses the NeMo Llama-2 pretraining example configuration,
 # with major modifications being
 # - use variable config values,
@@ -34,6 +43,7 @@ nemo_repo_dir="$ext_repo_dir"/NeMo
 # - save checkpoints to SCRATCH.
 
 python -u \
+    "$(get_curr_dir)"/../py-scripts/run_with_virtual_datasets.py \
     "$nemo_repo_dir"/examples/nlp/language_modeling/megatron_gpt_pretraining.py  \
     --config-path="$TRAIN_CONFIG_YAML_DIR" \
     --config-name="$TRAIN_CONFIG_YAML_NAME" \
@@ -67,6 +77,7 @@ python -u \
 
 # Same as above, but using SentencePiece tokenizer.
 # python -u \
+#     "$(get_curr_dir)"/../py-scripts/run_with_virtual_datasets.py \
 #     "$nemo_repo_dir"/examples/nlp/language_modeling/megatron_gpt_pretraining.py  \
 #     --config-path="$TRAIN_CONFIG_YAML_DIR" \
 #     --config-name="$TRAIN_CONFIG_YAML_NAME" \
@@ -93,3 +104,5 @@ python -u \
 #     +model.data.data_prefix=\{train:\[1.0,"$TRAIN_DATA_PREFIX"\],validation:\[1.0,"$EVAL_DATA_PREFIX"\]\} \
 #     model.data.num_workers="$PER_SPLIT_NUM_WORKERS" \
 #     exp_manager.exp_dir="$MODEL_CHECKPOINT_DIR"
+
+pop_curr_file
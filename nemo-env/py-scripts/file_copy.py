@@ -0,0 +1,226 @@
+"""
+Append whole files to an open output file inside the kernel.
+
+`shutil.copyfileobj` moves every byte through Python buffers. Instead,
+we use `os.copy_file_range`, which avoids user space entirely and lets
+the filesystem share extents (reflink) or copy server-side where it
+supports that. If it is unavailable or not supported between the two
+files, we fall back to `os.sendfile` and finally to copying with a
+large buffer.
+"""
+
+import errno
+import os
+import threading
+import time
+from typing import BinaryIO, Dict, Optional, Tuple
+
+# Errors that mean a copy method is not supported for the given files.
+_UNSUPPORTED_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EINVAL,
+    errno.EBADF,
+}
+
+# Maximum number of bytes copied by a single system call.
+_MAX_CHUNK_BYTES = 1 << 30
+BUFFER_BYTES = 64 << 20
+
+
+def _copy_file_range(
+        src_fd: int,
+        src_offset: int,
+        dst_fd: int,
+        dst_offset: int,
+        size: int,
+) -> int:
+    copied = 0
+    while copied < size:
+        num_bytes = os.copy_file_range(
+            src_fd,
+            dst_fd,
+            min(size - copied, _MAX_CHUNK_BYTES),
+            src_offset + copied,
+            dst_offset + copied,
+        )
+        if num_bytes == 0:
+            break
+        copied += num_bytes
+    return copied
+
+
+def _sendfile(
+        src_fd: int,
+        src_offset: int,
+        dst_fd: int,
+        dst_offset: int,
+        size: int,
+) -> int:
+    # `sendfile` writes at the output's file position.
+    os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+    copied = 0
+    while copied < size:
+        num_bytes = os.sendfile(
+            dst_fd,
+            src_fd,
+            src_offset + copied,
+            min(size - copied, _MAX_CHUNK_BYTES),
+        )
+        if num_bytes == 0:
+            break
+        copied += num_bytes
+    return copied
+
+
+def _buffered_copy(
+        src_fd: int,
+        src_offset: int,
+        dst_fd: int,
+        dst_offset: int,
+        size: int,
+) -> int:
+    buffer = memoryview(bytearray(min(BUFFER_BYTES, max(size, 1))))
+    copied = 0
+    while copied < size:
+        num_read = os.preadv(
+            src_fd,
+            [buffer[:min(size - copied, len(buffer))]],
+            src_offset + copied,
+        )
+        if num_read == 0:
+            break
+        written = 0
+        while written < num_read:
+            written += os.pwrite(
+                dst_fd,
+                buffer[written:num_read],
+                dst_offset + copied + written,
+            )
+        copied += num_read
+    return copied
+
+
+_COPY_METHODS = [
+    ('copy_file_range', _copy_file_range),
+    ('sendfile', _sendfile),
+    ('buffered', _buffered_copy),
+]
+if not hasattr(os, 'copy_file_range'):
+    _COPY_METHODS.pop(0)
+
+
+def copy_file(
+        src_path: str,
+        dst_fd: int,
+        dst_offset: int,
+) -> Tuple[int, str]:
+    """Copy the contents of `src_path` into the file descriptor
+    `dst_fd` starting at `dst_offset`.
+
+    The position of `dst_fd` is undefined afterwards, so concurrent
+    copies need their own file descriptors.
+
+    Returns:
+        The number of bytes copied and the name of the method that
+        finished copying them.
+    """
+    with open(src_path, 'rb') as src:
+        src_fd = src.fileno()
+        size = os.fstat(src_fd).st_size
+
+        copied = 0
+        method = None
+        for (name, copy) in _COPY_METHODS:
+            try:
+                copied += copy(
+                    src_fd,
+                    copied,
+                    dst_fd,
+                    dst_offset + copied,
+                    size - copied,
+                )
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED_ERRNOS or name == 'buffered':
+                    raise
+            # A method may also stop early (copying 0 bytes) on
+            # filesystems that do not support it.
+            if copied >= size:
+                method = name
+                break
+
+    if copied != size:
+        raise OSError(
+            f'could only copy {copied} of {size} bytes from {src_path}',
+        )
+    return (copied, method)
+
+
+def append_file(src_path: str, dst_file: BinaryIO) -> Tuple[int, str]:
+    """Append the contents of `src_path` to `dst_file` at its current
+    position, leaving the position after the appended data.
+
+    Returns:
+        The number of bytes copied and the name of the method that
+        finished copying them.
+    """
+    dst_file.flush()
+    dst_offset = dst_file.tell()
+    (copied, method) = copy_file(src_path, dst_file.fileno(), dst_offset)
+    # Update the file object's (possibly cached) position.
+    dst_file.seek(dst_offset + copied)
+    return (copied, method)
+
+
+class CopyStats:
+    """Throughput of file copies, per copy method. Thread-safe."""
+
+    def __init__(self) -> None:
+        self.num_bytes = 0
+        self.seconds = 0.0
+        self.methods: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def _record(self, num_bytes: int, seconds: float, method: str) -> None:
+        with self._lock:
+            self.num_bytes += num_bytes
+            self.seconds += seconds
+            self.methods[method] = self.methods.get(method, 0) + 1
+
+    def copy_file(self, src_path: str, dst_fd: int, dst_offset: int) -> int:
+        """Like `copy_file`, but record the copy; returns the number of
+        bytes copied.
+        """
+        start = time.perf_counter()
+        (num_bytes, method) = copy_file(src_path, dst_fd, dst_offset)
+        self._record(num_bytes, time.perf_counter() - start, method)
+        return num_bytes
+
+    def append_file(self, src_path: str, dst_file: BinaryIO) -> int:
+        """Like `append_file`, but record the copy; returns the number
+        of bytes copied.
+        """
+        start = time.perf_counter()
+        (num_bytes, method) = append_file(src_path, dst_file)
+        self._record(num_bytes, time.perf_counter() - start, method)
+        return num_bytes
+
+    def report(self, wall_seconds: Optional[float] = None) -> str:
+        """Return a summary of the copies.
+
+        For concurrent copies, pass the `wall_seconds` they took, since
+        the recorded time is summed over all copies.
+        """
+        if wall_seconds is None:
+            wall_seconds = self.seconds
+        seconds = max(wall_seconds, 1e-9)
+        methods = ', '.join(
+            f'{method}: {num_files} files'
+            for (method, num_files) in sorted(self.methods.items())
+        )
+        return (
+            f'Copied {self.num_bytes / 1e9:.3f} GB in {wall_seconds:.1f} s '
+            f'({self.num_bytes / seconds / 1e9:.3f} GB/s; {methods})'
+        )
@@ -0,0 +1,180 @@
+"""
+Split large JSONL files into newline-aligned byte ranges that can be
+processed independently, so that a single huge file does not have to
+be processed by a single process.
+
+A byte range `[start, end)` contains exactly those lines whose first
+byte lies in it. To read it, we seek to `start`, skip to the beginning
+of the next line, and read until a line starts at or after `end`.
+"""
+
+import json
+import math
+import os
+from typing import Dict, Iterator, List, NamedTuple, Optional, Sequence
+
+from data_prep_metrics import get_metrics
+
+
+class ByteRange(NamedTuple):
+    path: str
+    start: int
+    end: int
+
+    def __str__(self) -> str:
+        return f'{self.path}:{self.start}-{self.end}'
+
+
+def is_splittable(path: str) -> bool:
+    """Return whether `path` is an uncompressed JSON lines file."""
+    return path.endswith(('.json', '.jsonl'))
+
+
+def list_byte_ranges(
+        paths: Sequence[str],
+        max_range_bytes: Optional[int] = None,
+) -> List[ByteRange]:
+    """Split `paths` into byte ranges of at most `max_range_bytes`.
+
+    Files that are not larger than `max_range_bytes` or that cannot be
+    split (such as compressed files) result in a single byte range
+    covering the whole file.
+
+    Args:
+        paths (Sequence[str]): Files to split.
+        max_range_bytes (Optional[int]): Maximum size of a byte range.
+            If not given, no file is split.
+
+    Returns:
+        Byte ranges of all files, in the order of `paths` and then by
+        offset.
+    """
+    byte_ranges = []
+    for path in paths:
+        size = os.path.getsize(path)
+        if (
+                max_range_bytes is None
+                or size <= max_range_bytes
+                or not is_splittable(path)
+        ):
+            byte_ranges.append(ByteRange(path, 0, size))
+            continue
+
+        # Use evenly sized ranges instead of a small remainder at the
+        # end.
+        num_ranges = math.ceil(size / max_range_bytes)
+        offsets = [size * i // num_ranges for i in range(num_ranges + 1)]
+        byte_ranges.extend(
+            ByteRange(path, start, end)
+            for (start, end) in zip(offsets[:-1], offsets[1:])
+        )
+    return byte_ranges
+
+
+class ByteRangeTextFile:
+    """Read-only text file over the lines of a byte range of a file."""
+
+    def __init__(self, byte_range: ByteRange, encoding: str = 'utf-8') -> None:
+        self.byte_range = byte_range
+        self.encoding = encoding
+        self._file = open(byte_range.path, 'rb')
+        self._position = byte_range.start
+        if byte_range.start > 0:
+            # Skip the line that started before our range, but do not
+            # skip a line starting exactly at `start`.
+            self._file.seek(byte_range.start - 1)
+            self._position = byte_range.start - 1 + len(self._file.readline())
+
+    def __iter__(self) -> Iterator[str]:
+        while self._position < self.byte_range.end:
+            line = self._file.readline()
+            if not line:
+                break
+            self._position += len(line)
+            yield line.decode(self.encoding)
+
+    @property
+    def position(self) -> int:
+        """Offset in the file up to which lines have been read."""
+        return self._position
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self) -> 'ByteRangeTextFile':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+
+class ByteRangeOpener:
+    """Stand-in for `open` that opens the currently set byte range
+    instead of the whole file.
+
+    Meant to be patched into a preprocessing script that opens its input
+    file with `open`.
+    """
+
+    def __init__(self) -> None:
+        self.byte_range = None
+
+    def __call__(self, file, *args, **kwargs):
+        if self.byte_range is not None and file == self.byte_range.path:
+            return ByteRangeTextFile(
+                self.byte_range,
+                encoding=kwargs.get('encoding') or 'utf-8',
+            )
+        return open(file, *args, **kwargs)
+
+
+class JsonlByteRangeDataset:
+    """Iterate over the JSON objects in the given byte ranges.
+
+    Supports the parts of the HuggingFace `IterableDataset` interface we
+    use, i.e., iterating over examples and `iter(batch_size)`.
+    """
+
+    def __init__(
+            self,
+            byte_ranges: Sequence[ByteRange],
+            columns: Sequence[str] = ('text',),
+    ) -> None:
+        # Units of work, i.e., the byte ranges to read.
+        self.units = list(byte_ranges)
+        self.columns = list(columns)
+
+    def _iter_byte_range(self, byte_range: ByteRange) -> Iterator[Dict]:
+        metrics = get_metrics()
+        with ByteRangeTextFile(byte_range) as f:
+            position = f.position
+            for line in f:
+                metrics.add(input_bytes=f.position - position)
+                position = f.position
+                if not line.strip():
+                    continue
+                sample = json.loads(line)
+                yield {column: sample[column] for column in self.columns}
+
+    def __iter__(self) -> Iterator[Dict]:
+        for byte_range in self.units:
+            yield from self._iter_byte_range(byte_range)
+
+    def iter(self, batch_size: int) -> Iterator[Dict[str, List]]:
+        """Yield dictionaries of up to `batch_size` values per column.
+
+        Batches do not cross byte range boundaries.
+        """
+        for byte_range in self.units:
+            batch = {column: [] for column in self.columns}
+            num_samples = 0
+            for sample in self._iter_byte_range(byte_range):
+                for column in self.columns:
+                    batch[column].append(sample[column])
+                num_samples += 1
+                if num_samples == batch_size:
+                    yield batch
+                    batch = {column: [] for column in self.columns}
+                    num_samples = 0
+            if num_samples > 0:
+                yield batch
@@ -7,7 +7,10 @@ import os
 import sys
 import json
 import argparse
-import shutil
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+import numpy as np
 
 from nemo.collections.nlp.data.language_modeling.megatron.indexed_dataset import (
     MMapIndexedDataset,
@@ -16,21 +19,331 @@ from nemo.collections.nlp.data.language_modeling.megatron.indexed_dataset import
     index_file_path as get_idx_path,
 )
 
+from data_prep_metrics import get_metrics, start_metrics
+from file_copy import CopyStats
+from mmap_index import IndexParts
+from tree_reduction import (
+    DEFAULT_TIMEOUT,
+    get_chunk,
+    get_rank_and_world_size,
+    get_run_id,
+    mark_done,
+    remove_work_dir,
+    tree_reduce,
+    wait_for,
+)
+from virtual_merge import write_manifest
+
 
 class MMapIndexedDatasetBuilder(_MMapIndexedDatasetBuilder):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Indices of merged files, kept as arrays.
+        self._index_parts = IndexParts()
+        self._copy_stats = CopyStats()
+
     def merge_file_(self, another_file):
+        metrics = get_metrics()
+
         # Concatenate index
-        index = MMapIndexedDataset.Index(get_idx_path(another_file))
-        assert index.dtype == self._dtype
+        with metrics.stage('merge_index'):
+            index = MMapIndexedDataset.Index(get_idx_path(another_file))
+            assert index.dtype == self._dtype
 
-        offset = len(self._sizes)
-        for size in index.sizes:
-            self._sizes.append(size)
-        self._doc_idx.extend((offset + index.doc_idx)[1:])
+            self._flush_items()
+            self._index_parts.append(index.sizes, index.doc_idx)
 
         # Concatenate data
-        with open(get_bin_path(another_file), 'rb') as f:
-            shutil.copyfileobj(f, self._data_file)
+        with metrics.stage('copy_data'):
+            num_bytes = self._copy_stats.append_file(
+                get_bin_path(another_file),
+                self._data_file,
+            )
+        metrics.add(
+            documents=len(index.doc_idx) - 1,
+            tokens=int(index.sizes.sum()),
+            input_bytes=num_bytes,
+            output_bytes=num_bytes,
+        )
+
+    def _flush_items(self):
+        # Keep items added with `add_item` in order with merged files.
+        if self._sizes or len(self._doc_idx) > 1:
+            self._index_parts.append(self._sizes, self._doc_idx)
+            self._sizes = []
+            self._doc_idx = [0]
+
+    def finalize(self, index_file):
+        self._data_file.close()
+        self._flush_items()
+        self._index_parts.write(index_file, self._dtype)
+        print(self._copy_stats.report())
+
+
+def read_indices(input_prefixes):
+    """Return the combined indices of the indexed datasets at
+    `input_prefixes`, their token data type, and the sizes of their
+    `.bin` files.
+    """
+    metrics = get_metrics()
+    with metrics.stage("merge_index"):
+        index_parts = IndexParts()
+        dtype = None
+        bin_sizes = []
+        for prefix in input_prefixes:
+            index = MMapIndexedDataset.Index(get_idx_path(prefix))
+            if dtype is None:
+                dtype = index.dtype
+            assert index.dtype == dtype
+            index_parts.append(index.sizes, index.doc_idx)
+
+            # Pointers into the merged data are derived from the
+            # sequence sizes, so the data has to match them exactly.
+            bin_size = os.path.getsize(get_bin_path(prefix))
+            num_tokens = int(index.sizes.sum(dtype=np.int64))
+            assert bin_size == num_tokens * np.dtype(dtype).itemsize, (
+                f"ERROR: size of {get_bin_path(prefix)} does not match "
+                f"its index"
+            )
+            bin_sizes.append(bin_size)
+            metrics.add(
+                documents=len(index.doc_idx) - 1,
+                tokens=num_tokens,
+            )
+            del index
+    return index_parts, dtype, bin_sizes
+
+
+def merge_virtual(input_prefixes, output_prefix):
+    """Merge the indexed datasets at `input_prefixes` into
+    `output_prefix` without copying their data.
+
+    Only the merged `.idx` and a manifest referencing the inputs' `.bin`
+    files are written; training started with
+    `run_with_virtual_datasets.py` loads the result. The inputs must not
+    be removed or changed afterwards.
+    """
+    index_parts, dtype, bin_sizes = read_indices(input_prefixes)
+    with get_metrics().stage("finalize"):
+        index_parts.write(get_idx_path(output_prefix), dtype)
+        write_manifest(
+            output_prefix,
+            [get_bin_path(prefix) for prefix in input_prefixes],
+            bin_sizes,
+        )
+
+
+def copy_inputs(input_prefixes, bin_path, bin_offsets, num_workers):
+    """Copy the data of the indexed datasets at `input_prefixes` into
+    their regions starting at `bin_offsets` of the already sized
+    `bin_path`, with `num_workers` threads.
+    """
+    metrics = get_metrics()
+    copy_stats = CopyStats()
+
+    def copy_input(i):
+        with metrics.stage("copy_data"):
+            # Each copy needs its own file descriptor.
+            dst_fd = os.open(bin_path, os.O_WRONLY)
+            try:
+                num_bytes = copy_stats.copy_file(
+                    get_bin_path(input_prefixes[i]),
+                    dst_fd,
+                    int(bin_offsets[i]),
+                )
+            finally:
+                os.close(dst_fd)
+        metrics.add(input_bytes=num_bytes, output_bytes=num_bytes)
+
+    bin_sizes = [
+        os.path.getsize(get_bin_path(prefix)) for prefix in input_prefixes
+    ]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(num_workers, 1)) as executor:
+        # Copy the largest inputs first so that no large copy is left
+        # running on its own at the end.
+        order = sorted(
+            range(len(input_prefixes)),
+            key=lambda i: (-bin_sizes[i], i),
+        )
+        for _ in executor.map(copy_input, order):
+            pass
+    print(copy_stats.report(time.perf_counter() - start))
+
+
+def merge_parallel(input_prefixes, output_prefix, num_workers):
+    """Merge the indexed datasets at `input_prefixes` into
+    `output_prefix`, copying the data of several inputs at once.
+
+    Since all input sizes are known up front, the output `.bin` is
+    sized in advance, and each input is copied into its own region of
+    it with positional writes.
+    """
+    index_parts, dtype, bin_sizes = read_indices(input_prefixes)
+    bin_offsets = np.cumsum([0] + bin_sizes)
+    bin_path = get_bin_path(output_prefix)
+    # Size the output in advance so that inputs can be copied into it
+    # in any order.
+    with open(bin_path, "wb") as f:
+        f.truncate(int(bin_offsets[-1]))
+
+    copy_inputs(input_prefixes, bin_path, bin_offsets, num_workers)
+
+    with get_metrics().stage("finalize"):
+        index_parts.write(get_idx_path(output_prefix), dtype)
+
+
+def write_partial_index(input_prefixes, prefix):
+    """Write the combined index of `input_prefixes` to `prefix`.idx and
+    their data type and `.bin` files to `prefix`.json.
+    """
+    dtype = None
+    if input_prefixes:
+        index_parts, dtype, bin_sizes = read_indices(input_prefixes)
+        index_parts.write(get_idx_path(prefix), dtype)
+    with open(prefix + ".json", "w") as f:
+        json.dump(
+            {
+                "dtype": np.dtype(dtype).name if dtype is not None else None,
+                "bin_paths": [
+                    get_bin_path(input_prefix)
+                    for input_prefix in input_prefixes
+                ],
+                "bin_sizes": bin_sizes if input_prefixes else [],
+            },
+            f,
+        )
+
+
+def combine_partial_indices(child_prefixes, prefix):
+    """Combine the partial indices at `child_prefixes` (see
+    `write_partial_index`) into `prefix`.
+    """
+    index_parts = IndexParts()
+    dtype = None
+    bin_paths = []
+    bin_sizes = []
+    for child_prefix in child_prefixes:
+        with open(child_prefix + ".json", "r") as f:
+            child = json.load(f)
+        if child["dtype"] is None:
+            continue
+        if dtype is None:
+            dtype = child["dtype"]
+        assert child["dtype"] == dtype, (
+            f"ERROR: cannot merge datasets of types {dtype} and "
+            f"{child['dtype']}"
+        )
+        index = MMapIndexedDataset.Index(get_idx_path(child_prefix))
+        index_parts.append(index.sizes, index.doc_idx)
+        del index
+        bin_paths.extend(child["bin_paths"])
+        bin_sizes.extend(child["bin_sizes"])
+
+    if dtype is not None:
+        index_parts.write(get_idx_path(prefix), np.dtype(dtype).type)
+    with open(prefix + ".json", "w") as f:
+        json.dump(
+            {"dtype": dtype, "bin_paths": bin_paths, "bin_sizes": bin_sizes},
+            f,
+        )
+
+
+def merge_distributed(
+        input_prefixes,
+        output_prefix,
+        virtual=False,
+        num_workers=0,
+        fan_in=16,
+        work_dir=None,
+        timeout=DEFAULT_TIMEOUT,
+):
+    """Merge the indexed datasets at `input_prefixes` into
+    `output_prefix` with all `WORLD_SIZE` processes.
+
+    Each process combines the indices of a contiguous chunk of inputs,
+    and the partial indices are combined in a tree. Unless `virtual`,
+    rank 0 then sizes the output and each process copies the data of
+    its chunk into it.
+
+    Partial results are written to `work_dir`, which must not contain
+    results of another run, and are removed after a successful merge.
+    By default, a new directory next to the output is used for each run
+    and removed as well; a given `work_dir` is kept. Processes wait up
+    to `timeout` seconds for each other.
+    """
+    rank, world_size = get_rank_and_world_size()
+    # Only remove a directory this run created.
+    keep_work_dir = work_dir is not None
+    if work_dir is None:
+        # Never pick up partial results or markers of an earlier run.
+        work_dir = f"{output_prefix}.merge-{get_run_id(world_size)}"
+    input_indices = get_chunk(range(len(input_prefixes)), rank, world_size)
+    final_prefix = tree_reduce(
+        work_dir,
+        rank,
+        world_size,
+        lambda prefix: write_partial_index(
+            [input_prefixes[i] for i in input_indices],
+            prefix,
+        ),
+        combine_partial_indices,
+        fan_in=fan_in,
+        timeout=timeout,
+    )
+
+    # Files of the copy, removed together with the partial results.
+    copy_dir = os.path.join(work_dir, "copy")
+    plan_prefix = os.path.join(copy_dir, "plan")
+    if final_prefix is not None:
+        with open(final_prefix + ".json", "r") as f:
+            merged = json.load(f)
+        assert merged["dtype"] is not None, "ERROR: no datasets to merge"
+        if virtual:
+            with get_metrics().stage("finalize"):
+                os.replace(
+                    get_idx_path(final_prefix),
+                    get_idx_path(output_prefix),
+                )
+                write_manifest(
+                    output_prefix,
+                    merged["bin_paths"],
+                    merged["bin_sizes"],
+                )
+            remove_work_dir(work_dir, keep_work_dir, ["copy"])
+            return
+
+        bin_offsets = np.cumsum([0] + merged["bin_sizes"])
+        with open(get_bin_path(output_prefix), "wb") as f:
+            f.truncate(int(bin_offsets[-1]))
+        os.makedirs(copy_dir, exist_ok=True)
+        with open(plan_prefix + ".json", "w") as f:
+            json.dump({"bin_offsets": bin_offsets.tolist()}, f)
+        mark_done(plan_prefix)
+    elif virtual:
+        return
+
+    wait_for([plan_prefix], timeout=timeout)
+    with open(plan_prefix + ".json", "r") as f:
+        bin_offsets = json.load(f)["bin_offsets"]
+    copy_inputs(
+        [input_prefixes[i] for i in input_indices],
+        get_bin_path(output_prefix),
+        [bin_offsets[i] for i in input_indices],
+        num_workers,
+    )
+    copied_prefixes = [
+        os.path.join(copy_dir, f"copied{i:05}") for i in range(world_size)
+    ]
+    mark_done(copied_prefixes[rank])
+    if rank != 0:
+        return
+
+    # Only publish the index once all data is in place.
+    wait_for(copied_prefixes, timeout=timeout)
+    with get_metrics().stage("finalize"):
+        os.replace(get_idx_path(final_prefix), get_idx_path(output_prefix))
+    remove_work_dir(work_dir, keep_work_dir, ["copy"])
 
 
 def get_args():
@@ -58,6 +371,64 @@ def get_args():
         action="store_true",
         help="Whether the datasets are assumed to be multimodal"
     )
+    group.add_argument(
+        "--parallel-workers",
+        type=int,
+        default=0,
+        help=(
+            "Number of threads copying inputs concurrently into a "
+            "preallocated output. If 0, inputs are appended one after "
+            "another."
+        ),
+    )
+    group.add_argument(
+        "--virtual",
+        action="store_true",
+        help=(
+            "Only write the merged index and a manifest referencing the "
+            "input `.bin` files instead of copying them. Training started "
+            "with `run_with_virtual_datasets.py` loads the result."
+        ),
+    )
+    group.add_argument(
+        "--distributed",
+        action="store_true",
+        help=(
+            "Merge with all `WORLD_SIZE` processes, where `RANK` is the "
+            "index of this process."
+        ),
+    )
+    group.add_argument(
+        "--fan-in",
+        type=int,
+        default=16,
+        help="Number of partial indices combined at once when distributed",
+    )
+    group.add_argument(
+        "--work-dir",
+        type=str,
+        help=(
+            "Directory for partial results when distributed. Must not "
+            "contain results of another run. Only the partial results are "
+            "removed from it afterwards. By default, a new directory next "
+            "to the output is used for each run."
+        ),
+    )
+    group.add_argument(
+        "--timeout",
+        type=float,
+        default=DEFAULT_TIMEOUT,
+        help=(
+            "Number of seconds to wait for other processes when "
+            "distributed before giving up, such as for the data of all "
+            "inputs to be copied."
+        ),
+    )
+    group.add_argument(
+        "--metrics-dir",
+        type=str,
+        help="Directory to write throughput and resource metrics to",
+    )
 
     args = parser.parse_args()
 
@@ -92,18 +463,58 @@ def main():
 
         prefixes.add(prefix)
 
-    builder = None
-    for prefix in sorted(prefixes):
-        if builder is None:
-            dataset = MMapIndexedDataset(os.path.join(args.input, prefix))  # , multimodal=args.multimodal)
-            builder = MMapIndexedDatasetBuilder(
-                get_bin_path(args.output_prefix), dtype=dataset._index.dtype,  # multimodal=args.multimodal
+    if args.distributed:
+        rank, _ = get_rank_and_world_size()
+        with start_metrics(args.metrics_dir, "merge_datasets", rank=rank):
+            merge_distributed(
+                [
+                    os.path.join(args.input, prefix)
+                    for prefix in sorted(prefixes)
+                ],
+                args.output_prefix,
+                virtual=args.virtual,
+                num_workers=args.parallel_workers,
+                fan_in=args.fan_in,
+                work_dir=args.work_dir,
+                timeout=args.timeout,
+            )
+        return
+
+    with start_metrics(args.metrics_dir, "merge_datasets") as metrics:
+        if args.virtual:
+            merge_virtual(
+                [
+                    os.path.join(args.input, prefix)
+                    for prefix in sorted(prefixes)
+                ],
+                args.output_prefix,
+            )
+            return
+
+        if args.parallel_workers > 0:
+            merge_parallel(
+                [
+                    os.path.join(args.input, prefix)
+                    for prefix in sorted(prefixes)
+                ],
+                args.output_prefix,
+                args.parallel_workers,
             )
-            del dataset
+            return
+
+        builder = None
+        for prefix in sorted(prefixes):
+            if builder is None:
+                dataset = MMapIndexedDataset(os.path.join(args.input, prefix))  # , multimodal=args.multimodal)
+                builder = MMapIndexedDatasetBuilder(
+                    get_bin_path(args.output_prefix), dtype=dataset._index.dtype,  # multimodal=args.multimodal
+                )
+                del dataset
 
-        builder.merge_file_(os.path.join(args.input, prefix))
+            builder.merge_file_(os.path.join(args.input, prefix))
 
-    builder.finalize(get_idx_path(args.output_prefix))
+        with metrics.stage("finalize"):
+            builder.finalize(get_idx_path(args.output_prefix))
 
 
 if __name__ == '__main__':
@@ -5,7 +5,6 @@
 from argparse import ArgumentParser
 import importlib
 import os
-import shutil
 import sys
 from typing import Type
 
@@ -18,6 +17,10 @@ from nemo.collections.nlp.data.language_modeling.megatron.indexed_dataset import
     index_file_path as get_idx_path,
 )
 
+from data_prep_metrics import get_metrics
+from file_copy import CopyStats
+from mmap_index import IndexParts
+
 
 class MMapIndexedDataset(_MMapIndexedDataset):
     def __init__(self, path_prefix: str, multimodal: bool = False) -> None:
@@ -36,20 +39,46 @@ class MMapIndexedDatasetBuilder(_MMapIndexedDatasetBuilder):
             multimodal: bool = False,
     ):
         super().__init__(bin_path, dtype)
+        # Indices of merged files, kept as arrays.
+        self._index_parts = IndexParts()
+        self._copy_stats = CopyStats()
 
     def merge_file_(self, another_file):
+        metrics = get_metrics()
+
         # Concatenate index
-        index = MMapIndexedDataset.Index(get_idx_path(another_file))
-        assert index.dtype == self._dtype
+        with metrics.stage('merge_index'):
+            index = MMapIndexedDataset.Index(get_idx_path(another_file))
+            assert index.dtype == self._dtype
 
-        offset = len(self._sizes)
-        for size in index.sizes:
-            self._sizes.append(size)
-        self._doc_idx.extend((offset + index.doc_idx)[1:])
+            self._flush_items()
+            self._index_parts.append(index.sizes, index.doc_idx)
 
         # Concatenate data
-        with open(get_bin_path(another_file), 'rb') as f:
-            shutil.copyfileobj(f, self._data_file)
+        with metrics.stage('copy_data'):
+            num_bytes = self._copy_stats.append_file(
+                get_bin_path(another_file),
+                self._data_file,
+            )
+        metrics.add(
+            documents=len(index.doc_idx) - 1,
+            tokens=int(index.sizes.sum()),
+            input_bytes=num_bytes,
+            output_bytes=num_bytes,
+        )
+
+    def _flush_items(self):
+        # Keep items added with `add_item` in order with merged files.
+        if self._sizes or len(self._doc_idx) > 1:
+            self._index_parts.append(self._sizes, self._doc_idx)
+            self._sizes = []
+            self._doc_idx = [0]
+
+    def finalize(self, index_file):
+        self._data_file.close()
+        self._flush_items()
+        self._index_parts.write(index_file, self._dtype)
+        print(self._copy_stats.report())
 
     def add_index(self, *args, **kwargs):
         return self.merge_file_(*args, **kwargs)
@@ -0,0 +1,76 @@
+"""
+Vectorized writing of the `.idx` files of memory-mapped indexed
+datasets (as used by NeMo and Megatron-LM).
+
+An index consists of a header, the size (in tokens) of each sequence,
+the pointer (byte offset into the `.bin` file) of each sequence, and
+the document index, i.e., the index of the sequence each document
+starts at. Instead of appending every size of every merged dataset to
+a Python list, we keep the merged datasets' arrays, compute pointers
+with a cumulative sum, and write each array with a single call.
+"""
+
+import struct
+from typing import List, Sequence, Type
+
+import numpy as np
+
+from nemo.collections.nlp.data.language_modeling.megatron.indexed_dataset import (
+    MMapIndexedDataset,
+    code,
+)
+
+INDEX_VERSION = 1
+
+
+class IndexParts:
+    """Sizes and document indices of consecutive datasets that are
+    combined into a single index.
+    """
+
+    def __init__(self) -> None:
+        self.sizes: List[np.ndarray] = []
+        self.doc_idx: List[np.ndarray] = [np.zeros(1, dtype=np.int64)]
+        self.num_sequences = 0
+        self.num_doc_idx = 1
+
+    def append(self, sizes: Sequence[int], doc_idx: Sequence[int]) -> None:
+        """Append the `sizes` and `doc_idx` (starting with 0) of the next
+        dataset.
+        """
+        # Copy, so the source index does not need to stay mapped.
+        sizes = np.array(sizes, dtype=np.int32)
+        doc_idx = self.num_sequences + np.asarray(doc_idx[1:], dtype=np.int64)
+        self.sizes.append(sizes)
+        self.doc_idx.append(doc_idx)
+        self.num_sequences += len(sizes)
+        self.num_doc_idx += len(doc_idx)
+
+    def write(self, index_file: str, dtype: Type[np.number]) -> None:
+        """Write the combined index for tokens of type `dtype` to
+        `index_file`.
+        """
+        itemsize = np.dtype(dtype).itemsize
+        with open(index_file, 'wb') as f:
+            f.write(MMapIndexedDataset.Index._HDR_MAGIC)
+            f.write(struct.pack('<Q', INDEX_VERSION))
+            f.write(struct.pack('<B', code(dtype)))
+            f.write(struct.pack('<Q', self.num_sequences))
+            f.write(struct.pack('<Q', self.num_doc_idx))
+
+            for sizes in self.sizes:
+                f.write(sizes.tobytes(order='C'))
+
+            address = 0
+            for sizes in self.sizes:
+                if len(sizes) == 0:
+                    continue
+                ends = address + np.cumsum(sizes, dtype=np.int64) * itemsize
+                pointers = np.empty(len(sizes), dtype=np.int64)
+                pointers[0] = address
+                pointers[1:] = ends[:-1]
+                f.write(pointers.tobytes(order='C'))
+                address = int(ends[-1])
+
+            for doc_idx in self.doc_idx:
+                f.write(doc_idx.tobytes(order='C'))
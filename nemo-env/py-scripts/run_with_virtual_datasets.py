@@ -0,0 +1,32 @@
+"""
+Run a training script so that it can load virtual merges.
+
+Usage: `python run_with_virtual_datasets.py <script> [<argument> ...]`
+
+The script is run as `__main__` with the given arguments, after
+`virtual_datasets.install_virtual_datasets()` was called. Regular
+datasets are loaded as before.
+"""
+
+import os
+import runpy
+import sys
+
+from virtual_datasets import install_virtual_datasets
+
+
+def main():
+    if len(sys.argv) < 2:
+        print(__doc__.strip(), file=sys.stderr)
+        sys.exit(2)
+
+    install_virtual_datasets()
+    script = sys.argv[1]
+    # Run the script as if it had been started directly.
+    sys.argv = sys.argv[1:]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    runpy.run_path(script, run_name='__main__')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Loading virtual merges (see `virtual_merge.py`) in training.
+
+Both NeMo and Megatron-LM build their GPT training datasets on top of
+Megatron-core's `IndexedDataset`. `VirtualIndexedDataset` extends it to
+read the sequences of a virtual merge from the original `.bin` files,
+and behaves exactly like `IndexedDataset` for regular datasets.
+`install_virtual_datasets()` makes Megatron-core's GPT dataset use it;
+training scripts are started with `run_with_virtual_datasets.py` to
+install it before any dataset is built.
+
+Only the methods of `IndexedDataset` that are the same across
+Megatron-core versions are overridden.
+"""
+
+import os
+
+from megatron.core.datasets import gpt_dataset, indexed_dataset
+import numpy as np
+
+from virtual_merge import manifest_path, VirtualBinFiles
+
+_IndexedDataset = indexed_dataset.IndexedDataset
+
+
+class VirtualIndexedDataset(_IndexedDataset):
+    """`IndexedDataset` that also supports virtual merges.
+
+    If a manifest exists for `path_prefix`, sequences are read from the
+    original `.bin` files listed in it. Otherwise, this is a regular
+    `IndexedDataset`.
+    """
+
+    def initialize(self, path_prefix, multimodal, mmap, *args, **kwargs):
+        # Also called when unpickling, for example in data loader
+        # workers.
+        self._bin_files = None
+        if not os.path.isfile(manifest_path(path_prefix)):
+            return super().initialize(
+                path_prefix,
+                multimodal,
+                mmap,
+                *args,
+                **kwargs,
+            )
+        if multimodal:
+            raise ValueError(
+                f'virtual merges of multimodal datasets are not supported: '
+                f'{path_prefix}',
+            )
+
+        self.path_prefix = path_prefix
+        self.multimodal = multimodal
+        self.mmap = mmap
+        self.index = indexed_dataset._IndexReader(
+            indexed_dataset.get_idx_path(path_prefix),
+            multimodal,
+        )
+        self._bin_files = VirtualBinFiles(path_prefix)
+        # Attributes that `IndexedDataset` reads or cleans up, depending
+        # on the Megatron-core version.
+        self.bin_buffer = None
+        self.bin_buffer_mmap = None
+        self.bin_reader = self._bin_files
+        self.s3_config = None
+
+    def __getitem__(self, idx):
+        if self._bin_files is None:
+            return super().__getitem__(idx)
+        if isinstance(idx, slice):
+            (start, stop, step) = idx.indices(len(self))
+            if step != 1:
+                raise ValueError(
+                    'Slices into indexed_dataset must be contiguous',
+                )
+            # Sequences of a slice may lie in different files.
+            return [self[i] for i in range(start, stop)]
+        (pointer, length) = self.index[idx][:2]
+        return self._bin_files.read(self.index.dtype, length, pointer)
+
+    def get(self, idx, offset=0, length=None):
+        if self._bin_files is None:
+            return super().get(idx, offset, length)
+        (pointer, size) = self.index[idx][:2]
+        if length is None:
+            length = size - offset
+        pointer += offset * np.dtype(self.index.dtype).itemsize
+        return self._bin_files.read(self.index.dtype, length, pointer)
+
+    @staticmethod
+    def exists(path_prefix):
+        return _IndexedDataset.exists(path_prefix) or (
+            os.path.exists(indexed_dataset.get_idx_path(path_prefix))
+            and os.path.exists(manifest_path(path_prefix))
+        )
+
+
+def install_virtual_datasets() -> None:
+    """Make Megatron-core's GPT datasets load virtual merges.
+
+    Has to be called before the training datasets are built.
+    """
+    gpt_dataset.IndexedDataset = VirtualIndexedDataset
+    indexed_dataset.IndexedDataset = VirtualIndexedDataset
@@ -0,0 +1,152 @@
+"""
+Load a virtual merge through Megatron-core's GPT dataset, like NeMo's
+default GPT data path does, and compare it to a regular merge of the
+same inputs.
+
+Needs `torch`, `megatron.core`, and `nemo`; skipped otherwise.
+"""
+
+import os
+import pickle
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(
+    0,
+    os.path.join(os.path.dirname(__file__), os.pardir, 'py-scripts'),
+)
+
+pytest.importorskip('torch')
+pytest.importorskip('megatron.core')
+pytest.importorskip('nemo')
+
+from megatron.core.datasets import gpt_dataset, indexed_dataset
+from megatron.core.datasets.blended_megatron_dataset_builder import (
+    BlendedMegatronDatasetBuilder,
+)
+from megatron.core.datasets.gpt_dataset import GPTDataset, GPTDatasetConfig
+from megatron.core.datasets.megatron_tokenizer import MegatronTokenizer
+
+import merge_datasets
+from virtual_datasets import install_virtual_datasets
+
+EOD = 0
+SEQUENCE_LENGTH = 16
+NUM_INPUTS = 5
+
+
+class _Tokenizer(MegatronTokenizer):
+    def __init__(self):
+        super().__init__('test')
+
+    def tokenize(self, text):
+        raise NotImplementedError
+
+    @property
+    def vocab(self):
+        return {}
+
+    @property
+    def inv_vocab(self):
+        return {}
+
+    @property
+    def vocab_size(self):
+        return 1000
+
+    @property
+    def eod(self):
+        return EOD
+
+
+def write_inputs(input_dir, num_inputs=NUM_INPUTS, dtype=np.uint16):
+    rng = np.random.default_rng(0)
+    for i in range(num_inputs):
+        prefix = os.path.join(input_dir, f'part_{i:03}')
+        builder = indexed_dataset.IndexedDatasetBuilder(
+            indexed_dataset.get_bin_path(prefix),
+            dtype=dtype,
+        )
+        # Includes inputs without any documents.
+        for _ in range(rng.integers(0, 20)):
+            tokens = rng.integers(1, 1000, rng.integers(1, 40))
+            builder.add_document(np.append(tokens, EOD), [len(tokens) + 1])
+        builder.finalize(indexed_dataset.get_idx_path(prefix))
+
+
+def build_gpt_dataset(path_prefix, cache_dir):
+    config = GPTDatasetConfig(
+        random_seed=1234,
+        sequence_length=SEQUENCE_LENGTH,
+        blend=([path_prefix], None),
+        split='1,0,0',
+        path_to_cache=cache_dir,
+        tokenizer=_Tokenizer(),
+        reset_position_ids=False,
+        reset_attention_mask=False,
+        eod_mask_loss=False,
+    )
+    (train_dataset, _, _) = BlendedMegatronDatasetBuilder(
+        GPTDataset,
+        [None, None, None],
+        lambda: True,
+        config,
+    ).build()
+    return train_dataset
+
+
+def test_virtual_merge_loads_like_regular_merge(tmp_path, monkeypatch):
+    input_dir = tmp_path / 'inputs'
+    input_dir.mkdir()
+    write_inputs(str(input_dir))
+    input_prefixes = [
+        str(input_dir / f'part_{i:03}') for i in range(NUM_INPUTS)
+    ]
+
+    regular_prefix = str(tmp_path / 'regular')
+    builder = indexed_dataset.IndexedDatasetBuilder(
+        indexed_dataset.get_bin_path(regular_prefix),
+        dtype=np.uint16,
+    )
+    for prefix in input_prefixes:
+        builder.add_index(prefix)
+    builder.finalize(indexed_dataset.get_idx_path(regular_prefix))
+    virtual_prefix = str(tmp_path / 'virtual')
+    merge_datasets.merge_virtual(input_prefixes, virtual_prefix)
+    assert not os.path.exists(indexed_dataset.get_bin_path(virtual_prefix))
+
+    # Undo the installation after the test.
+    monkeypatch.setattr(
+        gpt_dataset,
+        'IndexedDataset',
+        gpt_dataset.IndexedDataset,
+    )
+    monkeypatch.setattr(
+        indexed_dataset,
+        'IndexedDataset',
+        indexed_dataset.IndexedDataset,
+    )
+    install_virtual_datasets()
+
+    regular = build_gpt_dataset(regular_prefix, str(tmp_path / 'cache-r'))
+    virtual = build_gpt_dataset(virtual_prefix, str(tmp_path / 'cache-v'))
+    assert len(virtual) == len(regular) > 0
+    for i in range(len(regular)):
+        np.testing.assert_array_equal(
+            virtual[i]['tokens'].numpy(),
+            regular[i]['tokens'].numpy(),
+        )
+        np.testing.assert_array_equal(
+            virtual[i]['labels'].numpy(),
+            regular[i]['labels'].numpy(),
+        )
+
+    # Data loader workers unpickle the dataset.
+    unpickled = pickle.loads(pickle.dumps(virtual.dataset))
+    np.testing.assert_array_equal(unpickled[3], regular.dataset[3])
+    np.testing.assert_array_equal(
+        unpickled.get(3, offset=1, length=2),
+        regular.dataset.get(3, offset=1, length=2),
+    )
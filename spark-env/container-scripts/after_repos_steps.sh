@@ -12,6 +12,7 @@ source "$_curr_dir"/../../global-scripts/get_curr_file.sh "$_curr_file"
 
 source "$(get_curr_dir)"/configure_pip_install_variables.sh
 
-python -m pip "${_pip_install_args[@]}" pyspark
+python -m pip "${_pip_install_args[@]}" pyspark pyarrow numpy pandas transformers \
+    mosaicml-streaming
 
 pop_curr_file
@@ -21,12 +21,71 @@ fi
 mkdir -p "$(dirname "$OUTPUT_DATA_DIR")"
 
 INPUT_FORMAT="${INPUT_FORMAT:-parquet}"
+# `parquet`, `json`, or `mds` (not supported by the `local` shuffler).
 OUTPUT_FORMAT="${OUTPUT_FORMAT:-parquet}"
+# For `mds` output, optionally the comma-separated columns to write.
+MDS_COLUMNS="${MDS_COLUMNS:-}"
+# For `mds` output of tokens, optionally pack them into samples of this
+# many tokens; by default, each document is one sample.
+CONCAT_TOKENS="${CONCAT_TOKENS:-}"
 OUTPUT_COMPRESSION="${OUTPUT_COMPRESSION:-zstd}"
+# `sort` for a global random sort, `partition` for a cheaper single
+# exchange to random partitions followed by local shuffles.
+SHUFFLE_MODE="${SHUFFLE_MODE:-sort}"
+# Optionally, choose the number of output files so that each has
+# about this many bytes or rows; by default, write one file per worker.
+TARGET_FILE_BYTES="${TARGET_FILE_BYTES:-}"
+ROWS_PER_FILE="${ROWS_PER_FILE:-}"
+FILE_COUNT_MULTIPLE="${FILE_COUNT_MULTIPLE:-1}"
+# `spark` to shuffle with a Spark cluster over all nodes, `local` to
+# shuffle on the first node only with `shuffle_data_local.py`, which
+# needs no JVM and is cheaper for small and medium datasets.
+SHUFFLER="${SHUFFLER:-spark}"
+# Optionally, tokenize the text column with this Hugging Face tokenizer
+# inside the Spark job (not supported by the `local` shuffler).
+TOKENIZER="${TOKENIZER:-}"
+TEXT_COLUMN="${TEXT_COLUMN:-text}"
+
+file_size_args=()
+if [ -n "$TARGET_FILE_BYTES" ]; then
+    file_size_args+=(--target-file-bytes "$TARGET_FILE_BYTES")
+fi
+if [ -n "$ROWS_PER_FILE" ]; then
+    file_size_args+=(--rows-per-file "$ROWS_PER_FILE")
+fi
+tokenizer_args=()
+if [ -n "$TOKENIZER" ]; then
+    tokenizer_args+=(--tokenizer "$TOKENIZER" --text-column "$TEXT_COLUMN")
+fi
+mds_args=()
+if [ -n "$MDS_COLUMNS" ]; then
+    mds_args+=(--mds-columns "$MDS_COLUMNS")
+fi
+if [ -n "$CONCAT_TOKENS" ]; then
+    mds_args+=(--concat-tokens "$CONCAT_TOKENS")
+fi
 my_spark_cache_dir="${my_spark_cache_dir:-"$cache_dir"}"
 
 export SPARK_LOCAL_DIRS="$my_spark_cache_dir"/spark-"$SLURM_JOB_ID"
-if ((NODE_RANK)); then
+if [ "$SHUFFLER" = local ]; then
+    if [ -n "$TOKENIZER" ]; then
+        echo 'Tokenizing is only supported with `SHUFFLER=spark`.'
+        exit 1
+    fi
+    if ! ((NODE_RANK)); then
+        python -u "$(get_curr_dir)"/../py-scripts/shuffle_data_local.py \
+               --dist-input-files="$INPUT_DATA_FILES" \
+               --dist-input-files-glob="$INPUT_DATA_FILES_GLOB" \
+               --output-dir="$OUTPUT_DATA_DIR" \
+               --local-dir "$SPARK_LOCAL_DIRS" \
+               --available-mem-gb "$AVAILABLE_MEM_GB" \
+               --input-format "$INPUT_FORMAT" \
+               --output-format "$OUTPUT_FORMAT" \
+               --output-compression "$OUTPUT_COMPRESSION" \
+               --file-count-multiple "$FILE_COUNT_MULTIPLE" \
+               "${file_size_args[@]}"
+    fi
+elif ((NODE_RANK)); then
     spark_work_dir="$my_spark_cache_dir"/spark-"$NODE_RANK"-"$SLURM_JOB_ID"
     spark-class org.apache.spark.deploy.worker.Worker \
                 spark://"$MASTER_ADDR":"$MASTER_PORT" \
@@ -46,7 +105,12 @@ else
            --available-mem-gb "$AVAILABLE_MEM_GB" \
            --input-format "$INPUT_FORMAT" \
            --output-format "$OUTPUT_FORMAT" \
-           --output-compression "$OUTPUT_COMPRESSION"
+           --output-compression "$OUTPUT_COMPRESSION" \
+           --shuffle-mode "$SHUFFLE_MODE" \
+           --file-count-multiple "$FILE_COUNT_MULTIPLE" \
+           "${file_size_args[@]}" \
+           "${tokenizer_args[@]}" \
+           "${mds_args[@]}"
 
     kill -s KILL "$master_proc"
 fi
@@ -0,0 +1,193 @@
+"""
+Command line interface and helpers shared by the Spark shuffler
+(`shuffle_data.py`) and the single-node shuffler
+(`shuffle_data_local.py`), so both accept the same arguments.
+"""
+
+from argparse import ArgumentParser, Namespace
+import glob
+import math
+import os
+import tempfile
+from typing import List, Sequence
+
+
+def get_parser(
+        output_formats: Sequence[str] = ('parquet', 'json'),
+) -> ArgumentParser:
+    """Return the command line parser shared by the shufflers, which
+    support writing `output_formats`.
+    """
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--dist-input-files',
+        help='Colon-separated list of input files to process',
+    )
+    parser.add_argument(
+        '--dist-input-files-glob',
+        help='Glob of input files to process',
+    )
+    parser.add_argument(
+        '--seed',
+        default=0,
+        type=int,
+        help='Value to initialize the random number generator with.',
+    )
+    parser.add_argument(
+        '--shuffle-mode',
+        choices=['sort', 'partition'],
+        default='sort',
+        help=(
+            'How to shuffle. "sort" sorts globally by a random column. '
+            '"partition" sends each row to a random partition in a single '
+            'exchange and then shuffles each partition locally, avoiding '
+            'the sampling pass and range-partitioned global sort.'
+        ),
+    )
+    parser.add_argument(
+        '--num-partitions',
+        type=int,
+        help=(
+            'Number of partitions (and thus output files) for '
+            '`--shuffle-mode partition`. Defaults to the number of output '
+            'files chosen by `--target-file-bytes` or `--rows-per-file`, or '
+            'else the number of workers.'
+        ),
+    )
+    parser.add_argument(
+        '--target-file-bytes',
+        type=int,
+        help=(
+            'Approximate size of each output file in bytes. The number of '
+            'output files is chosen from the total size of the input files, '
+            'so this assumes output and input are similarly compressed.'
+        ),
+    )
+    parser.add_argument(
+        '--rows-per-file',
+        type=int,
+        help=(
+            'Approximate number of rows in each output file. Requires '
+            'counting the input rows first.'
+        ),
+    )
+    parser.add_argument(
+        '--file-count-multiple',
+        type=int,
+        default=1,
+        help=(
+            'Round the number of output files chosen by '
+            '`--target-file-bytes` or `--rows-per-file` up to a multiple of '
+            'this, for example the number of processes that will convert '
+            'the output, so that each gets the same number of files.'
+        ),
+    )
+    parser.add_argument(
+        '--local-dir',
+        default=os.getenv('SPARK_LOCAL_DIRS', tempfile.gettempdir()),
+    )
+    parser.add_argument(
+        '--event-dir',
+        default=os.path.join(tempfile.gettempdir(), 'spark-events'),
+    )
+    parser.add_argument('--available-mem-gb', type=float)
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument(
+        '--num-shards',
+        type=int,
+        help='Uniformly shard across all input files into this many shards',
+    )
+    parser.add_argument('--rank', type=int)
+    parser.add_argument(
+        '--input-format',
+        choices=['parquet', 'json'],
+        default='parquet',
+        help='Format of the input data, i.e., when reading.',
+    )
+    parser.add_argument(
+        '--output-format',
+        choices=list(output_formats),
+        default='parquet',
+        help='Format of the output data, i.e., when writing.',
+    )
+    parser.add_argument(
+        '--output-compression',
+        default='zstd',
+        help=(
+            'Compression to apply to the output data, i.e., when writing. '
+            '"none" or "" for no compression.'
+        ),
+    )
+    return parser
+
+
+def check_args(args: Namespace) -> None:
+    """Check combinations of arguments that the parser cannot check."""
+    assert args.dist_input_files or args.dist_input_files_glob, (
+        'need either `--dist-input-files` or `--dist-input-files-glob` '
+        'to be specified'
+    )
+    assert (
+        args.num_shards is None and args.rank is None
+        or args.num_shards is not None and args.rank is not None
+    ), 'cannot give only one of `--num-shards` and `--rank`; please set both'
+    assert args.target_file_bytes is None or args.rows_per_file is None, (
+        'cannot give both `--target-file-bytes` and `--rows-per-file`'
+    )
+    assert args.file_count_multiple >= 1, (
+        '`--file-count-multiple` must be at least 1'
+    )
+
+
+def get_input_files(args: Namespace) -> List[str]:
+    """Return the input files of this shard."""
+    input_files = []
+    if args.dist_input_files:
+        input_files.extend(args.dist_input_files.split(':'))
+    if args.dist_input_files_glob:
+        input_files.extend(sorted(glob.glob(args.dist_input_files_glob)))
+
+    if args.num_shards is not None:
+        input_files = input_files[args.rank::args.num_shards]
+    return input_files
+
+
+def get_input_bytes(input_paths: Sequence[str]) -> int:
+    """Return the total size of `input_paths` in bytes.
+
+    Directories (which Spark reads as datasets) count with the size of
+    all files below them, skipping hidden files and files starting with
+    an underscore (such as `_SUCCESS`) like Spark does.
+    """
+    num_bytes = 0
+    for path in input_paths:
+        if not os.path.isdir(path):
+            num_bytes += os.path.getsize(path)
+            continue
+        for (root, dirs, files) in os.walk(path):
+            dirs[:] = [
+                name for name in dirs if not name.startswith(('.', '_'))
+            ]
+            num_bytes += sum(
+                os.path.getsize(os.path.join(root, name))
+                for name in files
+                if not name.startswith(('.', '_'))
+            )
+    return num_bytes
+
+
+def get_output_compression(args: Namespace):
+    """Return the output compression, or `None` for no compression."""
+    return (
+        args.output_compression
+        if args.output_compression not in ['', 'none']
+        else None
+    )
+
+
+def round_num_files(num_files: int, file_count_multiple: int) -> int:
+    """Return `num_files` rounded up to a positive multiple of
+    `file_count_multiple`.
+    """
+    num_files = max(num_files, 1)
+    return math.ceil(num_files / file_count_multiple) * file_count_multiple
@@ -1,78 +1,138 @@
-from argparse import ArgumentParser
 import atexit
-import glob
 import math
 import os
-import tempfile
+import shutil
 
+from pyspark import StorageLevel
 from pyspark.sql import SparkSession
 from pyspark.sql import functions as sf
 
+from shuffle_common import (
+    check_args,
+    get_input_bytes,
+    get_input_files,
+    get_output_compression,
+    get_parser,
+    round_num_files,
+)
+from spark_mds import get_mds_columns, write_mds
+from spark_tokenization import TOKENS_COLUMN, tokenize_column
+
 
 def parse_args():
-    parser = ArgumentParser()
+    parser = get_parser(output_formats=['parquet', 'json', 'mds'])
     parser.add_argument(
-        '--dist-input-files',
-        help='Colon-separated list of input files to process',
+        '--mds-columns',
+        help=(
+            'Comma-separated columns to write with `--output-format mds`. '
+            'Defaults to "tokens" when tokenizing, or else the text column. '
+            'Each partition is written as an MDS dataset in '
+            '`<output-dir>/<partition index>`, which can be merged with '
+            "LLM Foundry's `merge_dataset.py`. Each row becomes one "
+            'sample, so without `--concat-tokens`, token IDs are written '
+            'unpacked, as one variable-length sample per document.'
+        ),
     )
     parser.add_argument(
-        '--dist-input-files-glob',
-        help='Glob of input files to process',
+        '--concat-tokens',
+        type=int,
+        help=(
+            'With `--tokenizer` and `--output-format mds`, pack the '
+            'shuffled token IDs into samples of this many tokens, like '
+            "the `--concat_tokens` output of LLM Foundry's conversion "
+            'scripts. Leftover tokens at the end of each partition are '
+            'discarded.'
+        ),
     )
     parser.add_argument(
-        '--seed',
-        default=0,
-        help='Value to initialize the random number generator with.',
+        '--no-wrap',
+        action='store_true',
+        help=(
+            'With `--concat-tokens`, do not wrap texts across samples; '
+            'the tokens after the text that fills a sample are discarded.'
+        ),
     )
     parser.add_argument(
-        '--local-dir',
-        default=os.getenv('SPARK_LOCAL_DIRS', tempfile.gettempdir()),
+        '--tokenizer',
+        help=(
+            'Name or path of a Hugging Face (fast) tokenizer. If given, the '
+            'text column is tokenized before shuffling, and replaced by '
+            'the columns "tokens" (token IDs) and "num_tokens".'
+        ),
     )
     parser.add_argument(
-        '--event-dir',
-        default=os.path.join(tempfile.gettempdir(), 'spark-events'),
+        '--text-column',
+        default='text',
+        help='Column containing the texts to tokenize.',
     )
-    parser.add_argument('--available-mem-gb', type=float)
-    parser.add_argument('--output-dir', required=True)
     parser.add_argument(
-        '--num-shards',
-        type=int,
-        help='Uniformly shard across all input files into this many shards',
+        '--keep-text',
+        action='store_true',
+        help='Keep the text column when tokenizing.',
     )
-    parser.add_argument('--rank', type=int)
     parser.add_argument(
-        '--input-format',
-        choices=['parquet', 'json'],
-        default='parquet',
-        help='Format of the input data, i.e., when reading.',
+        '--bos-text',
+        default='',
+        help='Text to insert at the beginning of each tokenized text.',
     )
     parser.add_argument(
-        '--output-format',
-        choices=['parquet', 'json'],
-        default='parquet',
-        help='Format of the output data, i.e., when writing.',
+        '--eos-text',
+        default='',
+        help='Text to insert at the end of each tokenized text.',
+    )
+    parser.add_argument(
+        '--get-bos-token-id',
+        action='store_true',
+        help=(
+            "Insert the tokenizer's BOS token ID instead of tokenizing "
+            '`--bos-text`.'
+        ),
     )
     parser.add_argument(
-        '--output-compression',
-        default='zstd',
+        '--get-eos-token-id',
+        action='store_true',
         help=(
-            'Compression to apply to the output data, i.e., when writing. '
-            '"none" or "" for no compression.'
+            "Insert the tokenizer's EOS token ID instead of tokenizing "
+            '`--eos-text`.'
         ),
     )
-    return parser.parse_args()
+    args = parser.parse_args()
+    assert args.concat_tokens is None or (
+        args.tokenizer is not None and args.output_format == 'mds'
+    ), '`--concat-tokens` needs `--tokenizer` and `--output-format mds`'
+    return args
+
+
+def get_num_output_files(
+        df,
+        input_files,
+        target_file_bytes=None,
+        rows_per_file=None,
+        file_count_multiple=1,
+):
+    """Return the number of equally sized output files that results in
+    files of about `target_file_bytes` bytes or `rows_per_file` rows,
+    or `None` if neither is given.
+    """
+    if target_file_bytes is not None:
+        input_bytes = get_input_bytes(input_files)
+        num_files = math.ceil(input_bytes / target_file_bytes)
+        print(f'{input_bytes} input bytes')
+    elif rows_per_file is not None:
+        num_rows = df.count()
+        num_files = math.ceil(num_rows / rows_per_file)
+        print(f'{num_rows} input rows')
+    else:
+        return None
+
+    num_files = round_num_files(num_files, file_count_multiple)
+    print(f'writing {num_files} output files')
+    return num_files
 
 
 def main():
     args = parse_args()
-    assert args.dist_input_files or args.dist_input_files_glob, (
-        'need either `--dist-input-files` or `--dist-input-files-glob` '
-        'to be specified'
-    )
-    assert (
-        args.num_shards is None and args.rank is None
-        or args.num_shards is not None and args.rank is not None
-    ), 'cannot give only one of `--num-shards` and `--rank`; please set both'
+    check_args(args)
 
     world_size = int(os.environ['WORLD_SIZE'])
 
@@ -111,14 +171,7 @@ def main():
 
     os.makedirs(os.path.dirname(args.output_dir), exist_ok=True)
 
-    input_files = []
-    if args.dist_input_files:
-        input_files.extend(args.dist_input_files.split(':'))
-    if args.dist_input_files_glob:
-        input_files.extend(sorted(glob.glob(args.dist_input_files_glob)))
-
-    if args.num_shards is not None:
-        input_files = input_files[args.rank::args.num_shards]
+    input_files = get_input_files(args)
 
     print(f'now reading {args.input_format}')
     if args.input_format == 'parquet':
@@ -127,19 +180,69 @@ def main():
         df = spark.read.json(input_files)
     else:
         print(f'unhandled data input format {args.input_format}...')
-    print('read parquet, now adding random column')
-    df = df.withColumn('randf', sf.rand(seed=args.seed))
-    print('added random column, now sorting')
-    df = df.sort('randf')
-    print('sorted, now coalescing')
-    df = df.drop('randf')
-    df = df.coalesce(world_size)
-
-    output_compression = (
-        args.output_compression
-        if args.output_compression not in ['', 'none']
-        else None
+    num_files = get_num_output_files(
+        df,
+        input_files,
+        target_file_bytes=args.target_file_bytes,
+        rows_per_file=args.rows_per_file,
+        file_count_multiple=args.file_count_multiple,
     )
+
+    # Tokenized rows cached for the global sort, if any.
+    tokenized_df = None
+    if args.tokenizer is not None:
+        # Tokenize before shuffling, so that tokenization runs with the
+        # parallelism of the input partitions instead of after the
+        # exchange.
+        print(f'now tokenizing {args.text_column} with {args.tokenizer}')
+        df = tokenize_column(
+            spark,
+            df,
+            args.tokenizer,
+            text_column=args.text_column,
+            bos_text=args.bos_text,
+            eos_text=args.eos_text,
+            get_bos_token_id=args.get_bos_token_id,
+            get_eos_token_id=args.get_eos_token_id,
+            keep_text=args.keep_text,
+        )
+        if args.shuffle_mode == 'sort':
+            # The global sort evaluates its input twice: once in a
+            # separate job that samples the range boundaries, and once
+            # for the sort itself. Cache the tokenized rows so the
+            # tokenizer only runs in the first of them.
+            tokenized_df = df.persist(StorageLevel.MEMORY_AND_DISK)
+            df = tokenized_df
+
+    if args.shuffle_mode == 'partition':
+        num_partitions = args.num_partitions or num_files or world_size
+        print('read data, now sending rows to random partitions')
+        # Hashing a random value assigns each row to a uniformly random
+        # partition in a single exchange.
+        df = df.repartition(num_partitions, sf.rand(seed=args.seed))
+        print('partitioned, now shuffling within partitions')
+        # Use a different seed so the order within a partition is
+        # independent of the partition assignment.
+        df = df.sortWithinPartitions(sf.rand(seed=args.seed + 1))
+    else:
+        if num_files is not None:
+            # Let the sort itself produce the output partitions, so
+            # that all executor cores write files of similar size.
+            spark.conf.set('spark.sql.shuffle.partitions', num_files)
+            spark.conf.set(
+                'spark.sql.adaptive.coalescePartitions.enabled',
+                'false',
+            )
+        print('read parquet, now adding random column')
+        df = df.withColumn('randf', sf.rand(seed=args.seed))
+        print('added random column, now sorting')
+        df = df.sort('randf')
+        df = df.drop('randf')
+        if num_files is None:
+            print('sorted, now coalescing')
+            df = df.coalesce(world_size)
+
+    output_compression = get_output_compression(args)
     print(f'coalesced, now writing {args.output_format}')
     if args.output_format == 'parquet':
         df.write.parquet(
@@ -153,8 +256,35 @@ def main():
             mode='overwrite',
             compression=output_compression,
         )
+    elif args.output_format == 'mds':
+        if args.mds_columns is not None:
+            mds_column_names = args.mds_columns.split(',')
+        elif args.tokenizer is not None:
+            mds_column_names = [TOKENS_COLUMN]
+        else:
+            mds_column_names = [args.text_column]
+        mds_columns = get_mds_columns(df.schema, mds_column_names)
+        print(f'writing MDS columns {mds_columns}')
+        # Like Spark's "overwrite" mode.
+        if os.path.exists(args.output_dir):
+            shutil.rmtree(args.output_dir)
+        num_samples = write_mds(
+            df,
+            args.output_dir,
+            mds_columns,
+            compression=output_compression,
+            concat_tokens=args.concat_tokens,
+            no_wrap=args.no_wrap,
+        )
+        print(
+            f'wrote {sum(num_samples.values())} samples to '
+            f'{len(num_samples)} MDS datasets'
+        )
     else:
         print(f'unhandled data output format {args.output_format}...')
+    if tokenized_df is not None:
+        # Free the cached rows on the executors' memory and disks.
+        tokenized_df.unpersist()
     print('done')
 
     close_client()
@@ -0,0 +1,549 @@
+"""
+Shuffle data on a single node with PyArrow, without Spark.
+
+This is an external-memory shuffle in two passes over the data, each
+parallelized over all cores with a process pool:
+
+1. Scatter: each task streams record batches from (a part of) an input
+   file and sends each row to one of `K` buckets chosen uniformly at
+   random. Rows are buffered up to a fixed number of bytes, grouped by
+   bucket and appended to the task's bucket file, so memory stays
+   bounded regardless of the input size.
+2. Shuffle: each bucket is read into memory, permuted, and written as
+   one output file.
+
+Since every row is assigned to a uniformly random bucket and every
+bucket is uniformly permuted, the output is a uniform shuffle of the
+input (when reading the output files in a random order), just like
+`shuffle_data.py --shuffle-mode partition`.
+
+The command line interface is the same as that of `shuffle_data.py`.
+`--local-dir` holds the bucket files, `--num-partitions` sets `K` (and
+thus the number of output files), and `--available-mem-gb` bounds the
+memory used. The Spark-specific `--shuffle-mode` and `--event-dir` are
+ignored with a warning.
+"""
+
+import json
+import math
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+from typing import Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.json as pa_json
+import pyarrow.parquet as pq
+
+from shuffle_common import (
+    check_args,
+    get_input_bytes,
+    get_input_files,
+    get_output_compression,
+    get_parser,
+    round_num_files,
+)
+
+# Fraction of a worker's memory that may be buffered while scattering,
+# and that a bucket may take up in memory while shuffling (the permuted
+# copy and the writer's buffers take up the rest).
+MEMORY_FRACTION = 0.25
+
+# Block size for reading JSON; larger blocks make type inference more
+# robust.
+JSON_BLOCK_BYTES = 64 << 20
+
+# File extensions of output compressions for JSON output, and
+# compression names Spark uses that PyArrow calls differently.
+_JSON_EXTENSIONS = {
+    'bz2': '.bz2',
+    'gzip': '.gz',
+    'lz4': '.lz4',
+    'zstd': '.zst',
+}
+_COMPRESSION_NAMES = {'bzip2': 'bz2', 'uncompressed': None}
+
+
+# Arguments of `shuffle_data.py` that only apply to Spark.
+_SPARK_ONLY_ARGS = ['shuffle_mode', 'event_dir']
+
+
+def parse_args():
+    parser = get_parser()
+    parser.add_argument(
+        '--num-workers',
+        type=int,
+        default=len(os.sched_getaffinity(0)),
+        help='Number of processes to use; defaults to all available cores.',
+    )
+    # Only to tell whether Spark-specific arguments were given.
+    parser.set_defaults(**{name: None for name in _SPARK_ONLY_ARGS})
+    args = parser.parse_args()
+    for name in _SPARK_ONLY_ARGS:
+        if getattr(args, name) is not None:
+            print(
+                f'Warning: ignoring `--{name.replace("_", "-")}`, which '
+                f'only applies to the Spark shuffler `shuffle_data.py`.'
+            )
+    return args
+
+
+def get_memory_bytes(available_mem_gb: Optional[float]) -> int:
+    """Return the number of bytes of memory the shuffle may use."""
+    if available_mem_gb:
+        return int(available_mem_gb * 1e9)
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def get_in_memory_bytes(path: str, input_format: str) -> int:
+    """Return the approximate size of the data in `path` in memory."""
+    if input_format == 'parquet':
+        metadata = pq.ParquetFile(path).metadata
+        return sum(
+            metadata.row_group(i).total_byte_size
+            for i in range(metadata.num_row_groups)
+        )
+    return os.path.getsize(path)
+
+
+def count_rows(path: str, input_format: str) -> int:
+    """Return the number of rows in `path`."""
+    if input_format == 'parquet':
+        return pq.ParquetFile(path).metadata.num_rows
+
+    num_rows = 0
+    last_byte = b'\n'
+    with pa.input_stream(path, compression='detect') as f:
+        while True:
+            data = f.read(JSON_BLOCK_BYTES)
+            if not data:
+                break
+            num_rows += data.count(b'\n')
+            last_byte = data[-1:]
+    # The last line may not end with a newline.
+    return num_rows + (last_byte != b'\n')
+
+
+def _count_rows_in_worker(args: Tuple[str, str]) -> int:
+    return count_rows(*args)
+
+
+def get_num_buckets(
+        args,
+        input_files: Sequence[str],
+        pool: mp.Pool,
+        memory_bytes: int,
+) -> int:
+    """Return the number of buckets, i.e., output files.
+
+    Unless `--num-partitions` is given, the number of files follows from
+    `--target-file-bytes` or `--rows-per-file` like in `shuffle_data.py`,
+    or else is chosen so that each worker gets a bucket and every bucket
+    fits into memory.
+    """
+    max_bucket_bytes = memory_bytes * MEMORY_FRACTION / args.num_workers
+    in_memory_bytes = sum(
+        get_in_memory_bytes(path, args.input_format) for path in input_files
+    )
+    print(f'{in_memory_bytes} input bytes in memory')
+
+    if args.num_partitions is not None:
+        num_buckets = args.num_partitions
+    elif args.target_file_bytes is not None:
+        input_bytes = get_input_bytes(input_files)
+        num_buckets = round_num_files(
+            math.ceil(input_bytes / args.target_file_bytes),
+            args.file_count_multiple,
+        )
+    elif args.rows_per_file is not None:
+        num_rows = sum(pool.map(
+            _count_rows_in_worker,
+            [(path, args.input_format) for path in input_files],
+        ))
+        print(f'{num_rows} input rows')
+        num_buckets = round_num_files(
+            math.ceil(num_rows / args.rows_per_file),
+            args.file_count_multiple,
+        )
+    else:
+        num_buckets = max(
+            args.num_workers,
+            math.ceil(in_memory_bytes / max_bucket_bytes),
+        )
+
+    if in_memory_bytes / num_buckets > max_bucket_bytes:
+        print(
+            f'Warning: buckets will take up about '
+            f'{in_memory_bytes / num_buckets / 1e9:.2f} GB of memory, more '
+            f'than the {max_bucket_bytes / 1e9:.2f} GB available per worker; '
+            f'consider writing more output files or using fewer workers.'
+        )
+    return num_buckets
+
+
+def is_splittable_json(path: str) -> bool:
+    """Return whether `path` is an uncompressed JSON lines file."""
+    return path.endswith(('.json', '.jsonl'))
+
+
+def get_json_byte_ranges(
+        path: str,
+        range_bytes: float,
+) -> List[Tuple[int, int]]:
+    """Split the JSON lines file `path` into byte ranges of at most
+    about `range_bytes` bytes, like `jsonl_byte_ranges.list_byte_ranges`
+    in the other environments.
+
+    A byte range `[start, end)` contains exactly those lines whose first
+    byte lies in it.
+    """
+    size = os.path.getsize(path)
+    num_ranges = max(math.ceil(size / max(range_bytes, 1)), 1)
+    offsets = [size * i // num_ranges for i in range(num_ranges + 1)]
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def read_json_byte_range(path: str, start: int, end: int) -> bytes:
+    """Return the lines starting in byte range `[start, end)` of
+    `path`.
+    """
+    with open(path, 'rb') as f:
+        position = start
+        if start > 0:
+            # Skip the line that started before the range, but not a
+            # line starting exactly at `start`.
+            f.seek(start - 1)
+            position = start - 1 + len(f.readline())
+        if position >= end:
+            return b''
+        data = f.read(end - position)
+        if data and not data.endswith(b'\n'):
+            # Complete the last line, which started inside the range.
+            data += f.readline()
+    return data
+
+
+def get_scatter_tasks(
+        input_files: Sequence[str],
+        input_format: str,
+        buffer_bytes: float,
+) -> List[Tuple[str, Optional[Union[List[int], Tuple[int, int]]]]]:
+    """Return the input of each scatter task as a file path and the part
+    of the file to read: row groups for Parquet, a byte range for JSON,
+    or `None` to read the whole file.
+
+    Parquet files are split into runs of row groups and uncompressed
+    JSON lines files into newline-aligned byte ranges of about
+    `buffer_bytes` bytes, so that large files are scattered in parallel.
+    Compressed JSON files are read by a single task each.
+    """
+    tasks = []
+    for path in input_files:
+        if input_format != 'parquet':
+            if is_splittable_json(path):
+                tasks.extend(
+                    (path, byte_range)
+                    for byte_range in get_json_byte_ranges(path, buffer_bytes)
+                )
+            else:
+                tasks.append((path, None))
+            continue
+
+        metadata = pq.ParquetFile(path).metadata
+        row_groups = []
+        num_bytes = 0
+        for i in range(metadata.num_row_groups):
+            row_groups.append(i)
+            num_bytes += metadata.row_group(i).total_byte_size
+            if num_bytes >= buffer_bytes:
+                tasks.append((path, row_groups))
+                row_groups = []
+                num_bytes = 0
+        if row_groups or metadata.num_row_groups == 0:
+            tasks.append((path, row_groups))
+    return tasks
+
+
+def iter_batches(
+        path: str,
+        input_format: str,
+        part: Optional[Union[List[int], Tuple[int, int]]],
+) -> Iterator[pa.RecordBatch]:
+    """Iterate over the record batches of `part` (see
+    `get_scatter_tasks`) of `path`.
+    """
+    if input_format == 'parquet':
+        parquet_file = pq.ParquetFile(path)
+        row_groups = part
+        if row_groups is None:
+            row_groups = list(range(parquet_file.metadata.num_row_groups))
+        yield from parquet_file.iter_batches(row_groups=row_groups)
+    elif input_format == 'json':
+        source = path
+        if part is not None:
+            data = read_json_byte_range(path, *part)
+            if not data:
+                return
+            source = pa.BufferReader(data)
+        yield from pa_json.open_json(
+            source,
+            read_options=pa_json.ReadOptions(block_size=JSON_BLOCK_BYTES),
+        )
+    else:
+        raise ValueError(f'unhandled data input format {input_format}')
+
+
+def scatter(
+        task_index: int,
+        path: str,
+        part: Optional[Union[List[int], Tuple[int, int]]],
+        input_format: str,
+        num_buckets: int,
+        seed: int,
+        bucket_dir: str,
+        buffer_bytes: float,
+) -> Tuple[str, np.ndarray, int]:
+    """Send each row read by the task to a random bucket.
+
+    All buckets of a task are stored in a single Arrow IPC file, with
+    each record batch belonging to a single bucket.
+
+    Returns:
+        The path of the bucket file, the bucket of each of its record
+        batches, and the number of rows.
+    """
+    rng = np.random.default_rng([seed, 0, task_index])
+    bucket_path = os.path.join(bucket_dir, f'{task_index:06}.arrow')
+    batch_buckets = []
+    num_rows = 0
+    writer = None
+    buffered = []
+    buffered_bytes = 0
+
+    def flush():
+        nonlocal writer
+        table = pa.Table.from_batches(buffered)
+        keys = rng.integers(num_buckets, size=len(table))
+        # Group rows by bucket; rows keep their order within a bucket,
+        # which the shuffle pass randomizes anyway.
+        table = table.take(np.argsort(keys, kind='stable')).combine_chunks()
+        ends = np.cumsum(np.bincount(keys, minlength=num_buckets))
+
+        if writer is None:
+            writer = pa.ipc.new_file(bucket_path, table.schema)
+        start = 0
+        for (bucket, end) in enumerate(ends.tolist()):
+            if end == start:
+                continue
+            for batch in table.slice(start, end - start).to_batches():
+                writer.write_batch(batch)
+                batch_buckets.append(bucket)
+            start = end
+
+    for batch in iter_batches(path, input_format, part):
+        buffered.append(batch)
+        buffered_bytes += batch.nbytes
+        num_rows += batch.num_rows
+        if buffered_bytes >= buffer_bytes:
+            flush()
+            buffered = []
+            buffered_bytes = 0
+    if buffered:
+        flush()
+
+    if writer is None:
+        return (None, np.array([], dtype=np.int64), 0)
+    writer.close()
+    return (bucket_path, np.array(batch_buckets, dtype=np.int64), num_rows)
+
+
+def _scatter_in_worker(args) -> Tuple[str, np.ndarray, int]:
+    return scatter(*args)
+
+
+def get_output_path(
+        output_dir: str,
+        bucket: int,
+        output_format: str,
+        compression: Optional[str],
+) -> str:
+    if output_format == 'parquet':
+        suffix = f'.{compression}' if compression else ''
+        return os.path.join(output_dir, f'part-{bucket:05}{suffix}.parquet')
+    suffix = _JSON_EXTENSIONS.get(compression, '') if compression else ''
+    return os.path.join(output_dir, f'part-{bucket:05}.json{suffix}')
+
+
+def write_json(table: pa.Table, path: str, compression: Optional[str]):
+    """Write `table` to `path` as JSON lines."""
+    with pa.output_stream(path, compression=compression) as f:
+        for batch in table.to_batches(max_chunksize=1 << 14):
+            f.write(''.join(
+                json.dumps(row, ensure_ascii=False) + '\n'
+                for row in batch.to_pylist()
+            ).encode('utf-8'))
+
+
+def shuffle_bucket(
+        bucket: int,
+        pieces: Sequence[Tuple[str, List[int]]],
+        seed: int,
+        output_dir: str,
+        output_format: str,
+        compression: Optional[str],
+) -> int:
+    """Read the record batches `pieces` (as bucket file paths and batch
+    indices) of `bucket`, shuffle them, and write them as an output
+    file.
+
+    Returns:
+        The number of rows written.
+    """
+    tables = []
+    for (path, batch_indices) in pieces:
+        with pa.OSFile(path, 'rb') as f:
+            reader = pa.ipc.open_file(f)
+            tables.append(pa.Table.from_batches(
+                [reader.get_batch(i) for i in batch_indices],
+                schema=reader.schema,
+            ))
+    table = pa.concat_tables(tables, promote_options='default')
+    del tables
+
+    rng = np.random.default_rng([seed, 1, bucket])
+    table = table.take(rng.permutation(len(table)))
+
+    path = get_output_path(output_dir, bucket, output_format, compression)
+    if output_format == 'parquet':
+        pq.write_table(table, path, compression=compression or 'none')
+    elif output_format == 'json':
+        write_json(table, path, compression)
+    else:
+        raise ValueError(f'unhandled data output format {output_format}')
+    return len(table)
+
+
+def _shuffle_bucket_in_worker(args) -> int:
+    return shuffle_bucket(*args)
+
+
+def _init_worker():
+    # Parallelism comes from the processes.
+    pa.set_cpu_count(1)
+
+
+def main():
+    args = parse_args()
+    check_args(args)
+    assert args.num_workers >= 1, '`--num-workers` must be at least 1'
+
+    input_files = get_input_files(args)
+    # Unlike Spark, PyArrow's readers used here only read single files.
+    for path in input_files:
+        assert os.path.isfile(path), (
+            f'{path} is not a file; directories are only supported by '
+            f'`shuffle_data.py`'
+        )
+    compression = get_output_compression(args)
+    compression = _COMPRESSION_NAMES.get(compression, compression)
+    memory_bytes = get_memory_bytes(args.available_mem_gb)
+    buffer_bytes = memory_bytes * MEMORY_FRACTION / args.num_workers
+
+    if os.path.exists(args.output_dir):
+        shutil.rmtree(args.output_dir)
+    os.makedirs(args.output_dir)
+    os.makedirs(args.local_dir, exist_ok=True)
+    bucket_dir = tempfile.mkdtemp(
+        prefix='shuffle-buckets-',
+        dir=args.local_dir,
+    )
+
+    start_time = time.perf_counter()
+    try:
+        with mp.Pool(args.num_workers, initializer=_init_worker) as pool:
+            num_buckets = get_num_buckets(
+                args,
+                input_files,
+                pool,
+                memory_bytes,
+            )
+            tasks = get_scatter_tasks(
+                input_files,
+                args.input_format,
+                buffer_bytes,
+            )
+            print(
+                f'scattering {len(input_files)} input files in {len(tasks)} '
+                f'tasks to {num_buckets} buckets'
+            )
+            scattered = pool.map(
+                _scatter_in_worker,
+                [
+                    (
+                        task_index,
+                        path,
+                        part,
+                        args.input_format,
+                        num_buckets,
+                        args.seed,
+                        bucket_dir,
+                        buffer_bytes,
+                    )
+                    for (task_index, (path, part)) in enumerate(tasks)
+                ],
+                chunksize=1,
+            )
+            num_rows = sum(task_rows for (_, _, task_rows) in scattered)
+            print(
+                f'scattered {num_rows} rows in '
+                f'{time.perf_counter() - start_time:.1f} s, now shuffling '
+                f'buckets'
+            )
+
+            bucket_pieces = [[] for _ in range(num_buckets)]
+            for (path, batch_buckets, _) in scattered:
+                if path is None:
+                    continue
+                for bucket in np.unique(batch_buckets).tolist():
+                    batch_indices = np.flatnonzero(batch_buckets == bucket)
+                    bucket_pieces[bucket].append(
+                        (path, batch_indices.tolist()),
+                    )
+
+            # Buckets that received no rows do not get an output file.
+            num_written = sum(pool.imap_unordered(
+                _shuffle_bucket_in_worker,
+                [
+                    (
+                        bucket,
+                        pieces,
+                        args.seed,
+                        args.output_dir,
+                        args.output_format,
+                        compression,
+                    )
+                    for (bucket, pieces) in enumerate(bucket_pieces)
+                    if pieces
+                ],
+            ))
+    finally:
+        shutil.rmtree(bucket_dir)
+
+    assert num_written == num_rows, (
+        f'wrote {num_written} rows, but read {num_rows}'
+    )
+    # Mark the output as complete, like Spark does.
+    with open(os.path.join(args.output_dir, '_SUCCESS'), 'w'):
+        pass
+    print(
+        f'wrote {num_written} rows in '
+        f'{time.perf_counter() - start_time:.1f} s'
+    )
+    print('done')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Writing Spark data frames directly in the MDS format of the `streaming`
+library.
+
+Each partition is written by its Spark task as a separate MDS dataset
+in `<output_dir>/<partition index>`, which is the layout of the per-rank
+outputs of the LLM Foundry conversion scripts. They can be merged into
+a single dataset with `merge_dataset.py`.
+
+By default, each row becomes one sample, so token IDs are written
+unpacked, as one variable-length sample per document. With
+`concat_tokens`, they are instead packed into samples of a fixed number
+of tokens per partition, like the `--concat_tokens` output of the LLM
+Foundry conversion scripts.
+"""
+
+import os
+import shutil
+from typing import Dict, Iterator, Optional, Sequence
+
+import numpy as np
+import pyarrow as pa
+from pyspark import TaskContext
+from pyspark.sql import DataFrame
+from pyspark.sql import types as st
+
+from spark_tokenization import TOKENS_COLUMN, TokenPacker
+
+# MDS encodings of Spark's scalar types.
+_SCALAR_ENCODINGS = {
+    st.StringType: 'str',
+    st.BinaryType: 'bytes',
+    st.ByteType: 'int8',
+    st.ShortType: 'int16',
+    st.IntegerType: 'int32',
+    st.LongType: 'int64',
+    st.FloatType: 'float32',
+    st.DoubleType: 'float64',
+}
+
+# Compression names Spark uses that `streaming` calls differently.
+_COMPRESSION_NAMES = {'gzip': 'gz', 'bzip2': 'bz2', 'uncompressed': None}
+
+
+def get_mds_encoding(data_type: st.DataType) -> str:
+    """Return the MDS encoding of values of Spark type `data_type`.
+
+    Arrays of numbers are stored as NumPy arrays; types without a
+    dedicated encoding are stored as JSON.
+    """
+    if type(data_type) in _SCALAR_ENCODINGS:
+        return _SCALAR_ENCODINGS[type(data_type)]
+    if isinstance(data_type, st.ArrayType):
+        element_encoding = _SCALAR_ENCODINGS.get(type(data_type.elementType))
+        if element_encoding not in [None, 'str', 'bytes']:
+            return f'ndarray:{element_encoding}'
+    return 'json'
+
+
+def get_mds_columns(
+        schema: st.StructType,
+        column_names: Sequence[str],
+) -> Dict[str, str]:
+    """Return the MDS columns (names and encodings) for the columns
+    `column_names` of a data frame with `schema`.
+    """
+    fields = {field.name: field for field in schema.fields}
+    missing = [name for name in column_names if name not in fields]
+    if missing:
+        raise ValueError(
+            f'columns {missing} do not exist; available columns are '
+            f'{list(fields)}',
+        )
+    return {
+        name: get_mds_encoding(fields[name].dataType)
+        for name in column_names
+    }
+
+
+def get_mds_compression(compression: Optional[str]) -> Optional[str]:
+    """Return the `streaming` name of the Spark compression
+    `compression`.
+    """
+    return _COMPRESSION_NAMES.get(compression, compression)
+
+
+def iter_column_values(column: pa.Array, encoding: str) -> Iterator:
+    """Yield the values of `column` as expected by the MDS `encoding`."""
+    if not encoding.startswith('ndarray:'):
+        yield from column.to_pylist()
+        return
+
+    # Slice the flat values instead of creating a Python list per row.
+    # Missing arrays become empty arrays.
+    dtype = encoding.split(':', 1)[1]
+    values = column.values.to_numpy(zero_copy_only=False).astype(
+        dtype,
+        copy=False,
+    )
+    offsets = column.offsets.to_numpy()
+    is_null = column.is_null().to_numpy(zero_copy_only=False)
+    for i in range(len(column)):
+        if is_null[i]:
+            yield values[:0]
+        else:
+            yield values[offsets[i]:offsets[i + 1]]
+
+
+def iter_samples(
+        batch: pa.RecordBatch,
+        columns: Dict[str, str],
+) -> Iterator[Dict]:
+    """Yield the MDS samples of the rows of `batch`."""
+    values = [
+        iter_column_values(batch.column(name), encoding)
+        for (name, encoding) in columns.items()
+    ]
+    for row in zip(*values):
+        yield dict(zip(columns, row))
+
+
+def iter_packed_samples(
+        batch: pa.RecordBatch,
+        packer: TokenPacker,
+) -> Iterator[Dict]:
+    """Yield the MDS samples that `packer` completes with the token IDs
+    of the rows of `batch`.
+    """
+    column = batch.column(TOKENS_COLUMN)
+    # Respects slicing, unlike `column.values`.
+    tokens = column.flatten().to_numpy(zero_copy_only=False)
+    doc_lengths = np.diff(column.offsets.to_numpy())
+    for sample in packer.pack(tokens, doc_lengths):
+        yield {TOKENS_COLUMN: sample}
+
+
+def write_mds(
+        df: DataFrame,
+        output_dir: str,
+        columns: Dict[str, str],
+        compression: Optional[str] = None,
+        concat_tokens: Optional[int] = None,
+        no_wrap: bool = False,
+) -> Dict[int, int]:
+    """Write each partition of `df` as an MDS dataset with `columns` to
+    `<output_dir>/<partition index>`.
+
+    If `concat_tokens` is given, the token IDs of the `tokens` column are
+    packed into samples of `concat_tokens` tokens instead, wrapping
+    texts across samples unless `no_wrap`; `columns` then has to be only
+    the `tokens` column. Leftover tokens at the end of a partition are
+    discarded.
+
+    Partitions without samples are not written.
+
+    Returns:
+        The number of samples written per written partition index.
+    """
+    if concat_tokens is not None and list(columns) != [TOKENS_COLUMN]:
+        raise ValueError(
+            f'can only pack tokens when writing only the {TOKENS_COLUMN} '
+            f'column, not {list(columns)}',
+        )
+    compression = get_mds_compression(compression)
+
+    def write_partition(
+            batches: Iterator[pa.RecordBatch],
+    ) -> Iterator[pa.RecordBatch]:
+        # Only needed when writing MDS, so shuffling does not require
+        # `streaming`.
+        from streaming import MDSWriter
+
+        partition = TaskContext.get().partitionId()
+        out = os.path.join(output_dir, str(partition))
+        packer = None
+        if concat_tokens is not None:
+            packer = TokenPacker(concat_tokens, should_wrap=not no_wrap)
+        writer = None
+        num_samples = 0
+        try:
+            for batch in batches:
+                if batch.num_rows == 0:
+                    continue
+                if packer is None:
+                    samples = iter_samples(batch, columns)
+                else:
+                    samples = iter_packed_samples(batch, packer)
+                for sample in samples:
+                    if writer is None:
+                        # Remove the output of a previous attempt of this
+                        # task.
+                        if os.path.exists(out):
+                            shutil.rmtree(out)
+                        writer = MDSWriter(
+                            columns=columns,
+                            out=out,
+                            compression=compression,
+                        )
+                    writer.write(sample)
+                    num_samples += 1
+        except BaseException:
+            # Do not leave a partial partition behind that looks
+            # complete; `finish` would write its `index.json`.
+            if writer is not None:
+                writer.cancel_future_jobs()
+            shutil.rmtree(out, ignore_errors=True)
+            raise
+        if writer is not None:
+            writer.finish()
+
+        yield pa.RecordBatch.from_pydict({
+            'partition': pa.array([partition], type=pa.int32()),
+            'samples': pa.array([num_samples], type=pa.int64()),
+        })
+
+    counts = df.mapInArrow(
+        write_partition,
+        'partition int, samples long',
+    ).collect()
+    return {
+        row['partition']: row['samples']
+        for row in counts
+        if row['samples'] > 0
+    }
@@ -0,0 +1,221 @@
+"""
+Tokenization of a text column inside a Spark job.
+
+Texts are tokenized per Arrow record batch with a single call to a
+(fast) Hugging Face tokenizer, which is broadcast to the executors once.
+Token IDs are stored as an array column, so no Python objects are
+created per token on the way back to the JVM. `TokenPacker` optionally
+packs them into fixed-length samples when writing.
+"""
+
+import itertools
+import os
+from typing import Iterator, List, Tuple
+import warnings
+
+import numpy as np
+import pyarrow as pa
+from pyspark.sql import DataFrame, SparkSession
+from pyspark.sql import types as st
+
+TOKENS_COLUMN = 'tokens'
+NUM_TOKENS_COLUMN = 'num_tokens'
+
+
+def load_tokenizer(name_or_path: str):
+    """Return the fast tokenizer `name_or_path`."""
+    # Only needed when tokenizing, so shuffling does not require
+    # `transformers`.
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(name_or_path, use_fast=True)
+    # We tokenize whole documents; do not warn about their length.
+    tokenizer.model_max_length = int(1e30)
+    return tokenizer
+
+
+def get_special_tokens(
+        tokenizer,
+        bos_text: str = '',
+        eos_text: str = '',
+        get_bos_token_id: bool = False,
+        get_eos_token_id: bool = False,
+) -> Tuple[List[int], List[int]]:
+    """Return the token IDs to insert before and after each text, like
+    `get_special_tokens` of the LLM Foundry conversion scripts.
+    """
+    special_tokens = []
+    for (text, get_token_id, token_id, name) in [
+            (bos_text, get_bos_token_id, tokenizer.bos_token_id, 'bos'),
+            (eos_text, get_eos_token_id, tokenizer.eos_token_id, 'eos'),
+    ]:
+        if get_token_id:
+            special_tokens.append([token_id])
+            continue
+
+        tokens = tokenizer(
+            text,
+            truncation=False,
+            padding=False,
+            add_special_tokens=False,
+        )['input_ids']
+        if len(tokens) > 1:
+            warnings.warn(
+                f'You specified --{name}-text={text}. That text will be '
+                f'tokenized into {len(tokens)} tokens, not a single '
+                f'{name.upper()} token.',
+            )
+        special_tokens.append(tokens)
+    return tuple(special_tokens)
+
+
+class TokenPacker:
+    """Pack a stream of tokenized texts into samples of `max_length`.
+
+    The behavior is the same as in LLM Foundry's `ConcatTokensDataset`
+    (and `batched_tokenization.TokenPacker` of the LLM Foundry
+    environment): when wrapping, texts are concatenated and cut at every
+    `max_length` boundary; when not wrapping, a sample is emitted as
+    soon as the buffered texts reach `max_length` and the remaining
+    tokens of the buffer are discarded.
+    """
+
+    def __init__(
+            self,
+            max_length: int,
+            should_wrap: bool = True,
+            dtype: np.dtype = np.int32,
+    ) -> None:
+        self.max_length = max_length
+        self.should_wrap = should_wrap
+        self.buffer = np.empty(0, dtype=dtype)
+
+    def pack(
+            self,
+            tokens: np.ndarray,
+            doc_lengths: np.ndarray,
+    ) -> Iterator[np.ndarray]:
+        """Add tokenized texts (the flat array of all their token IDs and
+        the number of tokens of each) to the buffer and yield all full
+        samples.
+        """
+        num_buffered = len(self.buffer)
+        if num_buffered > 0:
+            tokens = np.concatenate([self.buffer, tokens])
+
+        if self.should_wrap:
+            num_samples = len(tokens) // self.max_length
+            end = num_samples * self.max_length
+            yield from tokens[:end].reshape(num_samples, self.max_length)
+            self.buffer = tokens[end:].copy()
+        else:
+            start = 0
+            for doc_end in num_buffered + np.cumsum(doc_lengths):
+                if doc_end - start >= self.max_length:
+                    yield tokens[start:start + self.max_length]
+                    start = doc_end
+            self.buffer = tokens[start:].copy()
+
+
+def tokenize_batch(
+        batch: pa.RecordBatch,
+        tokenizer,
+        bos_tokens: List[int],
+        eos_tokens: List[int],
+        text_column: str,
+        keep_text: bool = False,
+) -> pa.RecordBatch:
+    """Return `batch` with the token IDs and number of tokens of each
+    text in `text_column` appended as columns. Missing texts are treated
+    as empty.
+    """
+    texts = [
+        text if text is not None else ''
+        for text in batch.column(text_column).to_pylist()
+    ]
+    input_ids = tokenizer(texts, truncation=False, padding=False)['input_ids']
+
+    num_special_tokens = len(bos_tokens) + len(eos_tokens)
+    num_tokens = np.fromiter(
+        (len(ids) + num_special_tokens for ids in input_ids),
+        dtype=np.int32,
+        count=len(input_ids),
+    )
+    offsets = np.zeros(len(num_tokens) + 1, dtype=np.int32)
+    np.cumsum(num_tokens, out=offsets[1:])
+    tokens = np.fromiter(
+        itertools.chain.from_iterable(
+            itertools.chain(bos_tokens, ids, eos_tokens)
+            for ids in input_ids
+        ),
+        dtype=np.int32,
+        count=int(offsets[-1]),
+    )
+
+    names = [
+        name for name in batch.schema.names
+        if keep_text or name != text_column
+    ]
+    return pa.RecordBatch.from_arrays(
+        [batch.column(name) for name in names] + [
+            pa.ListArray.from_arrays(pa.array(offsets), pa.array(tokens)),
+            pa.array(num_tokens),
+        ],
+        names=names + [TOKENS_COLUMN, NUM_TOKENS_COLUMN],
+    )
+
+
+def tokenize_column(
+        spark: SparkSession,
+        df: DataFrame,
+        tokenizer_name: str,
+        text_column: str = 'text',
+        bos_text: str = '',
+        eos_text: str = '',
+        get_bos_token_id: bool = False,
+        get_eos_token_id: bool = False,
+        keep_text: bool = False,
+) -> DataFrame:
+    """Return `df` with `text_column` replaced by (or, with `keep_text`,
+    extended with) the token IDs (`tokens`) and their number
+    (`num_tokens`) of each text.
+    """
+    tokenizer = load_tokenizer(tokenizer_name)
+    (bos_tokens, eos_tokens) = get_special_tokens(
+        tokenizer,
+        bos_text,
+        eos_text,
+        get_bos_token_id,
+        get_eos_token_id,
+    )
+    # Executors deserialize the tokenizer once and cache it.
+    broadcast = spark.sparkContext.broadcast(
+        (tokenizer, bos_tokens, eos_tokens),
+    )
+
+    schema = st.StructType([
+        field for field in df.schema.fields
+        if keep_text or field.name != text_column
+    ] + [
+        st.StructField(TOKENS_COLUMN, st.ArrayType(st.IntegerType())),
+        st.StructField(NUM_TOKENS_COLUMN, st.IntegerType()),
+    ])
+
+    def tokenize_batches(
+            batches: Iterator[pa.RecordBatch],
+    ) -> Iterator[pa.RecordBatch]:
+        # Parallelism comes from Spark's tasks; do not let each of them
+        # spawn its own tokenizer thread pool on top.
+        os.environ['TOKENIZERS_PARALLELISM'] = 'false'
+        (tokenizer, bos_tokens, eos_tokens) = broadcast.value
+        for batch in batches:
+            yield tokenize_batch(
+                batch,
+                tokenizer,
+                bos_tokens,
+                eos_tokens,
+                text_column,
+                keep_text,
+            )
+
+    return df.mapInArrow(tokenize_batches, schema)